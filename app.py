@@ -4,11 +4,19 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import eventlet
 eventlet.monkey_patch()
 import base64
+import json
 import os
-from flask import Flask, render_template, request, session, jsonify, redirect, url_for, Response
+import time
+from flask import Flask, render_template, request, session, jsonify, redirect, url_for, Response, stream_with_context
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from system.rag_system import OptimizedRAGSystem
-from system.face_auth import FaceAuthTransformer
+from system.model_registry import model_registry, register_default_models, FACE_AUTH, PHOBERT, VIT
+from system.face_auth import find_matching_face
+from system.face_gallery import get_face_gallery, encode_embeddings
+from system.auth_governor import AuthFrameGovernor
+from system.inference_pool import get_inference_pool, pool_stats, InferenceBusy, FACE_POOL, MODEL_POOL
+from system.warmup import StartupWarmup, WarmupComponent
+from system.face_batcher import FaceEmbeddingBatcher
 from services.voice_service import VoiceService
 from services.suggestion_service import SuggestionService
 from services.suggestion_query_handler import SuggestionQueryHandler
@@ -21,8 +29,10 @@ import logging
 from utils import get_purchase_history, get_all_categories, get_products_by_category, get_all_products
 from search_engine.extract_info_image import LLMExtract
 from search_engine.get_URL_img import extract_product_images
-import sqlite3
-import json
+from db_pool import get_pool, pool_metrics
+import hmac
+import threading
+from functools import wraps
 
 load_dotenv()
 
@@ -31,29 +41,80 @@ app.secret_key = os.environ.get("FLASK_SECRET_KEY", "a_very_secret_key_for_dev_o
 socketio = SocketIO(app, async_mode='eventlet', cors_allowed_origins="*")
 
 config = Config()
-rag_system = OptimizedRAGSystem(config)
+db_pool = get_pool(config.db_path, config.db_timeout)
+face_gallery = get_face_gallery(config.db_path)
+register_default_models(config)
+# RAG system (PhoBERT, hai FAISS store, Gemini, chỉ mục ảnh) được tạo khi cần hoặc bởi warm-up nền
+_rag_system = None
+_rag_system_lock = threading.Lock()
+
+def get_rag_system():
+    global _rag_system
+    if _rag_system is None:
+        with _rag_system_lock:
+            if _rag_system is None:
+                _rag_system = OptimizedRAGSystem(config)
+    return _rag_system
+
 suggestion_service = SuggestionService(config)
-suggestion_handler = SuggestionQueryHandler(rag_system, suggestion_service)
-client_auth_transformers = {}
+suggestion_handler = SuggestionQueryHandler(get_rag_system, suggestion_service)
+# Trạng thái xác thực của từng SID nằm trong governor; model khuôn mặt dùng chung qua registry
+auth_governor = AuthFrameGovernor.from_config(config)
+face_pool = get_inference_pool(FACE_POOL, config.face_workers)
+model_pool = get_inference_pool(MODEL_POOL, config.model_workers)
+# ArcFace của nhiều SID được gom thành micro-batch trước khi chạy trên face_pool
+face_batcher = FaceEmbeddingBatcher(
+    lambda: model_registry.get(FACE_AUTH, runner=face_pool.run), face_pool,
+    max_batch=config.face_max_batch, window_ms=config.face_batch_window_ms
+) if config.face_batching_enabled else None
 
 
 voice_service = VoiceService()
 
+# Model được tải trên pool suy luận (ngoài hub) rồi chạy thử một lượt; RAG system dùng PhoBERT và ViT đã tải
+# và cũng đọc FAISS store, đồng bộ và chỉ mục ảnh trên pool
+warmup = StartupWarmup([
+    WarmupComponent(FACE_AUTH, lambda: model_registry.get(FACE_AUTH, runner=face_pool.run),
+                    lambda model: face_pool.run(model.warmup)),
+    WarmupComponent(PHOBERT, lambda: model_registry.get(PHOBERT, runner=model_pool.run),
+                    lambda model: model_pool.run(model.warmup)),
+    WarmupComponent(VIT, lambda: model_registry.get(VIT, runner=model_pool.run),
+                    lambda model: model_pool.run(model.warmup)),
+    WarmupComponent("rag", get_rag_system, lambda rag: rag.warmup()),
+], order=[name.strip() for name in config.warmup_order.split(",") if name.strip()],
+   run_warmup=config.warmup_inference, retry_attempts=config.warmup_retry_attempts,
+   retry_backoff=config.warmup_retry_backoff)
+if config.warmup_background:
+    # Server mở cổng ngay; /readyz trả 503 đến khi mọi thành phần sẵn sàng
+    warmup.start(socketio.start_background_task)
+else:
+    warmup.run()
+
 logging.basicConfig(level=logging.DEBUG)
 
+def _decode_image_bytes(base64_string):
+    img_data = base64.b64decode(base64_string)
+    np_arr = np.frombuffer(img_data, np.uint8)
+    return cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+
 def decode_image_from_base64(base64_string):
     """Decodes a base64 image string (data URL) into an OpenCV image."""
     try:
         if ',' in base64_string:
             base64_string = base64_string.split(',')[1]
-        img_data = base64.b64decode(base64_string)
-        np_arr = np.frombuffer(img_data, np.uint8)
-        img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-        return img
+        # Giải mã JPEG trên pool khuôn mặt, không chặn hub eventlet
+        return face_pool.run(_decode_image_bytes, base64_string)
+    except InferenceBusy:
+        raise
     except Exception as e:
         print(f"Error decoding base64 image: {e}")
         return None
 
+def _busy_response(e):
+    """503 khi pool suy luận đã đầy; client nên thử lại sau ít giây."""
+    print(f"Rejecting request, {e}")
+    return jsonify({"error": "Máy chủ đang bận, vui lòng thử lại sau giây lát.", "busy": True}), 503, {"Retry-After": "2"}
+
 # --- Routes ---
 @app.route('/')
 def index():
@@ -92,6 +153,25 @@ def chat():
 
     return jsonify(result)
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Streams the assistant answer as server-sent events (token, product_images, done, error)."""
+    data = request.get_json()
+    user_query = data.get('prompt')
+    if not user_query:
+        return jsonify({"error": "No prompt provided"}), 400
+
+    # Session phải được cập nhật trước khi bắt đầu stream (cookie nằm trong header)
+    suggestion_handler.ensure_valid_session()
+    user_key = suggestion_handler.get_user_key_from_session()
+
+    def generate():
+        for event, payload in suggestion_handler.stream_chat_message(user_key, user_query):
+            yield f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/logout')
 def logout():
     """Logs the user out by clearing relevant session keys."""
@@ -121,7 +201,7 @@ def start_anonymous_chat():
 
     session['anonymous'] = True
 
-    rag_system.clear_chat_history("anonymous")
+    get_rag_system().clear_chat_history("anonymous")
     print("Starting anonymous chat session.")
     return redirect(url_for('index'))
 
@@ -143,69 +223,77 @@ def register():
             if not all([name, sex, age, location]):
                 return jsonify({'error': 'Thiếu thông tin bắt buộc'}), 400
 
-            # Kết nối database
-            conn = sqlite3.connect('Database.db')
-            cursor = conn.cursor()
-
-            # Thêm thông tin người dùng vào bảng Customers
-            cursor.execute('''
-                INSERT INTO Customers (name, sex, age, location)
-                VALUES (?, ?, ?, ?)
-            ''', (name, sex, age, location))
-
-            # Lấy ID vừa tạo
-            user_id = cursor.lastrowid
-            print(f"Đã tạo người dùng mới với ID: {user_id}")
-
-            # Kiểm tra ID có tồn tại trong database
-            cursor.execute('SELECT id FROM Customers WHERE id = ?', (user_id,))
-            if not cursor.fetchone():
-                raise Exception(f"Không tìm thấy người dùng với ID {user_id} trong database")
-
-            # Tạo thư mục lưu ảnh cho người dùng
-            user_img_dir = os.path.join('cus_img', str(user_id))
-            os.makedirs(user_img_dir, exist_ok=True)
-            print(f"Đã tạo thư mục lưu ảnh: {user_img_dir}")
-
-            # Lưu ảnh và tạo embedding
+            # Tạo embedding trước khi ghi database để không giữ kết nối ghi trong lúc chạy model
             embeddings = []
-            for i, image_data in enumerate(images):
+            decoded_images = []
+            for image_data in images:
                 # Chuyển base64 thành ảnh
                 image_data = image_data.split(',')[1]
                 image_bytes = base64.b64decode(image_data)
+                decoded_images.append(image_bytes)
 
-                # Lưu ảnh
-                image_path = os.path.join(user_img_dir, f'image_{i+1}.jpg')
-                with open(image_path, 'wb') as f:
-                    f.write(image_bytes)
-
-                # Tạo embedding
                 img = decode_image_from_base64(image_data)
                 if img is not None:
-                    transformer = FaceAuthTransformer()
-                    embedding = transformer.get_face_embedding(img)
+                    transformer = model_registry.get(FACE_AUTH, runner=face_pool.run)
+                    embedding = face_pool.run(transformer.get_face_embedding, img)
                     if embedding is not None:
                         embeddings.append(embedding)
 
-            if embeddings:
-                combined_embedding = np.vstack(embeddings)
-                embedding_json = json.dumps(combined_embedding.tolist())
-
-                cursor.execute('''
-                    UPDATE Customers
-                    SET embedding = ?
-                    WHERE id = ?
-                ''', (embedding_json, user_id))
-
-            conn.commit()
-            conn.close()
+            with db_pool.connection(readonly=False) as conn:
+                user_id = _insert_customer(conn, name, sex, age, location, decoded_images, embeddings)
+            # Giao dịch đã commit: thêm ngay vào gallery khuôn mặt thay vì nạp lại toàn bộ
+            face_gallery.add(user_id, name, embeddings)
 
             return jsonify({'success': True, 'user_id': user_id})
 
+        except InferenceBusy as e:
+            return _busy_response(e)
         except Exception as e:
             print(f"Error during registration: {e}")
             return jsonify({'error': 'Lỗi hệ thống'}), 500
 
+def _insert_customer(conn, name, sex, age, location, decoded_images, embeddings):
+    """Insert the customer row, save face images and store embeddings in one transaction."""
+    cursor = conn.cursor()
+
+    # Thêm thông tin người dùng vào bảng Customers
+    cursor.execute('''
+        INSERT INTO Customers (name, sex, age, location)
+        VALUES (?, ?, ?, ?)
+    ''', (name, sex, age, location))
+
+    # Lấy ID vừa tạo
+    user_id = cursor.lastrowid
+    print(f"Đã tạo người dùng mới với ID: {user_id}")
+
+    # Kiểm tra ID có tồn tại trong database
+    cursor.execute('SELECT id FROM Customers WHERE id = ?', (user_id,))
+    if not cursor.fetchone():
+        raise Exception(f"Không tìm thấy người dùng với ID {user_id} trong database")
+
+    # Tạo thư mục lưu ảnh cho người dùng
+    user_img_dir = os.path.join('cus_img', str(user_id))
+    os.makedirs(user_img_dir, exist_ok=True)
+    print(f"Đã tạo thư mục lưu ảnh: {user_img_dir}")
+
+    # Lưu ảnh
+    for i, image_bytes in enumerate(decoded_images):
+        image_path = os.path.join(user_img_dir, f'image_{i+1}.jpg')
+        with open(image_path, 'wb') as f:
+            f.write(image_bytes)
+
+    if embeddings:
+        # Lưu dạng BLOB float32 thay vì chuỗi JSON
+        combined_embedding = np.vstack(embeddings)
+
+        cursor.execute('''
+            UPDATE Customers
+            SET embedding = ?
+            WHERE id = ?
+        ''', (encode_embeddings(combined_embedding), user_id))
+
+    return user_id
+
 @app.route('/reset_session')
 def reset_session():
     """Reset session and redirect to auth page."""
@@ -224,6 +312,98 @@ def voice_service_status():
     }
     return jsonify(status)
 
+@app.route('/db-pool-status')
+def db_pool_status():
+    """Report connection pool metrics (open/idle/in-use connections, reuse, waits)."""
+    return jsonify(pool_metrics())
+
+@app.route('/face-gallery-status')
+def face_gallery_status():
+    """Report the size and index type of the in-memory face gallery."""
+    return jsonify(face_gallery.stats())
+
+@app.route('/auth-stream-status')
+def auth_stream_status():
+    """Report frame-governor backpressure stats summed over all connected auth streams."""
+    return jsonify(auth_governor.stats())
+
+@app.route('/model-status')
+def model_status():
+    """Report load state, load time and estimated memory of each shared model."""
+    return jsonify(model_registry.stats())
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: process is serving; includes per-component warm-up state and load times."""
+    return jsonify(warmup.status())
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: 200 once every required model/index is loaded and warmed up, 503 before that."""
+    status = warmup.status()
+    if not status["ready"]:
+        return jsonify(status), 503, {"Retry-After": "5"}
+    return jsonify(status)
+
+@app.route('/inference-status')
+def inference_status():
+    """Report queue depth, wait times and rejections of the inference worker pools."""
+    return jsonify({
+        "pools": pool_stats(),
+        "face_batcher": face_batcher.stats() if face_batcher is not None else None
+    })
+
+def admin_required(view):
+    """Chỉ cho phép request có header X-Admin-Token khớp ADMIN_TOKEN (tắt nếu chưa cấu hình)."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = request.headers.get('X-Admin-Token', '')
+        if not config.admin_token or not hmac.compare_digest(token, config.admin_token):
+            return jsonify({"error": "Forbidden"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/admin/response-cache', methods=['GET'])
+@admin_required
+def response_cache_status():
+    """Report semantic response cache and query embedding cache hit rates."""
+    rag_system = get_rag_system()
+    query_cache = rag_system.embeddings.query_cache
+    return jsonify({
+        "response_cache": rag_system.response_cache.stats(),
+        "query_embedding_cache": query_cache.stats() if query_cache is not None else None
+    })
+
+@app.route('/admin/sql-plan-cache', methods=['GET', 'DELETE'])
+@admin_required
+def sql_plan_cache_status():
+    """Report SQL plan cache hit rate and LLM generation time saved; DELETE clears the cache."""
+    if request.method == 'DELETE':
+        get_rag_system().sql_plan_cache.clear()
+    return jsonify(get_rag_system().sql_plan_cache.stats())
+
+@app.route('/admin/response-cache/evict', methods=['POST'])
+@admin_required
+def response_cache_evict():
+    """Evict cached responses by route and/or user scope; an empty body clears the whole cache."""
+    data = request.get_json(silent=True) or {}
+    response_cache = get_rag_system().response_cache
+    removed = response_cache.evict(route=data.get('route'), scope=data.get('user_key'))
+    return jsonify({"removed": removed, "stats": response_cache.stats()})
+
+@app.route('/admin/vector-store/sync', methods=['GET', 'POST'])
+@admin_required
+def vector_store_sync():
+    """POST syncs the text and description vector stores with the database and swaps them in; GET reports the last sync."""
+    rag_system = get_rag_system()
+    if request.method == 'GET':
+        return jsonify(rag_system.vector_store_versions())
+    try:
+        results = rag_system.sync_vector_stores()
+    except InferenceBusy as e:
+        return _busy_response(e)
+    return jsonify({"results": results, "versions": rag_system.vector_store_versions()})
+
 @app.route('/text-to-speech', methods=['POST'])
 def text_to_speech():
     """Convert text to speech using ElevenLabs API."""
@@ -267,9 +447,8 @@ def handle_connect():
     sid = request.sid
     print(f'Client connected for auth: {sid}')
 
-    client_auth_transformers[sid] = FaceAuthTransformer()
+    auth_governor.open(sid)
     join_room(sid)
-    print(f"Auth transformer created for SID: {sid}")
 
 @socketio.on('disconnect')
 def handle_disconnect():
@@ -277,48 +456,71 @@ def handle_disconnect():
     sid = request.sid
     print(f'Client disconnected: {sid}')
 
-    if sid in client_auth_transformers:
-        del client_auth_transformers[sid]
-        print(f"Auth transformer removed for SID: {sid}")
+    auth_governor.close(sid)
     leave_room(sid)
 
+def _emit_auth_stats(sid, force=False):
+    if force or auth_governor.should_report(sid):
+        emit('auth_stats', auth_governor.stats(sid), room=sid)
+
 @socketio.on('video_frame')
 def handle_video_frame(data):
     """Receives and processes video frames for face authentication."""
     sid = request.sid
 
-    if sid not in client_auth_transformers:
-        print(f"Error: No auth transformer found for SID {sid}. Client might need to reconnect.")
+    # Bỏ frame trước cả khi giải mã nếu SID đang bận, gửi quá nhanh hoặc đã xác thực xong
+    drop_reason = auth_governor.try_acquire(sid)
+    if drop_reason == "unknown":
+        print(f"Error: No auth stream found for SID {sid}. Client might need to reconnect.")
         return
-
-    image_data_url = data.get('image')
-    if not image_data_url:
-        print(f"Error: No image data received from {sid}")
-        return
-
-    frame = decode_image_from_base64(image_data_url)
-    if frame is None:
-        print(f"Error decoding image from {sid}")
+    if drop_reason:
+        if drop_reason == "done":
+            emit('auth_stream_end', {'reason': 'confirmed'}, room=sid)
+        _emit_auth_stats(sid)
         return
 
-    transformer = client_auth_transformers[sid]
-
+    started = time.perf_counter()
     try:
-        result = transformer.recognize_face(frame)
-        match_outcome = result.get('match')
-        bbox = result.get('bbox')
-        confidence = result.get('confidence')
-
-        if bbox:
-            bbox = [int(coord) for coord in bbox]
+        image_data_url = data.get('image')
+        if not image_data_url:
+            print(f"Error: No image data received from {sid}")
+            return
+
+        frame = decode_image_from_base64(image_data_url)
+        if frame is None:
+            print(f"Error decoding image from {sid}")
+            return
+
+        transformer = model_registry.get(FACE_AUTH, runner=face_pool.run)
+        match_outcome, bbox, confidence = None, None, None
+        # RetinaFace/ArcFace chạy trên pool thread thật; so khớp gallery ở lại hub
+        detection = face_pool.run(transformer.detect_face, frame)
+        if detection is not None:
+            face, bbox, confidence = detection
+            # Khuôn mặt gần như đứng yên: dùng lại kết quả nhận dạng trước, bỏ qua ArcFace
+            match_outcome = auth_governor.reusable_match(sid, bbox)
+            if match_outcome is None:
+                if face_batcher is not None:
+                    embedding = face_batcher.embed(frame, face)
+                else:
+                    embedding = face_pool.run(transformer.embed, frame, face)
+                match_outcome = (find_matching_face(embedding, db_path=config.db_path) or False) if embedding is not None else False
+                auth_governor.remember(sid, bbox, match_outcome)
+        streak = auth_governor.observe(sid, match_outcome)
 
         emit_data = {'success': False, 'message': None, 'user_info': None, 'bbox': bbox, 'confidence': confidence}
 
         if isinstance(match_outcome, dict) and 'id' in match_outcome: # Successful match
-            print(f"Authentication successful for SID: {sid}. User: {match_outcome}")
-            emit_data['success'] = True
-            emit_data['user_info'] = match_outcome
-            emit('auth_result', emit_data, room=sid)
+            if auth_governor.is_confirmed(sid):
+                print(f"Authentication successful for SID: {sid}. User: {match_outcome}")
+                emit_data['success'] = True
+                emit_data['user_info'] = match_outcome
+                emit('auth_result', emit_data, room=sid)
+                emit('auth_stream_end', {'reason': 'confirmed'}, room=sid)
+                _emit_auth_stats(sid, force=True)
+            else:
+                emit_data['message'] = f'Đang xác nhận danh tính... ({streak}/{auth_governor.stable_frames})'
+                emit('auth_result', emit_data, room=sid)
         elif match_outcome is False:
             print(f"Authentication explicitly failed for SID: {sid}")
             emit_data['success'] = False
@@ -330,10 +532,17 @@ def handle_video_frame(data):
 
             emit('auth_result', emit_data, room=sid)
 
+    except InferenceBusy as e:
+        # Quá tải: bỏ frame này, client giữ nguyên camera và gửi frame tiếp theo
+        emit('auth_result', {'success': False, 'busy': True, 'message': 'Máy chủ đang bận, vui lòng giữ nguyên...',
+                             'bbox': None, 'confidence': None}, room=sid)
     except Exception as e:
         print(f"Error during face recognition processing for SID {sid}: {e}")
 
         emit('auth_result', {'success': False, 'message': f'Lỗi máy chủ: {e}', 'bbox': None, 'confidence': None}, room=sid)
+    finally:
+        auth_governor.release(sid, time.perf_counter() - started)
+        _emit_auth_stats(sid)
 
 @app.route('/confirm_auth', methods=['POST'])
 def confirm_auth():
@@ -413,6 +622,7 @@ def process_image():
         search_query += f" {extracted_info.suitable_for}"
 
         try:
+            rag_system = get_rag_system()
             search_response = rag_system._answer_with_vector(
                 user_key,
                 search_query,
@@ -432,6 +642,11 @@ def process_image():
                 except Exception as chat_save_err:
                     print(f"Error saving image search chat history for user {user_key}: {chat_save_err}")
 
+        except InferenceBusy as busy_err:
+            if os.path.exists(file_path):
+                try: os.remove(file_path)
+                except Exception as rm_err: print(f"Error cleaning up file {file_path} after busy rejection: {rm_err}")
+            return _busy_response(busy_err)
         except Exception as search_err:
             print(f"Exception during vector search: {search_err}")
             if os.path.exists(file_path):
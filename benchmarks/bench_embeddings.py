@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+import argparse
+import logging
+import numpy as np
+import torch
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(script_dir, '..'))
+sys.path.insert(0, project_root)
+
+from config import Config
+from utils import load_table_data
+from system.embeddings import PhoBERTEmbeddings
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def legacy_embed_documents(embeddings: PhoBERTEmbeddings, texts: list) -> list:
+    """Vòng lặp cũ: một lần tokenize và một lượt forward cho mỗi văn bản."""
+    results = []
+    for text in texts:
+        inputs = embeddings.tokenizer(text, return_tensors="pt", truncation=True, padding=True, max_length=embeddings.max_length)
+        with torch.no_grad():
+            outputs = embeddings.model(**inputs)
+        mean_emb = outputs.last_hidden_state.mean(dim=1).squeeze(0).numpy()
+        results.append(mean_emb.tolist())
+    return results
+
+def _time_run(fn, texts: list, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(texts)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main(config: Config, limit: int, batch_sizes: list, repeat: int):
+    """So sánh docs/sec giữa vòng lặp cũ và chế độ batch của PhoBERTEmbeddings."""
+    documents = load_table_data(config.db_path)
+    texts = [doc["content"] for doc in documents][:limit]
+    if not texts:
+        logger.warning("Không có văn bản nào để benchmark. Kết thúc.")
+        return
+
+    embeddings = PhoBERTEmbeddings(model_name=config.embedding_model)
+    logger.info(f"Benchmark trên {len(texts)} văn bản (lấy thời gian tốt nhất sau {repeat} lần chạy)")
+
+    legacy_time = _time_run(lambda t: legacy_embed_documents(embeddings, t), texts, repeat)
+    legacy_vectors = np.asarray(legacy_embed_documents(embeddings, texts[:8]), dtype=np.float32)
+    logger.info(f"Vòng lặp cũ: {len(texts) / legacy_time:.1f} docs/sec ({legacy_time:.2f}s)")
+
+    for batch_size in batch_sizes:
+        embeddings.batch_size = batch_size
+        batched_time = _time_run(embeddings.embed_documents_array, texts, repeat)
+        batched_vectors = embeddings.embed_documents_array(texts[:8])
+        max_diff = float(np.abs(batched_vectors - legacy_vectors).max())
+        logger.info(
+            f"Batch size {batch_size}: {len(texts) / batched_time:.1f} docs/sec ({batched_time:.2f}s), "
+            f"tăng tốc x{legacy_time / batched_time:.2f}, sai khác tối đa so với vòng lặp cũ: {max_diff:.2e}"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark PhoBERTEmbeddings.embed_documents")
+    parser.add_argument("--limit", type=int, default=512, help="Số văn bản tối đa lấy từ database")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[8, 16, 32, 64])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    main(Config(), args.limit, args.batch_sizes, args.repeat)
@@ -0,0 +1,109 @@
+import os
+import io
+import sys
+import glob
+import time
+import argparse
+import logging
+import threading
+import contextlib
+
+import cv2
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(script_dir, '..'))
+sys.path.insert(0, project_root)
+
+from config import Config
+from system.model_registry import model_registry, register_default_models, FACE_AUTH
+from system.inference_pool import InferencePool
+from system.face_batcher import FaceEmbeddingBatcher
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def load_frames(pattern: str, transformer):
+    """Đọc ảnh khách hàng mẫu, chỉ giữ ảnh có khuôn mặt (kèm kết quả detect)."""
+    frames = []
+    for path in sorted(glob.glob(pattern)):
+        frame = cv2.imread(path)
+        if frame is None:
+            continue
+        detection = transformer.detect_face(frame)
+        if detection is not None:
+            frames.append((frame, detection[0]))
+    return frames
+
+def run_clients(clients: int, duration: float, frames, process_frame) -> float:
+    """``clients`` luồng cùng gửi frame liên tục trong ``duration`` giây; trả về frames/s."""
+    processed = [0] * clients
+    stop = threading.Event()
+
+    def client(index: int):
+        i = index
+        while not stop.is_set():
+            frame, face = frames[i % len(frames)]
+            process_frame(frame, face)
+            processed[index] += 1
+            i += 1
+
+    workers = [threading.Thread(target=client, args=(c,)) for c in range(clients)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    time.sleep(duration)
+    stop.set()
+    for w in workers:
+        w.join()
+    return sum(processed) / (time.perf_counter() - start)
+
+def main(config: Config, client_counts, duration: float, workers: int, include_detection: bool, pattern: str):
+    """So sánh frames/s của ArcFace từng frame với micro-batch ở nhiều mức client đồng thời."""
+    register_default_models(config)
+    transformer = model_registry.get(FACE_AUTH)
+    frames = load_frames(pattern, transformer)
+    if not frames:
+        logger.warning(f"Không tìm thấy ảnh có khuôn mặt theo mẫu {pattern}. Kết thúc.")
+        return
+    logger.info(f"{len(frames)} ảnh mẫu, {workers} worker, detection {'có' if include_detection else 'không'} tính vào thời gian")
+
+    pool = InferencePool("bench-face", workers)
+    batcher = FaceEmbeddingBatcher(lambda: transformer, pool, max_batch=config.face_max_batch,
+                                   window_ms=config.face_batch_window_ms)
+
+    def unbatched(frame, face):
+        if include_detection:
+            pool.run(transformer.detect_face, frame)
+        pool.run(transformer.embed, frame, face)
+
+    def batched(frame, face):
+        if include_detection:
+            pool.run(transformer.detect_face, frame)
+        batcher.embed(frame, face)
+
+    # face_auth in log cho mỗi embedding; tắt để không đo thời gian ghi stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+        unbatched(*frames[0])
+        batched(*frames[0])
+
+    for clients in client_counts:
+        with contextlib.redirect_stdout(io.StringIO()):
+            before = batcher.stats()
+            single_fps = run_clients(clients, duration, frames, unbatched)
+            batched_fps = run_clients(clients, duration, frames, batched)
+            after = batcher.stats()
+        batches = after["batches"] - before["batches"]
+        avg_batch = (after["items"] - before["items"]) / batches if batches else 0.0
+        logger.info(f"{clients:>3} client: từng frame {single_fps:7.1f} frames/s | micro-batch {batched_fps:7.1f} frames/s "
+                    f"(x{batched_fps / single_fps if single_fps else 0:.2f}, batch TB {avg_batch:.1f})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark micro-batch ArcFace cho nhiều client xác thực đồng thời")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--duration", type=float, default=10.0, help="Số giây chạy cho mỗi cấu hình")
+    parser.add_argument("--workers", type=int, default=None, help="Số worker của pool (mặc định FACE_WORKERS)")
+    parser.add_argument("--include-detection", action="store_true", help="Tính cả RetinaFace (chạy từng frame) vào thông lượng")
+    parser.add_argument("--images", default=os.path.join(project_root, "cus_img", "*", "*.jpg"))
+    args = parser.parse_args()
+    config = Config()
+    main(config, args.clients, args.duration, args.workers or config.face_workers, args.include_detection, args.images)
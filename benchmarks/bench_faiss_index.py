@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import argparse
+import logging
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(script_dir, '..'))
+sys.path.insert(0, project_root)
+
+import faiss
+from config import Config
+from search_engine.faiss_indexer import FaissIndexer, create_index, reconstruct_vectors, set_search_params
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def load_vectors(config: Config, synthetic: int, dimension: int, seed: int) -> np.ndarray:
+    """Vector của chỉ mục ảnh hiện có, hoặc ``synthetic`` vector ngẫu nhiên có cấu trúc cụm (đã chuẩn hóa L2)."""
+    if synthetic:
+        rng = np.random.default_rng(seed)
+        centers = rng.standard_normal((max(1, synthetic // 100), dimension)).astype(np.float32)
+        vectors = centers[rng.integers(0, len(centers), synthetic)] + 0.5 * rng.standard_normal((synthetic, dimension)).astype(np.float32)
+    else:
+        indexer = FaissIndexer(config.image_index_path, config.image_metadata_path, dimension)
+        if indexer.get_index_size() == 0:
+            return np.zeros((0, dimension), dtype=np.float32)
+        vectors = reconstruct_vectors(indexer.index, indexer.ids)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+def measure(index, queries: np.ndarray, k: int):
+    """Tìm từng truy vấn một (như khi phục vụ request); trả về (kết quả, độ trễ ms từng truy vấn)."""
+    results = np.empty((len(queries), k), dtype=np.int64)
+    latencies = np.empty(len(queries))
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        _, indices = index.search(query[None, :], k)
+        latencies[i] = (time.perf_counter() - start) * 1000
+        results[i] = indices[0]
+    return results, latencies
+
+def recall_at_k(results: np.ndarray, ground_truth: np.ndarray) -> float:
+    k = ground_truth.shape[1]
+    return float(np.mean([len(set(r) & set(g)) / k for r, g in zip(results, ground_truth)]))
+
+def main(config: Config, synthetic: int, dimension: int, num_queries: int, k: int,
+         nprobes, ef_searches, seed: int):
+    """So sánh recall@k và độ trễ của IVF-Flat, IVF-PQ, HNSW với chỉ mục flat chính xác."""
+    vectors = load_vectors(config, synthetic, dimension, seed)
+    if len(vectors) <= k:
+        logger.warning("Không đủ vector để benchmark (dùng --synthetic N khi chưa có chỉ mục ảnh). Kết thúc.")
+        return
+    dimension = vectors.shape[1]
+
+    # Truy vấn: vector trong catalog cộng nhiễu nhỏ, giống ảnh chụp của một sản phẩm đã có
+    rng = np.random.default_rng(seed + 1)
+    queries = vectors[rng.integers(0, len(vectors), num_queries)] + 0.05 * rng.standard_normal((num_queries, dimension)).astype(np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    faiss.normalize_L2(queries)
+
+    flat, _ = create_index("flat", dimension, metric=config.image_index_metric)
+    flat.add(vectors)
+    ground_truth, flat_latencies = measure(flat, queries, k)
+    logger.info(f"{len(vectors)} vector, {dimension} chiều, {num_queries} truy vấn, k={k}")
+    logger.info(f"{'flat':<10} {'':<14} recall@{k} 1.000 | TB {flat_latencies.mean():7.3f} ms | p95 {np.percentile(flat_latencies, 95):7.3f} ms")
+
+    for index_type, settings, param in (("ivf_flat", nprobes, "nprobe"), ("ivf_pq", nprobes, "nprobe"), ("hnsw", ef_searches, "efSearch")):
+        start = time.perf_counter()
+        index, params = create_index(index_type, dimension, vectors, nlist=config.image_index_nlist,
+                                     pq_m=config.image_index_pq_m, pq_nbits=config.image_index_pq_nbits,
+                                     hnsw_m=config.image_index_hnsw_m, ef_construction=config.image_index_ef_construction,
+                                     metric=config.image_index_metric)
+        index.add(vectors)
+        build_s = time.perf_counter() - start
+        if params["index_type"] != index_type:
+            logger.info(f"{index_type:<10} bỏ qua: không đủ vector để huấn luyện")
+            continue
+        logger.info(f"{index_type:<10} build {build_s:.2f}s {params}")
+        for value in settings:
+            set_search_params(index, nprobe=value, ef_search=value)
+            results, latencies = measure(index, queries, k)
+            logger.info(f"{index_type:<10} {param}={value:<7} recall@{k} {recall_at_k(results, ground_truth):.3f} | "
+                        f"TB {latencies.mean():7.3f} ms | p95 {np.percentile(latencies, 95):7.3f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark recall@k và độ trễ của các loại chỉ mục FAISS so với flat")
+    parser.add_argument("--synthetic", type=int, default=0, help="Số vector ngẫu nhiên (0 = dùng chỉ mục ảnh hiện có)")
+    parser.add_argument("--dimension", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 64])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 32, 64, 128])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(Config(), args.synthetic, args.dimension, args.queries, args.k, args.nprobe, args.ef_search, args.seed)
@@ -0,0 +1,101 @@
+import os
+import io
+import sys
+import time
+import random
+import argparse
+import logging
+import contextlib
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(script_dir, '..'))
+sys.path.insert(0, project_root)
+
+from langchain_community.vectorstores import FAISS
+from config import Config
+from system.model_registry import model_registry, register_default_models, PHOBERT
+from search_engine.hybrid_search import HybridSearchResult
+from search_engine.description_embeddings import DescriptionEmbeddings
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def legacy_combine_results_mbr(hybrid_search, text_results, image_results, alpha=0.5, k=3):
+    """Cách tính MBR cũ: embed lại hai mô tả cho mỗi cặp ứng viên × kết quả."""
+    text_probs = hybrid_search._normalize_scores([(r, r.get('score', 0.0)) for r in text_results])
+    image_probs = hybrid_search._normalize_scores(image_results)
+
+    candidates = {}
+    for meta in text_results + [meta for meta, _ in image_results]:
+        candidates.setdefault(meta['product_id'], meta)
+
+    def compute_similarity(desc1, desc2):
+        emb1 = np.array(hybrid_search.embeddings.embed_query(desc1))
+        emb2 = np.array(hybrid_search.embeddings.embed_query(desc2))
+        return float(np.dot(emb1, emb2) / (np.linalg.norm(emb1) * np.linalg.norm(emb2) + 1e-8))
+
+    scores = []
+    for candidate_id, candidate in candidates.items():
+        sim_image = sum(image_probs.get(meta['product_id'], 0.0) * compute_similarity(candidate['description'], meta['description'])
+                        for meta, _ in image_results)
+        sim_text = sum(text_probs.get(r['product_id'], 0.0) * compute_similarity(candidate['description'], r['description'])
+                       for r in text_results)
+        scores.append((candidate_id, alpha * sim_image + (1 - alpha) * sim_text))
+    scores.sort(key=lambda x: -x[1])
+    return [candidates[cid] for cid, _ in scores[:k]]
+
+def main(config: Config, requests: int, k: int):
+    """Đo độ trễ MBR cho mỗi request trước và sau khi dùng ma trận embedding tính sẵn."""
+    register_default_models(config)
+    embeddings = model_registry.get(PHOBERT)
+    # Tắt cache truy vấn để cách tính cũ phản ánh đúng chi phí chạy PhoBERT
+    if embeddings.query_cache is not None:
+        embeddings.query_cache.enabled = False
+
+    store = FAISS.load_local(config.description_vector_store_path, embeddings, allow_dangerous_deserialization=True)
+    matrix = DescriptionEmbeddings.from_vector_store(store)
+    products = [store.docstore.search(doc_id).metadata for doc_id in store.index_to_docstore_id.values()]
+    if len(products) < 2 * k:
+        logger.warning("Không đủ sản phẩm trong description store để benchmark. Kết thúc.")
+        return
+
+    # Dùng HybridSearchResult mà không tải ViT/FAISS ảnh: MBR chỉ cần PhoBERT và ma trận mô tả
+    hybrid_search = object.__new__(HybridSearchResult)
+    hybrid_search.embeddings = embeddings
+    hybrid_search.set_description_embeddings(matrix)
+
+    rng = random.Random(0)
+    workloads = []
+    for _ in range(requests):
+        sample = rng.sample(products, 2 * k)
+        text_results = [{'product_id': p['ID'], 'description': p['description'], 'score': rng.uniform(50, 150)} for p in sample[:k]]
+        image_results = [({'product_id': p['ID'], 'description': p['description']}, rng.uniform(0.2, 1.5)) for p in sample[k:]]
+        workloads.append((text_results, image_results))
+
+    timings = {"legacy": [], "precomputed": []}
+    mismatches = 0
+    for text_results, image_results in workloads:
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            legacy = legacy_combine_results_mbr(hybrid_search, text_results, image_results, k=k)
+            timings["legacy"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            current = hybrid_search.combine_results_mbr(text_results, image_results, alpha=0.5, k=k)
+            timings["precomputed"].append(time.perf_counter() - start)
+        if [m['product_id'] for m in legacy] != [m['product_id'] for m in current]:
+            mismatches += 1
+
+    for name, values in timings.items():
+        values_ms = np.array(values) * 1000
+        logger.info(f"{name}: p50 {np.percentile(values_ms, 50):.2f} ms, p95 {np.percentile(values_ms, 95):.2f} ms")
+    logger.info(f"Tăng tốc p50: x{np.median(timings['legacy']) / np.median(timings['precomputed']):.1f}, "
+                f"số request xếp hạng khác nhau: {mismatches}/{requests}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark MBR fusion trong HybridSearchResult")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("-k", type=int, default=3)
+    args = parser.parse_args()
+    main(Config(), args.requests, args.k)
@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+from datetime import datetime
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(script_dir, '..'))
+sys.path.insert(0, project_root)
+
+from langchain_google_genai import ChatGoogleGenerativeAI
+from config import Config
+from system.model_registry import model_registry, register_default_models, PHOBERT
+from system.query_router import QueryRouter, SQL_TOOL, VECTOR_TOOL
+from system.schema_cache import SchemaCache
+from system.tool_manager import ToolManager
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Các mức độ tin cậy của router dùng để báo cáo tỉ lệ bất đồng với LLM (chọn ngưỡng ROUTER_CONFIDENCE_THRESHOLD)
+CONFIDENCE_BINS = (0.0, 0.2, 0.35, 0.5, 0.7, 0.9, 1.0)
+
+def load_logged_queries(history_path: str) -> list:
+    """Đọc các câu hỏi đã log theo thứ tự thời gian, kèm đoạn chat ngay trước đó của cùng user."""
+    with open(history_path, 'r', encoding='utf-8') as f:
+        histories = json.load(f)
+    samples = []
+    for user_key, entries in histories.items():
+        entries = sorted(entries, key=lambda x: datetime.fromisoformat(x['timestamp']))
+        previous = ""
+        for entry in entries:
+            samples.append({"user_key": user_key, "query": entry['query'], "history": previous})
+            previous = f"Q: {entry['query']}\nA: {entry['response']}"
+    return samples
+
+def llm_route(llm_with_tools, tool_manager: ToolManager, schema: str, sample: dict):
+    prompt = tool_manager.create_tool_selection_prompt(
+        recent_history_str=sample["history"],
+        query=sample["query"],
+        data_schema=schema
+    )
+    start = time.perf_counter()
+    response = llm_with_tools.invoke(prompt)
+    elapsed = time.perf_counter() - start
+    return tool_manager.process_tool_response(response) or VECTOR_TOOL, elapsed
+
+def disagreement_by_confidence(rows: list, edges=CONFIDENCE_BINS) -> list:
+    """Số câu và số câu router chọn khác LLM trong từng khoảng độ tin cậy [edges[i], edges[i + 1])."""
+    report = []
+    for low, high in zip(edges[:-1], edges[1:]):
+        in_bin = [r for r in rows if low <= r["decision"].confidence < high
+                  or (high == edges[-1] and r["decision"].confidence >= high)]
+        disagree = sum(r["decision"].tool != r["llm_tool"] for r in in_bin)
+        report.append({"low": low, "high": high, "count": len(in_bin), "disagree": disagree,
+                       "disagree_rate": disagree / len(in_bin) if in_bin else float("nan")})
+    return report
+
+def main(config: Config, history_path: str, threshold: float, dump_path: str):
+    """So sánh router cục bộ với router LLM trên các câu hỏi đã log và ước tính độ trễ tiết kiệm được."""
+    samples = load_logged_queries(history_path)
+    if not samples:
+        logger.warning(f"Không có câu hỏi nào trong {history_path}. Kết thúc.")
+        return
+
+    register_default_models(config)
+    router = QueryRouter.from_config(config, model_registry.get(PHOBERT))
+    router.confidence_threshold = threshold
+    router.route("khởi động")  # embed câu mẫu trước khi đo
+
+    tool_manager = ToolManager()
+    llm = ChatGoogleGenerativeAI(model=config.llm_model, temperature=config.llm_temperature, google_api_key=config.google_api_key)
+    llm_with_tools = llm.bind_tools(tool_manager.get_tools())
+    schema = SchemaCache(config.db_path).get_compact_schema()
+
+    rows = []
+    for sample in samples:
+        start = time.perf_counter()
+        decision = router.route(sample["query"])
+        router_time = time.perf_counter() - start
+        llm_tool, llm_time = llm_route(llm_with_tools, tool_manager, schema, sample)
+        rows.append({**sample, "decision": decision, "router_time": router_time, "llm_tool": llm_tool, "llm_time": llm_time})
+        logger.info(f"[{decision.source:>9}] {decision.tool} ({decision.confidence:.2f}) | LLM: {llm_tool} | {sample['query']}")
+
+    local = [r for r in rows if not r["decision"].needs_llm]
+    agree_all = np.mean([r["decision"].tool == r["llm_tool"] for r in rows])
+    agree_local = np.mean([r["decision"].tool == r["llm_tool"] for r in local]) if local else float("nan")
+    router_ms = np.array([r["router_time"] for r in rows]) * 1000
+    llm_ms = np.array([r["llm_time"] for r in rows]) * 1000
+    # Độ trễ chọn tool: câu tự tin chỉ tốn router, câu còn lại tốn router + LLM
+    pipeline_ms = np.array([r["router_time"] + (0 if not r["decision"].needs_llm else r["llm_time"]) for r in rows]) * 1000
+
+    logger.info(f"Số câu hỏi: {len(rows)}, router tự quyết: {len(local)} ({len(local) / len(rows):.0%})")
+    logger.info(f"Đồng thuận với LLM: toàn bộ {agree_all:.1%}, trên các câu router tự quyết {agree_local:.1%}")
+    for tool in (SQL_TOOL, VECTOR_TOOL):
+        logger.info(f"LLM chọn {tool}: {sum(r['llm_tool'] == tool for r in rows)}, router chọn: {sum(r['decision'].tool == tool for r in rows)}")
+    logger.info("Bất đồng với LLM theo độ tin cậy của router (không tính fallback):")
+    for level in disagreement_by_confidence(rows):
+        marker = " <- ngưỡng" if level["low"] <= threshold < level["high"] else ""
+        logger.info(f"  [{level['low']:.2f}, {level['high']:.2f}): {level['count']:>4} câu, "
+                    f"{level['disagree']:>3} bất đồng ({level['disagree_rate']:.1%}){marker}")
+    logger.info(f"Router: p50 {np.percentile(router_ms, 50):.1f} ms, p95 {np.percentile(router_ms, 95):.1f} ms")
+    logger.info(f"LLM chọn tool: p50 {np.percentile(llm_ms, 50):.1f} ms, p95 {np.percentile(llm_ms, 95):.1f} ms")
+    logger.info(f"Chọn tool với router + fallback: p50 {np.percentile(pipeline_ms, 50):.1f} ms, p95 {np.percentile(pipeline_ms, 95):.1f} ms, "
+                f"tiết kiệm trung bình {llm_ms.mean() - pipeline_ms.mean():.1f} ms/câu")
+
+    if dump_path:
+        # Nhãn của LLM có thể dùng làm câu mẫu bổ sung cho router (ROUTER_EXAMPLES_PATH)
+        with open(dump_path, 'w', encoding='utf-8') as f:
+            json.dump([{"query": r["query"], "tool": r["llm_tool"]} for r in rows], f, ensure_ascii=False, indent=2)
+        logger.info(f"Đã lưu nhãn LLM vào {dump_path}")
+
+if __name__ == "__main__":
+    config = Config()
+    parser = argparse.ArgumentParser(description="Đánh giá router cục bộ so với router LLM trên câu hỏi đã log")
+    parser.add_argument("--history", default=config.chat_history_path)
+    parser.add_argument("--threshold", type=float, default=config.router_confidence_threshold)
+    parser.add_argument("--dump-labels", default="", help="Lưu nhãn LLM ra file JSON dạng câu mẫu cho router")
+    args = parser.parse_args()
+    main(config, args.history, args.threshold, args.dump_labels)
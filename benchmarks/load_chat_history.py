@@ -0,0 +1,126 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import logging
+import tempfile
+import threading
+from datetime import datetime
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(script_dir, '..'))
+sys.path.insert(0, project_root)
+
+from system.chat_history import ChatHistory
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+class LegacyChatHistory:
+    """Cách lưu cũ: ghi lại toàn bộ file JSON (indent=2) sau mỗi tin nhắn, không khóa."""
+
+    def __init__(self, history_file: str, max_history_per_user: int = 3):
+        self.history_file = history_file
+        self.max_history_per_user = max_history_per_user
+        self.histories = {}
+
+    def add_chat(self, user_key: str, query: str, response: str):
+        self.histories.setdefault(user_key, []).append(
+            {"timestamp": datetime.now().isoformat(), "query": query, "response": response}
+        )
+        self.histories[user_key] = self.histories[user_key][-self.max_history_per_user:]
+        with open(self.history_file, 'w', encoding='utf-8') as f:
+            json.dump(self.histories, f, ensure_ascii=False, indent=2)
+
+    def get_latest_chat(self, user_key: str) -> str:
+        user_history = self.histories.get(user_key, [])
+        if not user_history:
+            return ""
+        latest_entry = max(user_history, key=lambda x: datetime.fromisoformat(x['timestamp']))
+        return f"Q: {latest_entry['query']}\nA: {latest_entry['response']}"
+
+def run_load(history, users: int, messages: int, threads: int) -> dict:
+    """Nhiều luồng cùng gửi tin nhắn cho các user ngẫu nhiên; đo độ trễ add_chat/get_latest_chat."""
+    add_times, read_times = [], []
+    lock = threading.Lock()
+
+    def worker(worker_id: int, count: int):
+        rng = random.Random(worker_id)
+        local_add, local_read = [], []
+        for i in range(count):
+            user_key = str(rng.randrange(users))
+            start = time.perf_counter()
+            history.get_latest_chat(user_key)
+            local_read.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            history.add_chat(user_key, f"Câu hỏi {worker_id}-{i} về giá Caffè Latte", "Caffè Latte có giá 45000 VND. " * 5)
+            local_add.append(time.perf_counter() - start)
+        with lock:
+            add_times.extend(local_add)
+            read_times.extend(local_read)
+
+    per_thread = messages // threads
+    workers = [threading.Thread(target=worker, args=(t, per_thread)) for t in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    add_ms, read_ms = np.array(add_times) * 1000, np.array(read_times) * 1000
+    return {
+        "messages": len(add_times),
+        "msgs_per_sec": len(add_times) / elapsed,
+        "add_p50_ms": np.percentile(add_ms, 50),
+        "add_p99_ms": np.percentile(add_ms, 99),
+        "read_p50_ms": np.percentile(read_ms, 50),
+    }
+
+def seed(history, users: int):
+    for user in range(users):
+        history.add_chat(str(user), "Xin chào", "Chào bạn!")
+
+def main(users: int, messages: int, threads: int, legacy_messages: int):
+    """So sánh cách ghi toàn bộ JSON cũ với các backend write-behind trên hàng nghìn user."""
+    workdir = tempfile.mkdtemp(prefix="chat_history_bench_")
+    try:
+        legacy = LegacyChatHistory(os.path.join(workdir, "legacy.json"))
+        legacy.histories = {str(u): [{"timestamp": datetime.now().isoformat(), "query": "Xin chào", "response": "Chào bạn!"}] for u in range(users)}
+        # Cách cũ chạy một luồng: nhiều luồng cùng ghi đè một file sẽ làm hỏng file
+        result = run_load(legacy, users, legacy_messages, 1)
+        logger.info(f"legacy (1 luồng, {legacy_messages} tin): {result['msgs_per_sec']:.0f} msg/s, "
+                    f"add p50 {result['add_p50_ms']:.2f} ms, p99 {result['add_p99_ms']:.2f} ms, read p50 {result['read_p50_ms']:.4f} ms")
+
+        for backend, file_name in (("json", "history.json"), ("sqlite", "history.sqlite")):
+            path = os.path.join(workdir, file_name)
+            history = ChatHistory(path, max_history_per_user=3, backend=backend, flush_interval=0.5)
+            seed(history, users)
+            history.flush()
+            result = run_load(history, users, messages, threads)
+            start = time.perf_counter()
+            history.close()
+            close_ms = (time.perf_counter() - start) * 1000
+
+            reloaded = ChatHistory(path, max_history_per_user=3, backend=backend, flush_interval=0)
+            total = sum(len(entries) for entries in reloaded.histories.values())
+            expected = sum(len(entries) for entries in history.histories.values())
+            reloaded.close()
+            logger.info(f"{backend} ({threads} luồng, {result['messages']} tin): {result['msgs_per_sec']:.0f} msg/s, "
+                        f"add p50 {result['add_p50_ms']:.3f} ms, p99 {result['add_p99_ms']:.3f} ms, "
+                        f"read p50 {result['read_p50_ms']:.4f} ms, flush cuối {close_ms:.1f} ms, "
+                        f"nạp lại {total}/{expected} mục {'OK' if total == expected else 'KHÔNG KHỚP'}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test cho ChatHistory với nhiều user")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--legacy-messages", type=int, default=200)
+    args = parser.parse_args()
+    main(args.users, args.messages, args.threads, args.legacy_messages)
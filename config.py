@@ -29,6 +29,13 @@ class Config:
     vector_index_path: str = str(base_dir / vector_store_dir / vector_index_file)
     vector_metadata_path: str = str(base_dir / vector_store_dir / vector_metadata_file)
     top_k_results: int = int(os.getenv("TOP_K_RESULTS", 3))
+    product_cache_enabled: bool = os.getenv("PRODUCT_CACHE_ENABLED", "true").lower() == "true"
+    # Map index.faiss và docstore vào bộ nhớ khi tải (chia sẻ page cache giữa các worker) thay vì đọc toàn bộ
+    index_mmap: bool = os.getenv("INDEX_MMAP", "true").lower() == "true"
+    # Đồng bộ vector store với database khi khởi động (tắt mặc định: mọi worker sẽ cùng ghi store;
+    # dùng POST /admin/vector-store/sync hoặc python -m system.vector_store_sync); số hàng mỗi lượt embed
+    vector_sync_on_start: bool = os.getenv("VECTOR_SYNC_ON_START", "false").lower() == "true"
+    vector_sync_batch_size: int = int(os.getenv("VECTOR_SYNC_BATCH_SIZE", 256))
     
     # Description vector store configuration
     description_store_dir: str = "search_engine/description_store"
@@ -40,24 +47,94 @@ class Config:
     
     # Model configuration
     embedding_model: str = os.getenv("EMBEDDING_MODEL", "vinai/phobert-base")
+    embedding_batch_size: int = int(os.getenv("EMBEDDING_BATCH_SIZE", 32))
     llm_model: str = os.getenv("LLM_MODEL", "gemini-1.5-flash-latest")
     llm_temperature: float = float(os.getenv("LLM_TEMPERATURE", 0))
+
+    # Query embedding cache configuration
+    query_cache_enabled: bool = os.getenv("QUERY_CACHE_ENABLED", "true").lower() == "true"
+    query_cache_size: int = int(os.getenv("QUERY_CACHE_SIZE", 1024))
+    query_cache_path: str = os.getenv("QUERY_CACHE_PATH", "")
+    query_cache_disk_size: int = int(os.getenv("QUERY_CACHE_DISK_SIZE", 50000))
+
+    # Chat pipeline configuration
+    pipeline_workers: int = int(os.getenv("PIPELINE_WORKERS", 8))
+    speculative_retrieval: bool = os.getenv("SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+    router_enabled: bool = os.getenv("ROUTER_ENABLED", "true").lower() == "true"
+    router_confidence_threshold: float = float(os.getenv("ROUTER_CONFIDENCE_THRESHOLD", 0.35))
+    router_examples_path: str = os.getenv("ROUTER_EXAMPLES_PATH", "")
+
+    # Semantic response cache configuration
+    response_cache_enabled: bool = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+    response_cache_threshold: float = float(os.getenv("RESPONSE_CACHE_THRESHOLD", 0.97))
+    response_cache_size: int = int(os.getenv("RESPONSE_CACHE_SIZE", 2000))
+    response_cache_ttl: int = int(os.getenv("RESPONSE_CACHE_TTL", 3600))
+
+    # Generated-SQL plan cache configuration
+    sql_plan_cache_enabled: bool = os.getenv("SQL_PLAN_CACHE_ENABLED", "true").lower() == "true"
+    sql_plan_cache_size: int = int(os.getenv("SQL_PLAN_CACHE_SIZE", 500))
+    
+    # Inference worker pools (model calls run off the eventlet hub)
+    model_workers: int = int(os.getenv("MODEL_WORKERS", 2))
+    inference_max_queue: int = int(os.getenv("INFERENCE_MAX_QUEUE", 32))
+    inference_queue_timeout: float = float(os.getenv("INFERENCE_QUEUE_TIMEOUT", 10))
+
+    # Face authentication stream (video_frame) configuration
+    face_workers: int = int(os.getenv("FACE_WORKERS", 2))
+    face_intra_op_threads: int = int(os.getenv("FACE_INTRA_OP_THREADS", 0))  # 0 = số CPU / FACE_WORKERS
+    face_inter_op_threads: int = int(os.getenv("FACE_INTER_OP_THREADS", 1))
+    face_batching_enabled: bool = os.getenv("FACE_BATCHING_ENABLED", "true").lower() == "true"
+    face_max_batch: int = int(os.getenv("FACE_MAX_BATCH", 16))
+    face_batch_window_ms: float = float(os.getenv("FACE_BATCH_WINDOW_MS", 5))
+    auth_max_fps: float = float(os.getenv("AUTH_MAX_FPS", 4))
+    auth_max_concurrent: int = int(os.getenv("AUTH_MAX_CONCURRENT", 4))
+    auth_reuse_iou: float = float(os.getenv("AUTH_REUSE_IOU", 0.85))
+    auth_reuse_max_frames: int = int(os.getenv("AUTH_REUSE_MAX_FRAMES", 1))
+    auth_reuse_max_age: float = float(os.getenv("AUTH_REUSE_MAX_AGE", 2.0))
+    auth_stable_frames: int = int(os.getenv("AUTH_STABLE_FRAMES", 3))
+    auth_stats_every: int = int(os.getenv("AUTH_STATS_EVERY", 10))
+    
+    # Startup warm-up (models load in the background after the port opens; /readyz reports readiness)
+    warmup_background: bool = os.getenv("WARMUP_BACKGROUND", "true").lower() == "true"
+    warmup_inference: bool = os.getenv("WARMUP_INFERENCE", "true").lower() == "true"
+    warmup_order: str = os.getenv("WARMUP_ORDER", "face_auth,phobert,vit,rag")
+    warmup_retry_attempts: int = int(os.getenv("WARMUP_RETRY_ATTEMPTS", 5))
+    warmup_retry_backoff: float = float(os.getenv("WARMUP_RETRY_BACKOFF", 5))
     
     # Image search configuration
     image_batch_size: int = int(os.getenv("IMAGE_BATCH_SIZE", 32))
     image_index_dir: str = "search_engine/image_index"
     image_index_path: str = os.getenv("IMAGE_FAISS_INDEX_PATH", str(base_dir / image_index_dir / "index.faiss"))
     image_metadata_path: str = os.getenv("IMAGE_FAISS_METADATA_PATH", str(base_dir / image_index_dir / "metadata.pkl"))
+    # flat (chính xác) | ivf_flat | ivf_pq | hnsw; nlist=0 = tự chọn theo số vector
+    image_index_type: str = os.getenv("IMAGE_INDEX_TYPE", "flat")
+    image_index_nlist: int = int(os.getenv("IMAGE_INDEX_NLIST", 0))
+    image_index_nprobe: int = int(os.getenv("IMAGE_INDEX_NPROBE", 8))
+    image_index_pq_m: int = int(os.getenv("IMAGE_INDEX_PQ_M", 16))
+    image_index_pq_nbits: int = int(os.getenv("IMAGE_INDEX_PQ_NBITS", 8))
+    image_index_hnsw_m: int = int(os.getenv("IMAGE_INDEX_HNSW_M", 32))
+    image_index_ef_construction: int = int(os.getenv("IMAGE_INDEX_EF_CONSTRUCTION", 40))
+    image_index_ef_search: int = int(os.getenv("IMAGE_INDEX_EF_SEARCH", 64))
+    # ip: điểm ảnh là cosine trong [-1, 1] (chỉ mục L2 cũ được chuyển đổi khi tải); l2: khoảng cách như trước
+    image_index_metric: str = os.getenv("IMAGE_INDEX_METRIC", "ip")
+    # Nhiệt độ softmax đổi cosine của kết quả ảnh thành xác suất cho MBR
+    image_score_temperature: float = float(os.getenv("IMAGE_SCORE_TEMPERATURE", 0.1))
     
     # System configuration
     system_dir: str = "system"
     chat_history_file: str = "chat_histories.json"
     chat_history_path: str = str(base_dir / chat_history_file)
     max_history_per_user: int = int(os.getenv("MAX_HISTORY_PER_USER", 3))
+    chat_history_backend: str = os.getenv("CHAT_HISTORY_BACKEND", "json")  # json | sqlite
+    chat_history_db_path: str = os.getenv("CHAT_HISTORY_DB_PATH", str(base_dir / "chat_histories.sqlite"))
+    chat_history_flush_interval: float = float(os.getenv("CHAT_HISTORY_FLUSH_INTERVAL", 1.0))
+    chat_history_compact_every: int = int(os.getenv("CHAT_HISTORY_COMPACT_EVERY", 1000))
     
     # API Keys - Read directly from environment variables (loaded from .env)
     google_api_key: str = os.getenv("GOOGLE_API_KEY")
     huggingface_hub_token: str = os.getenv("HUGGINGFACE_HUB_TOKEN")
+    # Token cho các route quản trị (header X-Admin-Token); để trống để tắt các route này
+    admin_token: str = os.getenv("ADMIN_TOKEN", "")
     
     def __post_init__(self):
         """Ensure paths exist and essential keys are loaded"""
@@ -77,10 +154,10 @@ class Config:
 
         # Ensure image index directory exists
         os.makedirs(os.path.dirname(self.image_index_path), exist_ok=True)
-        if not os.path.exists(self.image_index_path):
+        # Chỉ mục ảnh được lưu theo thế hệ, trỏ tới bởi <tên chỉ mục>.current.json (xem FaissIndexer)
+        image_index_pointer = os.path.splitext(self.image_index_path)[0] + ".current.json"
+        if not os.path.exists(image_index_pointer) and not os.path.exists(self.image_index_path):
             print(f"Warning: Image index not found at {self.image_index_path}")
-        if not os.path.exists(self.image_metadata_path):
-            print(f"Warning: Image metadata not found at {self.image_metadata_path}")
 
         # Ensure db path is absolute
         db_full_path = os.path.join(self.base_dir, self.db_path)
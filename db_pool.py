@@ -0,0 +1,296 @@
+import os
+import time
+import queue
+import hashlib
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+class _PooledConnection(sqlite3.Connection):
+    """``sqlite3.Connection`` không hỗ trợ weakref; lớp con Python thì có."""
+
+
+class _ConnectionQueue:
+    """Một nhóm kết nối SQLite cùng chế độ (đọc/ghi hoặc chỉ đọc), có giới hạn kích thước."""
+
+    def __init__(self, db_path: str, timeout: float, max_size: int, readonly: bool, cached_statements: int):
+        self.db_path = db_path
+        self.timeout = timeout
+        self.max_size = max(1, max_size)
+        self.readonly = readonly
+        self.cached_statements = cached_statements
+        # LIFO để ưu tiên dùng lại kết nối "nóng" vừa trả về
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.in_use = 0
+        self.errors = 0
+        # kết nối -> busy timeout (giây) đã đặt cho kết nối đó; khóa yếu để kết nối đã đóng
+        # và bị thu hồi tự rời khỏi bảng, không để id() được tái sử dụng trỏ nhầm
+        self._busy_timeouts: "weakref.WeakKeyDictionary[sqlite3.Connection, float]" = weakref.WeakKeyDictionary()
+
+    def _open(self) -> sqlite3.Connection:
+        if self.readonly:
+            conn = sqlite3.connect(
+                f"file:{self.db_path}?mode=ro", uri=True, timeout=self.timeout,
+                check_same_thread=False, cached_statements=self.cached_statements, factory=_PooledConnection
+            )
+            # Chặn mọi câu lệnh ghi, kể cả khi SQL do LLM sinh ra lọt qua bước kiểm tra
+            conn.execute("PRAGMA query_only = ON")
+        else:
+            conn = sqlite3.connect(
+                self.db_path, timeout=self.timeout,
+                check_same_thread=False, cached_statements=self.cached_statements, factory=_PooledConnection
+            )
+            conn.execute("PRAGMA journal_mode = WAL")
+        self._busy_timeouts[conn] = self.timeout
+        return conn
+
+    def set_timeout(self, timeout: float):
+        """Đổi timeout; kết nối đã mở nhận busy timeout mới ở lần được mượn kế tiếp."""
+        self.timeout = timeout
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if self.created < self.max_size:
+                    self.created += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._lock:
+                        self.created -= 1
+                    raise
+            else:
+                start = time.perf_counter()
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    # Cùng loại lỗi với "database is locked" để nơi gọi xử lý như lỗi SQLite thông thường
+                    raise sqlite3.OperationalError("connection pool exhausted") from None
+                finally:
+                    waited = time.perf_counter() - start
+                    with self._lock:
+                        self.waits += 1
+                        self.total_wait += waited
+                        self.max_wait = max(self.max_wait, waited)
+        if self._busy_timeouts.get(conn) != self.timeout:
+            conn.execute(f"PRAGMA busy_timeout = {int(self.timeout * 1000)}")
+            self._busy_timeouts[conn] = self.timeout
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+        return conn
+
+    def release(self, conn: sqlite3.Connection, broken: bool = False):
+        with self._lock:
+            self.in_use -= 1
+        if broken:
+            with self._lock:
+                self.errors += 1
+                self.created -= 1
+            self._busy_timeouts.pop(conn, None)
+            try:
+                conn.close()
+            except Exception:
+                pass
+            return
+        self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self.created -= 1
+            self._busy_timeouts.pop(conn, None)
+            conn.close()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "open": self.created,
+                "in_use": self.in_use,
+                "idle": self._idle.qsize(),
+                "max_size": self.max_size,
+                "checkouts": self.checkouts,
+                "reused": self.checkouts - self.created,
+                "waits": self.waits,
+                "avg_wait_ms": round(self.total_wait / self.waits * 1000, 3) if self.waits else 0.0,
+                "max_wait_ms": round(self.max_wait * 1000, 3),
+                "broken": self.errors,
+            }
+
+
+class SQLitePool:
+    """Pool kết nối SQLite dùng chung cho toàn ứng dụng.
+
+    Mỗi luồng/greenlet mượn một kết nối trong suốt khối ``with`` rồi trả lại pool,
+    thay vì mở/đóng kết nối cho mỗi lần gọi. Kết nối chỉ đọc được mở với
+    ``mode=ro`` và ``query_only``; kết nối ghi dùng WAL. sqlite3 tự cache
+    prepared statement theo từng kết nối (``cached_statements``), nên dùng lại
+    kết nối cũng là dùng lại các câu lệnh đã biên dịch.
+    """
+
+    def __init__(self, db_path: str, timeout: float = 30, max_size: int = 8, cached_statements: int = 256):
+        self.db_path = db_path
+        self.timeout = timeout
+        self._timeout_lock = threading.Lock()
+        self._readers = _ConnectionQueue(db_path, timeout, max_size, True, cached_statements)
+        self._writers = _ConnectionQueue(db_path, timeout, max(1, max_size // 4), False, cached_statements)
+        self.queries = 0
+
+    def ensure_timeout(self, timeout: float):
+        """Nâng timeout của pool lên ``timeout`` nếu lớn hơn (không bao giờ giảm)."""
+        with self._timeout_lock:
+            if timeout <= self.timeout:
+                return
+            self.timeout = timeout
+            self._readers.set_timeout(timeout)
+            self._writers.set_timeout(timeout)
+
+    @contextmanager
+    def connection(self, readonly: bool = True) -> Iterator[sqlite3.Connection]:
+        """Mượn một kết nối. Kết nối ghi được commit khi khối ``with`` kết thúc bình thường."""
+        pool = self._readers if readonly else self._writers
+        conn = pool.acquire()
+        broken = False
+        try:
+            yield conn
+            if not readonly:
+                conn.commit()
+        except BaseException as e:
+            # Kết nối lỗi ở tầng interface không được trả lại pool
+            broken = isinstance(e, (sqlite3.InterfaceError, sqlite3.InternalError))
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                broken = True
+            raise
+        finally:
+            pool.release(conn, broken=broken)
+
+    def fetchall(self, sql: str, params: Sequence[Any] = (), readonly: bool = True) -> List[tuple]:
+        with self.connection(readonly=readonly) as conn:
+            self.queries += 1
+            return conn.execute(sql, params).fetchall()
+
+    def fetchone(self, sql: str, params: Sequence[Any] = (), readonly: bool = True) -> Optional[tuple]:
+        with self.connection(readonly=readonly) as conn:
+            self.queries += 1
+            return conn.execute(sql, params).fetchone()
+
+    def execute_dicts(self, sql: str, params: Any = ()) -> List[Dict[str, Any]]:
+        """Chạy câu truy vấn chỉ đọc và trả về danh sách dict {tên cột: giá trị}."""
+        with self.connection(readonly=True) as conn:
+            self.queries += 1
+            cursor = conn.execute(sql, params)
+            columns = [description[0] for description in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def file_version(self) -> Tuple[int, ...]:
+        """mtime của file database và file WAL; đổi khi có bất kỳ lần ghi nào."""
+        version = []
+        for path in (self.db_path, self.db_path + "-wal"):
+            try:
+                version.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                version.append(0)
+        return tuple(version)
+
+    def tables_checksum(self, tables: Sequence[str]) -> str:
+        """Checksum nội dung của các bảng (dùng để phát hiện thay đổi dữ liệu)."""
+        digest = hashlib.sha1()
+        with self.connection(readonly=True) as conn:
+            for table in tables:
+                digest.update(table.encode("utf-8"))
+                for row in conn.execute(f'SELECT * FROM "{table}" ORDER BY rowid'):
+                    digest.update(repr(row).encode("utf-8"))
+        return digest.hexdigest()
+
+    def close(self):
+        self._readers.close_all()
+        self._writers.close_all()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "db_path": self.db_path,
+            "queries": self.queries,
+            "readonly": self._readers.metrics(),
+            "readwrite": self._writers.metrics(),
+        }
+
+
+class TableWatcher:
+    """Theo dõi thay đổi dữ liệu của một nhóm bảng để làm mất hiệu lực cache.
+
+    Mỗi lần kiểm tra chỉ ``os.stat`` file database; checksum các bảng chỉ được
+    tính lại khi file đã bị ghi, nên ghi vào bảng khác không làm cache mất hiệu lực.
+    """
+
+    def __init__(self, pool: SQLitePool, tables: Sequence[str]):
+        self.pool = pool
+        self.tables = list(tables)
+        self._file_version: Optional[Tuple[int, ...]] = None
+        self._checksum: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def version(self) -> str:
+        """Checksum hiện tại của các bảng được theo dõi."""
+        file_version = self.pool.file_version()
+        if file_version != self._file_version or self._checksum is None:
+            with self._lock:
+                if file_version != self._file_version or self._checksum is None:
+                    self._checksum = self.pool.tables_checksum(self.tables)
+                    self._file_version = file_version
+        return self._checksum
+
+
+_pools: Dict[str, SQLitePool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path: str, timeout: Optional[float] = None) -> SQLitePool:
+    """Trả về pool dùng chung cho file database (mỗi đường dẫn một pool).
+
+    Pool được tạo ở lần gọi đầu với ``timeout`` (None: 30 giây). Lần gọi sau với ``timeout``
+    lớn hơn sẽ nâng timeout của pool; timeout nhỏ hơn không làm giảm timeout nơi khác đã yêu cầu.
+    """
+    key = os.path.abspath(db_path)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = SQLitePool(key, timeout=30 if timeout is None else timeout,
+                                  max_size=int(os.getenv("DB_POOL_SIZE", 8)))
+                _pools[key] = pool
+                return pool
+    if timeout is not None:
+        pool.ensure_timeout(timeout)
+    return pool
+
+
+def default_db_path() -> str:
+    """Đường dẫn database mặc định (Database.db ở thư mục gốc dự án)."""
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), os.getenv("DB_PATH", "Database.db"))
+
+
+def pool_metrics() -> Dict[str, Any]:
+    return {path: pool.metrics() for path, pool in _pools.items()}
@@ -1,8 +1,12 @@
 import sqlite3
 import os
+import json
+import time
+import hashlib
 import argparse
 import numpy as np
 import logging
+from typing import Any, Dict, List, Tuple
 from tqdm import tqdm # Thư viện tạo thanh tiến trình
 
 import sys
@@ -10,24 +14,25 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.abspath(os.path.join(script_dir, '..'))  # Lùi lại 1 cấp để đến thư mục gốc
 sys.path.insert(0, project_root)  # Thêm vào đầu sys.path để ưu tiên
 
-from search_engine.faiss_indexer import FaissIndexer
-from search_engine.feature_extractor import ImageFeatureExtractor
+from search_engine.faiss_indexer import FaissIndexer, index_exists
+from search_engine.record_store import atomic_write
+from system.model_registry import model_registry, register_default_models, VIT
 from config import Config
+from db_pool import get_pool
 
 # Cấu hình logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Chiều vector dùng để mở chỉ mục khi manifest chưa ghi (chiều thật được đọc từ file chỉ mục)
+DEFAULT_FEATURE_DIM = 768
+
 def get_product_image_sources(db_path: str) -> list:
     """Truy vấn database để lấy danh sách (ID, Link_Image, Name_Product) từ bảng Product."""
     sources = []
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
         # Lấy ID, Link_Image và Name_Product, bỏ qua những hàng có Link_Image là NULL hoặc trống
-        cursor.execute("SELECT ID, Link_Image, Name_Product FROM Product WHERE Link_Image IS NOT NULL AND Link_Image != ''")
-        rows = cursor.fetchall()
-        conn.close()
+        rows = get_pool(db_path).fetchall("SELECT ID, Link_Image, Name_Product FROM Product WHERE Link_Image IS NOT NULL AND Link_Image != ''")
         sources = [(row[0], row[1], row[2]) for row in rows] # Lưu ID, Link và Name
         logger.info(f"Tìm thấy {len(sources)} sản phẩm có Link_Image trong database.")
     except sqlite3.Error as e:
@@ -36,110 +41,205 @@ def get_product_image_sources(db_path: str) -> list:
         logger.error(f"Lỗi không xác định khi lấy nguồn ảnh: {e}")
     return sources
 
-def main(config: Config):
-    """Hàm chính để xây dựng chỉ mục ảnh."""
-    logger.info("Bắt đầu quá trình xây dựng chỉ mục ảnh...")
-
-    # 1. Lấy nguồn ảnh từ database
-    image_sources_with_ids = get_product_image_sources(config.db_path)
-    if not image_sources_with_ids:
-        logger.warning("Không tìm thấy nguồn ảnh nào từ database. Kết thúc.")
-        return
-
-    # Tách ID, URL/Path và Name
-    product_ids = [item[0] for item in image_sources_with_ids]
-    image_sources = [item[1] for item in image_sources_with_ids]
-    product_names = [item[2] for item in image_sources_with_ids]
-
-    # 2. Khởi tạo Trình trích xuất Đặc trưng
+def manifest_path(index_path: str) -> str:
+    """Manifest (ID sản phẩm -> nguồn ảnh, hash nội dung, tên) nằm cạnh file chỉ mục."""
+    return os.path.splitext(index_path)[0] + ".manifest.json"
+
+def content_hash(source: str) -> str:
+    """SHA-1 nội dung file ảnh local; với URL là SHA-1 của chính URL (ảnh mới thì URL mới)."""
+    digest = hashlib.sha1()
+    if not source.startswith(('http://', 'https://')) and os.path.isfile(source):
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    else:
+        digest.update(source.encode('utf-8'))
+    return digest.hexdigest()
+
+def load_manifest(path: str) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {"items": {}}
     try:
-        feature_extractor = ImageFeatureExtractor() # Tự động phát hiện device
-        feature_dim = feature_extractor.feature_dim
-    except Exception as e:
-        logger.error(f"Không thể khởi tạo ImageFeatureExtractor: {e}")
-        return
-
-    # 3. Trích xuất đặc trưng theo batch
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Không đọc được manifest {path} ({e}), coi như chưa có.")
+        return {"items": {}}
+
+def save_manifest(path: str, items: Dict[str, Dict[str, Any]], indexer: FaissIndexer):
+    manifest = {
+        "dimension": indexer.dimension,
+        "ntotal": indexer.get_index_size(),
+        "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "items": items,
+    }
+
+    def writer(tmp_path: str):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    atomic_write(path, writer)
+    logger.info(f"Đã lưu manifest ({len(items)} sản phẩm) tại: {path}")
+
+def make_metadata(product_id: int, product_name: str, source: str) -> Dict[str, Any]:
+    return {
+        'product_id': product_id, # Lưu ID sản phẩm
+        'product_name': product_name, # Lưu tên sản phẩm
+        'image_source': source
+    }
+
+def extract_features(config: Config, products: List[Tuple[int, str, str]]) -> Tuple[np.ndarray, List[Dict[str, Any]], List[int]]:
+    """Trích xuất vector cho các sản phẩm (ID, Link_Image, Name_Product).
+
+    Mỗi nguồn ảnh chỉ được tải và trích xuất một lần dù nhiều sản phẩm dùng chung. Trả về
+    (vector, metadata, ID sản phẩm) của các sản phẩm có ảnh trích xuất thành công.
+    """
+    image_sources = list(dict.fromkeys(source for _, source, _ in products))
+
+    register_default_models(config)
+    feature_extractor = model_registry.get(VIT) # Tự động phát hiện device
     try:
+        feature_dim = feature_extractor.feature_dim
         # Sử dụng batch_size lớn hơn nếu có GPU mạnh
-        batch_size = config.image_batch_size # Lấy từ config
-
-        all_features_list, successful_sources = feature_extractor.extract_features_batch(image_sources, batch_size=batch_size)
+        all_features_list, successful_sources = feature_extractor.extract_features_batch(image_sources, batch_size=config.image_batch_size)
+    finally:
+        # Giải phóng bộ nhớ của model sau khi trích xuất xong
+        del feature_extractor
+        model_registry.release(VIT)
+
+    features_by_source = dict(zip(successful_sources, all_features_list))
+    vectors, metadata_list, ids = [], [], []
+    for product_id, source, product_name in products:
+        features = features_by_source.get(source)
+        if features is None:
+            continue
+        vectors.append(features)
+        metadata_list.append(make_metadata(product_id, product_name, source))
+        ids.append(product_id)
+
+    logger.info(f"Trích xuất thành công {len(vectors)}/{len(products)} sản phẩm từ {len(features_by_source)} ảnh.")
+    return np.array(vectors, dtype=np.float32).reshape(-1, feature_dim), metadata_list, ids
+
+def build_full(config: Config, products: List[Tuple[int, str, str]], hashes: Dict[int, str]):
+    """Trích xuất lại mọi ảnh và xây dựng chỉ mục mới theo ID sản phẩm (ghi đè nếu đã tồn tại)."""
+    vectors, metadata_list, ids = extract_features(config, products)
+    if not ids:
+        logger.warning("Không trích xuất được vector đặc trưng nào. Kết thúc.")
+        return
 
-        if not all_features_list:
-            logger.warning("Không trích xuất được vector đặc trưng nào. Kết thúc.")
+    # Tạo thư mục chứa nếu chưa có
+    os.makedirs(os.path.dirname(config.image_index_path), exist_ok=True)
+    os.makedirs(os.path.dirname(config.image_metadata_path), exist_ok=True)
+
+    faiss_indexer = FaissIndexer.from_config(
+        config,
+        index_path=config.image_index_path,
+        metadata_path=config.image_metadata_path,
+        dimension=vectors.shape[1]
+    )
+    faiss_indexer.build_index(vectors=vectors, metadata=metadata_list, ids=ids)
+    save_manifest(manifest_path(config.image_index_path),
+                  {str(meta['product_id']): {"source": meta['image_source'], "hash": hashes[meta['product_id']],
+                                             "name": meta['product_name']} for meta in metadata_list},
+                  faiss_indexer)
+    logger.info(f"Đã xây dựng và lưu chỉ mục FAISS tại: {config.image_index_path}")
+
+def sync_index(config: Config, faiss_indexer: FaissIndexer, products: List[Tuple[int, str, str]],
+               hashes: Dict[int, str], manifest: Dict[str, Any]):
+    """Đồng bộ chỉ mục với bảng Product: chỉ trích xuất ảnh của sản phẩm mới hoặc đổi ảnh,
+    xóa vector của sản phẩm đã bị xóa, cập nhật metadata của sản phẩm chỉ đổi tên.
+
+    Sự có mặt của một sản phẩm được lấy từ chính chỉ mục; manifest chỉ dùng để so sánh nguồn
+    ảnh và hash, nên manifest cũ hơn chỉ mục (ví dụ bị ngắt giữa chừng) chỉ gây trích xuất thừa.
+    """
+    faiss_indexer.to_keyed()
+    entries = manifest.get("items", {})
+    products_by_id = {product_id: (source, name) for product_id, source, name in products}
+
+    removed = [int(i) for i in faiss_indexer.ids if int(i) not in products_by_id]
+    to_embed, renamed = [], {}
+    for product_id, (source, name) in products_by_id.items():
+        meta = faiss_indexer.get_metadata(product_id)
+        if meta is None:
+            to_embed.append(product_id)
+            continue
+        # Chỉ mục dựng trước khi có manifest: tin vector đã có nếu nguồn ảnh không đổi
+        entry = entries.get(str(product_id)) or {"source": meta.get('image_source'), "hash": hashes[product_id]}
+        if entry.get("source") != source or entry.get("hash") != hashes[product_id]:
+            to_embed.append(product_id)
+        elif meta.get('product_name') != name:
+            renamed[product_id] = make_metadata(product_id, name, source)
+
+    logger.info(f"Đồng bộ chỉ mục ảnh: {len(to_embed)} cần trích xuất, {len(removed)} cần xóa, "
+                f"{len(renamed)} đổi tên, {len(products_by_id) - len(to_embed) - len(renamed)} không đổi.")
+
+    vectors, metadata_list, ids = np.zeros((0, faiss_indexer.dimension), dtype=np.float32), [], []
+    if to_embed:
+        vectors, metadata_list, ids = extract_features(config, [(pid, *products_by_id[pid]) for pid in to_embed])
+        if ids and vectors.shape[1] != faiss_indexer.dimension:
+            logger.error(f"Chiều vector mới ({vectors.shape[1]}) khác chiều chỉ mục ({faiss_indexer.dimension}). Chạy lại với --full.")
             return
+        failed = set(to_embed) - set(ids)
+        if failed:
+            # Sản phẩm đổi ảnh nhưng trích xuất lỗi giữ vector cũ; lần đồng bộ sau thử lại
+            logger.warning(f"{len(failed)} sản phẩm trích xuất ảnh lỗi: {sorted(failed)[:20]}")
+
+    if ids or removed or renamed:
+        faiss_indexer.update_items(vectors, metadata_list, ids, removed_ids=removed, updated_metadata=renamed)
+
+    # Manifest ghi sau chỉ mục; sản phẩm trích xuất lỗi giữ mục cũ (hoặc hash rỗng) để lần sau thử lại
+    embedded = set(ids)
+    items = {}
+    for product_id in (int(i) for i in faiss_indexer.ids):
+        source, name = products_by_id[product_id]
+        if product_id in embedded or product_id not in to_embed:
+            items[str(product_id)] = {"source": source, "hash": hashes[product_id], "name": name}
+        else:
+            items[str(product_id)] = entries.get(str(product_id)) or {"source": source, "hash": None, "name": name}
+    save_manifest(manifest_path(config.image_index_path), items, faiss_indexer)
+
+def main(config: Config, full: bool = False):
+    """Xây dựng chỉ mục ảnh lần đầu (hoặc khi ``full``), các lần sau chỉ đồng bộ phần thay đổi."""
+    start = time.perf_counter()
+    logger.info("Bắt đầu quá trình xây dựng chỉ mục ảnh...")
 
-        # Chuyển list các array thành một NumPy array lớn
-        all_features_np = np.array(all_features_list).astype(np.float32)
-
-        # Tạo metadata tương ứng với các vector đã trích xuất thành công
-        # Tìm ID và tên sản phẩm cho các nguồn ảnh thành công
-        source_to_info_map = {source: (pid, pname) for pid, source, pname in image_sources_with_ids}
-        metadata_list = []
-        valid_indices = [] # Lưu index của các vector hợp lệ trong mảng all_features_np
-        for i, source in enumerate(successful_sources):
-            product_info = source_to_info_map.get(source)
-            if product_info is not None:
-                product_id, product_name = product_info
-                metadata_list.append({
-                    'product_id': product_id, # Lưu ID sản phẩm
-                    'product_name': product_name, # Lưu tên sản phẩm
-                    'image_source': source
-                })
-                valid_indices.append(i)
-            else:
-                 logger.warning(f"Không tìm thấy product_id cho nguồn ảnh thành công: {source}")
-
-        # Chỉ giữ lại các vector đặc trưng tương ứng với metadata hợp lệ
-        if len(valid_indices) != all_features_np.shape[0]:
-             logger.info(f"Lọc bỏ {all_features_np.shape[0] - len(valid_indices)} vector không có ID sản phẩm tương ứng.")
-             all_features_np = all_features_np[valid_indices]
-
-        if not metadata_list:
-             logger.warning("Không có metadata hợp lệ nào được tạo. Kết thúc.")
-             return
-
-        logger.info(f"Trích xuất thành công {all_features_np.shape[0]} vector đặc trưng.")
-
-    except Exception as e:
-        logger.error(f"Lỗi trong quá trình trích xuất đặc trưng: {e}")
-        # Cân nhắc giải phóng bộ nhớ nếu lỗi xảy ra ở đây
-        if 'feature_extractor' in locals():
-            del feature_extractor
+    # 1. Lấy nguồn ảnh từ database
+    products = get_product_image_sources(config.db_path)
+    if not products:
+        logger.warning("Không tìm thấy nguồn ảnh nào từ database. Kết thúc.")
         return
-    finally:
-         # Giải phóng bộ nhớ của model sau khi trích xuất xong
-        if 'feature_extractor' in locals():
-            del feature_extractor
-
-    # 4. Khởi tạo và Xây dựng Chỉ mục FAISS
-    try:
-        # Lấy đường dẫn từ config
-        index_path = config.image_index_path
-        metadata_path = config.image_metadata_path
-
-        # Tạo thư mục chứa nếu chưa có
-        os.makedirs(os.path.dirname(index_path), exist_ok=True)
-        os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
+    # Mỗi ID một ảnh (hàng sau cùng thắng nếu truy vấn trả trùng ID)
+    products = list({product_id: (product_id, source, name) for product_id, source, name in products}.values())
 
-        faiss_indexer = FaissIndexer(
-            index_path=index_path,
-            metadata_path=metadata_path,
-            dimension=feature_dim
-        )
+    # 2. Hash nội dung ảnh để phát hiện ảnh thay đổi
+    hashes = {product_id: content_hash(source) for product_id, source, _ in tqdm(products, desc="Hash ảnh", disable=len(products) < 1000)}
 
-        # Xây dựng chỉ mục mới (ghi đè nếu đã tồn tại)
-        faiss_indexer.build_index(vectors=all_features_np, metadata=metadata_list)
-
-        logger.info(f"Đã xây dựng và lưu chỉ mục FAISS tại: {index_path}")
-        logger.info(f"Đã lưu metadata tại: {metadata_path}")
+    try:
+        manifest = load_manifest(manifest_path(config.image_index_path))
+        faiss_indexer = None
+        if not full and index_exists(config.image_index_path):
+            faiss_indexer = FaissIndexer.from_config(
+                config,
+                index_path=config.image_index_path,
+                metadata_path=config.image_metadata_path,
+                dimension=manifest.get("dimension", DEFAULT_FEATURE_DIM)
+            )
+
+        # 3. Trích xuất đặc trưng và cập nhật chỉ mục FAISS
+        if faiss_indexer is None or faiss_indexer.get_index_size() == 0:
+            build_full(config, products, hashes)
+        else:
+            sync_index(config, faiss_indexer, products, hashes, manifest)
 
     except Exception as e:
-        logger.error(f"Lỗi trong quá trình xây dựng hoặc lưu chỉ mục FAISS: {e}")
+        logger.error(f"Lỗi trong quá trình xây dựng hoặc cập nhật chỉ mục FAISS: {e}")
+        return
 
-    logger.info("Hoàn tất quá trình xây dựng chỉ mục ảnh.")
+    logger.info(f"Hoàn tất quá trình xây dựng chỉ mục ảnh trong {time.perf_counter() - start:.1f}s.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Xây dựng hoặc đồng bộ chỉ mục ảnh sản phẩm")
+    parser.add_argument("--full", action="store_true", help="Trích xuất lại mọi ảnh và xây dựng lại chỉ mục từ đầu")
+    args = parser.parse_args()
     config = Config()
-    main(config)
+    main(config, full=args.full)
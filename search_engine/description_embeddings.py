@@ -0,0 +1,93 @@
+import os
+import logging
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+# Cấu hình logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+FILE_NAME = "description_embeddings.npz"
+
+
+def _l2_normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / (norms + 1e-8)
+
+
+class DescriptionEmbeddings:
+    """Ma trận embedding mô tả sản phẩm (đã chuẩn hóa L2), tra cứu theo product ID.
+
+    Được lưu cạnh description vector store (``description_embeddings.npz``) để MBR
+    không phải chạy lại PhoBERT cho các mô tả sản phẩm vốn không đổi.
+    """
+
+    def __init__(self, product_ids: Sequence[Any], vectors: np.ndarray):
+        if len(product_ids) != vectors.shape[0]:
+            raise ValueError(f"Số product ID ({len(product_ids)}) không khớp với số vector ({vectors.shape[0]}).")
+        self.product_ids = list(product_ids)
+        self.vectors = _l2_normalize(np.asarray(vectors, dtype=np.float32))
+        self._row_of: Dict[Any, int] = {pid: i for i, pid in enumerate(self.product_ids)}
+
+    def __len__(self) -> int:
+        return len(self.product_ids)
+
+    def __contains__(self, product_id: Any) -> bool:
+        return product_id in self._row_of
+
+    def get(self, product_ids: Sequence[Any]) -> np.ndarray:
+        """Trả về ma trận (len(product_ids), dim); hàng của ID không có trong ma trận là vector 0."""
+        result = np.zeros((len(product_ids), self.vectors.shape[1]), dtype=np.float32)
+        for i, pid in enumerate(product_ids):
+            row = self._row_of.get(pid)
+            if row is not None:
+                result[i] = self.vectors[row]
+        return result
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path, product_ids=np.asarray(self.product_ids), vectors=self.vectors)
+        logger.info(f"Đã lưu {len(self)} embedding mô tả sản phẩm vào: {path}")
+
+    @classmethod
+    def load(cls, path: str) -> "DescriptionEmbeddings":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["product_ids"].tolist(), data["vectors"])
+
+    @classmethod
+    def from_vector_store(cls, vector_store) -> "DescriptionEmbeddings":
+        """Lấy lại vector đã lưu trong description FAISS store (không chạy lại model)."""
+        product_ids: List[Any] = []
+        rows: List[int] = []
+        for position, docstore_id in vector_store.index_to_docstore_id.items():
+            doc = vector_store.docstore.search(docstore_id)
+            product_id = getattr(doc, "metadata", {}).get("ID")
+            if product_id is not None:
+                product_ids.append(product_id)
+                rows.append(position)
+        vectors = np.vstack([vector_store.index.reconstruct(int(i)) for i in rows]) if rows \
+            else np.zeros((0, vector_store.index.d), dtype=np.float32)
+        return cls(product_ids, vectors)
+
+    @classmethod
+    def load_or_build(cls, store_path: str, vector_store) -> Optional["DescriptionEmbeddings"]:
+        """Tải ma trận đã lưu; dựng lại từ vector store nếu chưa có hoặc không khớp số lượng."""
+        if vector_store is None:
+            return None
+        path = os.path.join(store_path, FILE_NAME)
+        if os.path.exists(path):
+            try:
+                matrix = cls.load(path)
+                if len(matrix) == vector_store.index.ntotal:
+                    return matrix
+                logger.warning(f"Ma trận embedding mô tả ({len(matrix)}) không khớp vector store ({vector_store.index.ntotal}), dựng lại.")
+            except Exception as e:
+                logger.error(f"Lỗi khi tải embedding mô tả từ {path}: {e}")
+        try:
+            matrix = cls.from_vector_store(vector_store)
+            matrix.save(path)
+            return matrix
+        except Exception as e:
+            logger.error(f"Không thể dựng ma trận embedding mô tả: {e}")
+            return None
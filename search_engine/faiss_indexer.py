@@ -1,79 +1,435 @@
 import faiss
 import numpy as np
 import pickle
+import json
+import math
 import os
+import time
+import uuid
+import shutil
 import logging
-from typing import List, Tuple, Dict, Any, Optional
+from typing import List, Tuple, Dict, Any, Iterable, Optional, Sequence
+
+from search_engine.record_store import RecordFile, atomic_write, write_records
 
 # Cấu hình logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Các loại chỉ mục hỗ trợ: flat (chính xác), IVF-Flat, IVF-PQ và HNSW (xấp xỉ)
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+# l2: khoảng cách L2 (nhỏ hơn là gần hơn); ip: tích vô hướng trên vector đã chuẩn hóa = cosine trong [-1, 1]
+METRICS = ("l2", "ip")
+_FAISS_METRICS = {"l2": faiss.METRIC_L2, "ip": faiss.METRIC_INNER_PRODUCT}
+# FAISS cần khoảng 39 vector huấn luyện cho mỗi centroid
+_MIN_POINTS_PER_CENTROID = 39
+# Số thế hệ chỉ mục giữ lại trên đĩa (thế hệ hiện tại và thế hệ trước cho worker chưa tải lại)
+KEEP_GENERATIONS = 2
+
+
+def default_nlist(n: int) -> int:
+    """Số cụm IVF mặc định: ~4·sqrt(n), đủ điểm huấn luyện cho mỗi cụm."""
+    return max(1, min(int(4 * math.sqrt(n)), n // _MIN_POINTS_PER_CENTROID))
+
+
+def _pq_subquantizers(dimension: int, pq_m: int) -> int:
+    """Số sub-quantizer lớn nhất <= ``pq_m`` chia hết ``dimension``."""
+    for m in range(max(1, min(pq_m, dimension)), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def create_index(index_type: str, dimension: int, vectors: Optional[np.ndarray] = None,
+                 nlist: int = 0, pq_m: int = 16, pq_nbits: int = 8,
+                 hnsw_m: int = 32, ef_construction: int = 40, metric: str = "l2",
+                 keyed: bool = False) -> Tuple[faiss.Index, Dict[str, Any]]:
+    """Tạo chỉ mục rỗng (đã huấn luyện trên ``vectors`` nếu là IVF) theo ``index_type`` và ``metric``.
+
+    Trả về ``(index, params)``; ``params`` ghi loại chỉ mục thực tế và tham số đã dùng.
+    Khi không đủ vector để huấn luyện IVF/PQ, chỉ mục lùi về ``flat``.
+    Với ``keyed``, vector được thêm bằng ``add_with_ids`` theo ID sản phẩm và xóa được bằng
+    ``remove_ids``: flat/HNSW được bọc trong IndexIDMap2, IVF dùng ID riêng của nó (kèm direct
+    map dạng hashtable để ``reconstruct`` theo ID).
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Loại chỉ mục không hợp lệ: {index_type} (hỗ trợ: {', '.join(INDEX_TYPES)})")
+    if metric not in METRICS:
+        raise ValueError(f"Metric không hợp lệ: {metric} (hỗ trợ: {', '.join(METRICS)})")
+    faiss_metric = _FAISS_METRICS[metric]
+
+    n = 0 if vectors is None else vectors.shape[0]
+    if index_type in ("ivf_flat", "ivf_pq"):
+        nlist = nlist or default_nlist(n)
+        min_points = nlist * _MIN_POINTS_PER_CENTROID
+        if index_type == "ivf_pq":
+            min_points = max(min_points, (1 << pq_nbits) * _MIN_POINTS_PER_CENTROID)
+        if n < min_points:
+            logger.warning(f"Chỉ có {n} vector, không đủ huấn luyện {index_type} (cần {min_points}). Dùng chỉ mục flat.")
+            index_type = "flat"
+
+    params: Dict[str, Any] = {"index_type": index_type, "metric": metric, "dimension": dimension}
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(dimension) if metric == "ip" else faiss.IndexFlatL2(dimension)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, hnsw_m, faiss_metric)
+        index.hnsw.efConstruction = ef_construction
+        params.update(hnsw_m=hnsw_m, ef_construction=ef_construction)
+    else:
+        quantizer = faiss.IndexFlatIP(dimension) if metric == "ip" else faiss.IndexFlatL2(dimension)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss_metric)
+        else:
+            pq_m = _pq_subquantizers(dimension, pq_m)
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, pq_nbits, faiss_metric)
+            params.update(pq_m=pq_m, pq_nbits=pq_nbits)
+        logger.info(f"Huấn luyện {index_type} với {nlist} cụm trên {n} vector...")
+        start = time.perf_counter()
+        index.train(np.ascontiguousarray(vectors, dtype=np.float32))
+        params.update(nlist=nlist, train_s=round(time.perf_counter() - start, 3))
+
+    if keyed:
+        if isinstance(index, faiss.IndexIVF):
+            index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        else:
+            index = faiss.IndexIDMap2(index)
+        params["keyed"] = True
+    return index, params
+
+
+def _base_index(index: faiss.Index) -> faiss.Index:
+    """Chỉ mục bên trong của IndexIDMap/IndexIDMap2, hoặc chính ``index``."""
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def describe_index(index: faiss.Index) -> str:
+    """Loại chỉ mục (theo INDEX_TYPES) của một chỉ mục đã tải từ file."""
+    index = _base_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+def index_metric(index: faiss.Index) -> str:
+    """Metric (theo METRICS) của một chỉ mục đã tải từ file."""
+    return "ip" if index.metric_type == faiss.METRIC_INNER_PRODUCT else "l2"
+
+
+def reconstruct_vectors(index: faiss.Index, ids: Optional[Iterable[int]] = None) -> np.ndarray:
+    """Lấy lại vector đã lưu trong chỉ mục (xấp xỉ với IVF-PQ): theo vị trí, hoặc theo ``ids`` nếu chỉ mục có ID."""
+    if ids is not None:
+        ids = [int(i) for i in ids]
+        if not ids:
+            return np.zeros((0, index.d), dtype=np.float32)
+        return np.ascontiguousarray(np.vstack([index.reconstruct(i) for i in ids]), dtype=np.float32)
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    # IndexIDMap lưu vector theo thứ tự id_map trong chỉ mục bên trong
+    index = _base_index(index)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return np.ascontiguousarray(index.reconstruct_n(0, index.ntotal), dtype=np.float32)
+
+
+def read_index(path: str, mmap: bool = False) -> Tuple[faiss.Index, bool]:
+    """Đọc chỉ mục FAISS; với ``mmap`` thì map file vào bộ nhớ (IO_FLAG_MMAP), lỗi thì đọc toàn bộ.
+
+    Trả về ``(index, mmapped)``. Chỉ mục mmap là chỉ đọc: không được ``add``/``remove`` trên nó.
+    """
+    if mmap:
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP), True
+        except Exception as e:
+            logger.warning(f"Không mmap được chỉ mục {path} ({e}), đọc toàn bộ vào bộ nhớ.")
+    return faiss.read_index(path), False
+
+
+def current_path(index_path: str) -> str:
+    """File con trỏ tới thế hệ chỉ mục hiện tại, nằm cạnh ``index_path``."""
+    return os.path.splitext(index_path)[0] + ".current.json"
+
+
+def generations_dir(index_path: str) -> str:
+    """Thư mục chứa các thế hệ chỉ mục (mỗi thế hệ một thư mục con)."""
+    return os.path.splitext(index_path)[0] + ".generations"
+
+
+def index_exists(index_path: str) -> bool:
+    """True nếu đã có chỉ mục: con trỏ thế hệ hoặc file chỉ mục cũ (trước khi lưu theo thế hệ)."""
+    return os.path.exists(current_path(index_path)) or os.path.exists(index_path)
+
+
+def set_search_params(index: faiss.Index, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """Đặt ``nprobe`` (IVF) hoặc ``efSearch`` (HNSW); không ảnh hưởng chỉ mục flat."""
+    index = _base_index(index)
+    if isinstance(index, faiss.IndexIVF) and nprobe:
+        index.nprobe = min(nprobe, index.nlist)
+    elif isinstance(index, faiss.IndexHNSW) and ef_search:
+        index.hnsw.efSearch = ef_search
+
 class FaissIndexer:
     """Quản lý việc xây dựng, lưu trữ và tìm kiếm chỉ mục FAISS cho vector đặc trưng ảnh."""
 
-    def __init__(self, index_path: str, metadata_path: str, dimension: int):
+    def __init__(self, index_path: str, metadata_path: str, dimension: int,
+                 index_type: str = "flat", nlist: int = 0, pq_m: int = 16, pq_nbits: int = 8,
+                 hnsw_m: int = 32, ef_construction: int = 40, nprobe: int = 8, ef_search: int = 64,
+                 metric: str = "l2", mmap: bool = False):
         """
         Khởi tạo FaissIndexer.
 
         Args:
             index_path (str): Đường dẫn để lưu/tải file chỉ mục FAISS (.index).
-            metadata_path (str): Đường dẫn để lưu/tải file metadata (.pkl).
+            metadata_path (str): Đường dẫn metadata; được lưu ở dạng file bản ghi ``<tên>.records``
+                (file .pkl cũ được chuyển đổi khi tải).
             dimension (int): Số chiều của vector đặc trưng (ví dụ: 768 cho ViT-B/16).
+            index_type (str): Loại chỉ mục khi build: flat, ivf_flat, ivf_pq hoặc hnsw.
+            nlist, pq_m, pq_nbits, hnsw_m, ef_construction: Tham số khi build (nlist=0: tự chọn).
+            nprobe, ef_search: Tham số khi tìm kiếm cho IVF / HNSW.
+            metric (str): "l2" trả về khoảng cách, "ip" trả về độ tương đồng cosine trong [-1, 1]
+                (vector được chuẩn hóa L2 khi thêm và khi tìm). Chỉ mục đã lưu với metric khác
+                được chuyển đổi khi tải.
+            mmap (bool): Map file chỉ mục và metadata vào bộ nhớ thay vì đọc toàn bộ; các worker
+                dùng chung page cache. Chỉ mục được đọc lại vào bộ nhớ trước khi sửa.
+
+        Mỗi lần lưu ghi chỉ mục, metadata, ID và info vào một thư mục thế hệ mới trong
+        ``<tên chỉ mục>.generations`` rồi mới thay file con trỏ ``<tên chỉ mục>.current.json``,
+        nên worker khác luôn tải được một bộ file khớp nhau. Khi chưa có con trỏ, các file cũ
+        cạnh ``index_path`` được tải như trước.
+
+        Chỉ mục build với ``ids`` (ID sản phẩm) là chỉ mục theo ID: ``search`` tra metadata theo ID,
+        ``update_items`` thay/xóa từng sản phẩm. ID được lưu theo thứ tự metadata trong
+        ``<tên metadata>.ids.npy``. Chỉ mục cũ (theo vị trí) được chuyển bằng ``to_keyed``.
         """
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Loại chỉ mục không hợp lệ: {index_type} (hỗ trợ: {', '.join(INDEX_TYPES)})")
+        if metric not in METRICS:
+            raise ValueError(f"Metric không hợp lệ: {metric} (hỗ trợ: {', '.join(METRICS)})")
         self.index_path = index_path
         self.metadata_path = metadata_path
+        self.info_path = os.path.splitext(index_path)[0] + ".info.json"
+        self.records_path = os.path.splitext(metadata_path)[0] + ".records"
+        self.ids_path = os.path.splitext(metadata_path)[0] + ".ids.npy"
+        self.current_path = current_path(index_path)
+        self.generations_dir = generations_dir(index_path)
+        self.generation: Optional[str] = None  # thế hệ đang tải, None nếu dùng file cũ
+        self.mmap = mmap
+        self.mmapped = False
         self.dimension = dimension
+        self.index_type = index_type
+        self.metric = metric
+        self.build_params = {"nlist": nlist, "pq_m": pq_m, "pq_nbits": pq_nbits,
+                             "hnsw_m": hnsw_m, "ef_construction": ef_construction}
+        self.nprobe = nprobe
+        self.ef_search = ef_search
         self.index: Optional[faiss.Index] = None
-        self.metadata: List[Dict[str, Any]] = []  # Metadata sẽ là list các dict
+        self.index_info: Dict[str, Any] = {}
+        self.metadata: Sequence[Dict[str, Any]] = []  # list các dict, hoặc RecordFile khi tải từ file
+        self.ids: Optional[np.ndarray] = None  # ID của metadata[i] (chỉ mục theo ID), None nếu theo vị trí
+        self._positions: Dict[int, int] = {}  # ID -> vị trí trong metadata
 
         # Tải chỉ mục và metadata nếu tồn tại
         self.load_index()
 
-    def build_index(self, vectors: np.ndarray, metadata: List[Dict[str, Any]]):
+    @classmethod
+    def from_config(cls, config, index_path: str, metadata_path: str, dimension: int) -> "FaissIndexer":
+        """FaissIndexer với loại chỉ mục và tham số IMAGE_INDEX_* trong cấu hình."""
+        return cls(
+            index_path=index_path,
+            metadata_path=metadata_path,
+            dimension=dimension,
+            index_type=config.image_index_type,
+            nlist=config.image_index_nlist,
+            pq_m=config.image_index_pq_m,
+            pq_nbits=config.image_index_pq_nbits,
+            hnsw_m=config.image_index_hnsw_m,
+            ef_construction=config.image_index_ef_construction,
+            nprobe=config.image_index_nprobe,
+            ef_search=config.image_index_ef_search,
+            metric=config.image_index_metric,
+            mmap=config.index_mmap,
+        )
+
+    @property
+    def keyed(self) -> bool:
+        """True nếu chỉ mục lưu vector theo ID sản phẩm (``add_with_ids``/``remove_ids``)."""
+        return self.ids is not None
+
+    def _set_ids(self, ids: Optional[np.ndarray]):
+        self.ids = ids
+        self._positions = {} if ids is None else {int(key): position for position, key in enumerate(ids)}
+
+    def get_metadata(self, item_id: int) -> Optional[Dict[str, Any]]:
+        """Metadata của ID sản phẩm ``item_id`` trong chỉ mục theo ID (None nếu không có)."""
+        position = self._positions.get(int(item_id))
+        return None if position is None else self.metadata[position]
+
+    @property
+    def higher_is_better(self) -> bool:
+        """True nếu điểm trả về là độ tương đồng (metric ip), False nếu là khoảng cách (l2)."""
+        return self.metric == "ip"
+
+    def _prepare_vectors(self, vectors: np.ndarray) -> np.ndarray:
+        """float32 liên tục; với metric ip thì chuẩn hóa L2 (trên bản sao) để tích vô hướng là cosine."""
+        vectors = np.array(vectors, dtype=np.float32, order="C")
+        if self.metric == "ip":
+            faiss.normalize_L2(vectors)
+        return vectors
+
+    def set_search_params(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+        """Đổi ``nprobe``/``efSearch`` của chỉ mục đang dùng (đánh đổi recall và độ trễ)."""
+        if nprobe is not None:
+            self.nprobe = nprobe
+        if ef_search is not None:
+            self.ef_search = ef_search
+        if self.index is not None:
+            set_search_params(self.index, self.nprobe, self.ef_search)
+
+    def build_index(self, vectors: np.ndarray, metadata: List[Dict[str, Any]], ids: Optional[Sequence[int]] = None):
   
         if vectors.shape[0] != len(metadata):
             raise ValueError(f"Số lượng vector ({vectors.shape[0]}) không khớp với số lượng metadata ({len(metadata)}).")
         if vectors.shape[1] != self.dimension:
             raise ValueError(f"Chiều của vector ({vectors.shape[1]}) không khớp với chiều đã khai báo ({self.dimension}).")
+        if ids is not None:
+            ids = self._check_ids(ids, len(metadata))
 
         logger.info(f"Bắt đầu xây dựng chỉ mục FAISS mới với {vectors.shape[0]} vector...")
 
-        # Sử dụng IndexFlatL2 vì chúng ta đã chuẩn hóa L2 các vector
-        self.index = faiss.IndexFlatL2(self.dimension)
-
         if vectors.dtype != np.float32:
             logger.warning(f"Chuyển đổi kiểu dữ liệu vector từ {vectors.dtype} sang float32.")
-            vectors = vectors.astype(np.float32)
+        vectors = self._prepare_vectors(vectors)
 
-        self.index.add(vectors)
+        # Chỉ mục IVF được huấn luyện trên chính các vector vừa trích xuất
+        self.index, params = create_index(self.index_type, self.dimension, vectors, metric=self.metric,
+                                          keyed=ids is not None, **self.build_params)
+        set_search_params(self.index, self.nprobe, self.ef_search)
+
+        if ids is not None:
+            self.index.add_with_ids(vectors, ids)
+        else:
+            self.index.add(vectors)
+        self.mmapped = False
         self.metadata = metadata
+        self._set_ids(ids)
+        self.index_info = dict(params, built_at=time.strftime("%Y-%m-%dT%H:%M:%S"))
 
         logger.info(f"Xây dựng chỉ mục hoàn tất. Tổng số vector trong chỉ mục: {self.index.ntotal}")
         self.save_index()
 
     def add_items(self, vectors: np.ndarray, metadata: List[Dict[str, Any]]):
       
-        if self.index is None:
+        if self.index is None or self.index.ntotal == 0:
             logger.warning("Chỉ mục chưa được khởi tạo. Gọi build_index trước.")
             self.build_index(vectors, metadata)
             return
+        if self.keyed:
+            raise ValueError("Chỉ mục theo ID: dùng update_items để thêm vector.")
 
         if vectors.shape[0] != len(metadata):
             raise ValueError("Số lượng vector không khớp với số lượng metadata.")
         if vectors.shape[1] != self.dimension:
             raise ValueError(f"Chiều của vector ({vectors.shape[1]}) không khớp với chiều của chỉ mục ({self.dimension}).")
 
-        if vectors.dtype != np.float32:
-            vectors = vectors.astype(np.float32)
+        vectors = self._prepare_vectors(vectors)
+        self._ensure_writable()
 
         logger.info(f"Thêm {vectors.shape[0]} vector mới vào chỉ mục...")
         self.index.add(vectors)
-        self.metadata.extend(metadata)
+        self.metadata = list(self.metadata) + list(metadata)
         logger.info(f"Thêm hoàn tất. Tổng số vector trong chỉ mục: {self.index.ntotal}")
 
         self.save_index()
 
+    def update_items(self, vectors: np.ndarray, metadata: List[Dict[str, Any]], ids: Sequence[int],
+                     removed_ids: Iterable[int] = (), updated_metadata: Optional[Dict[int, Dict[str, Any]]] = None):
+        """Thêm hoặc thay vector của các ID ``ids``, xóa các ID ``removed_ids`` và thay metadata
+        (không đổi vector) của các ID trong ``updated_metadata``, rồi lưu một lần.
+
+        ID đã có trong chỉ mục được xóa trước khi thêm lại. HNSW không hỗ trợ ``remove_ids`` nên
+        khi có ID cần xóa, chỉ mục HNSW được dựng lại từ các vector còn lại (không trích xuất lại ảnh).
+        Chỉ mục rỗng được build mới theo ID.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        if vectors.shape[0] != len(metadata):
+            raise ValueError("Số lượng vector không khớp với số lượng metadata.")
+        ids = self._check_ids(ids, len(metadata))
+
+        if self.index is None or self.index.ntotal == 0:
+            if len(ids):
+                self.build_index(vectors, list(metadata), ids)
+            return
+        if not self.keyed:
+            raise ValueError("Chỉ mục theo vị trí: gọi to_keyed trước khi cập nhật theo ID.")
+
+        drop = {int(i) for i in removed_ids} | {int(i) for i in ids}
+        drop &= self._positions.keys()
+        updated = {int(key): meta for key, meta in (updated_metadata or {}).items()
+                   if int(key) in self._positions and int(key) not in drop}
+        if not drop and not len(ids) and not updated:
+            return
+
+        if drop or len(ids):
+            self._ensure_writable()
+        current = list(self.metadata)
+        for key, meta in updated.items():
+            current[self._positions[key]] = meta
+        keep = [position for position, key in enumerate(self.ids) if int(key) not in drop]
+        kept_ids = np.asarray(self.ids, dtype=np.int64)[keep]
+        if drop:
+            logger.info(f"Xóa {len(drop)} ID khỏi chỉ mục...")
+            if describe_index(self.index) == "hnsw":
+                kept_vectors = reconstruct_vectors(self.index, kept_ids)
+                self.index, _ = create_index("hnsw", self.dimension, metric=self.metric, keyed=True,
+                                             hnsw_m=self.index_info.get("hnsw_m", self.build_params["hnsw_m"]),
+                                             ef_construction=self.index_info.get("ef_construction", self.build_params["ef_construction"]))
+                set_search_params(self.index, self.nprobe, self.ef_search)
+                if len(kept_ids):
+                    self.index.add_with_ids(kept_vectors, kept_ids)
+            else:
+                self.index.remove_ids(np.array(sorted(drop), dtype=np.int64))
+
+        if len(ids):
+            logger.info(f"Thêm {len(ids)} vector theo ID...")
+            self.index.add_with_ids(self._prepare_vectors(vectors), ids)
+
+        self.metadata = [current[position] for position in keep] + list(metadata)
+        self._set_ids(np.concatenate([kept_ids, ids]))
+        logger.info(f"Cập nhật hoàn tất. Tổng số vector trong chỉ mục: {self.index.ntotal}")
+        self.save_index()
+
+    def to_keyed(self, key: str = "product_id"):
+        """Chuyển chỉ mục theo vị trí sang chỉ mục theo ID lấy từ ``metadata[i][key]`` (dùng lại vector đã lưu)."""
+        if self.keyed or self.index is None or self.index.ntotal == 0:
+            return
+        logger.info(f"Chuyển chỉ mục {self.index_path} sang chỉ mục theo ID ({key})...")
+        vectors = reconstruct_vectors(self.index)
+        metadata = list(self.metadata)
+        # Mỗi ID giữ một vector: bản ghi sau cùng thắng
+        last = {int(meta[key]): position for position, meta in enumerate(metadata)}
+        positions = sorted(last.values())
+        index_type, self.index_type = self.index_type, self.index_info.get("index_type", self.index_type)
+        try:
+            self.build_index(vectors[positions], [metadata[p] for p in positions],
+                             [int(metadata[p][key]) for p in positions])
+        finally:
+            self.index_type = index_type
+
+    @staticmethod
+    def _check_ids(ids: Sequence[int], count: int) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        if len(ids) != count:
+            raise ValueError(f"Số lượng ID ({len(ids)}) không khớp với số lượng metadata ({count}).")
+        if len(np.unique(ids)) != len(ids):
+            raise ValueError("ID bị trùng lặp.")
+        return ids
+
     def search(self, query_vector: np.ndarray, k: int = 5) -> List[Tuple[Dict[str, Any], float]]:
       
         if self.index is None or self.index.ntotal == 0:
@@ -86,8 +442,7 @@ class FaissIndexer:
         if query_vector.shape[1] != self.dimension:
             raise ValueError(f"Chiều của vector truy vấn ({query_vector.shape[1]}) không khớp với chiều của chỉ mục ({self.dimension}).")
 
-        if query_vector.dtype != np.float32:
-            query_vector = query_vector.astype(np.float32)
+        query_vector = self._prepare_vectors(query_vector)
 
         actual_k = min(k, self.index.ntotal)
         if actual_k == 0:
@@ -100,9 +455,9 @@ class FaissIndexer:
         for i, dist in zip(indices[0], distances[0]):
             if i != -1:  # faiss trả về -1 nếu không đủ k kết quả
                 try:
-                    meta = self.metadata[i]
+                    meta = self.metadata[self._positions[int(i)] if self.keyed else i]
                     results.append((meta, float(dist)))
-                except IndexError:
+                except (IndexError, KeyError):
                     logger.error(f"Lỗi truy cập metadata tại index {i} trong khi index size là {len(self.metadata)}")
                 except Exception as e:
                     logger.error(f"Lỗi không xác định khi xử lý kết quả tại index {i}: {e}")
@@ -110,50 +465,134 @@ class FaissIndexer:
         logger.debug(f"Tìm thấy {len(results)} kết quả.")
         return results
 
+    def _paths(self, generation: Optional[str]) -> Dict[str, str]:
+        """Đường dẫn các file của một thế hệ, hoặc các file cũ cạnh ``index_path`` nếu ``generation`` là None."""
+        if generation is None:
+            return {"index": self.index_path, "records": self.records_path,
+                    "ids": self.ids_path, "info": self.info_path}
+        directory = os.path.join(self.generations_dir, generation)
+        return {"index": os.path.join(directory, os.path.basename(self.index_path)),
+                "records": os.path.join(directory, os.path.basename(self.records_path)),
+                "ids": os.path.join(directory, os.path.basename(self.ids_path)),
+                "info": os.path.join(directory, os.path.basename(self.info_path))}
+
+    def _read_current(self) -> Optional[str]:
+        """Thế hệ mà con trỏ đang trỏ tới (None nếu chưa có con trỏ hoặc thư mục thế hệ không còn)."""
+        if not os.path.exists(self.current_path):
+            return None
+        try:
+            with open(self.current_path, 'r', encoding='utf-8') as f:
+                generation = json.load(f)["generation"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Không đọc được con trỏ chỉ mục {self.current_path}: {e}")
+            return None
+        if not os.path.isdir(os.path.join(self.generations_dir, generation)):
+            logger.error(f"Con trỏ {self.current_path} trỏ tới thế hệ không tồn tại: {generation}")
+            return None
+        return generation
+
     def save_index(self):
-        """Lưu chỉ mục FAISS và metadata vào file."""
+        """Lưu chỉ mục FAISS và metadata thành một thế hệ mới rồi chuyển con trỏ sang thế hệ đó."""
         if self.index is None:
             logger.warning("Không có chỉ mục để lưu.")
             return
 
+        generation = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        paths = self._paths(generation)
         try:
-            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
-            os.makedirs(os.path.dirname(self.metadata_path), exist_ok=True)
-
-            logger.info(f"Lưu chỉ mục FAISS vào: {self.index_path}")
-            faiss.write_index(self.index, self.index_path)
-
-            logger.info(f"Lưu metadata vào: {self.metadata_path}")
-            with open(self.metadata_path, 'wb') as f:
-                pickle.dump(self.metadata, f)
-            logger.info("Lưu chỉ mục và metadata thành công.")
+            os.makedirs(os.path.dirname(paths["index"]), exist_ok=True)
+            logger.info(f"Lưu chỉ mục FAISS vào: {paths['index']}")
+            faiss.write_index(self.index, paths["index"])
+
+            logger.info(f"Lưu metadata vào: {paths['records']}")
+            write_records(paths["records"], self.metadata)
+            if self.keyed:
+                with open(paths["ids"], 'wb') as f:
+                    np.save(f, np.asarray(self.ids, dtype=np.int64))
+
+            # Ghi lại loại chỉ mục và tham số build bên cạnh file chỉ mục
+            self.index_info.update(index_type=describe_index(self.index), metric=index_metric(self.index),
+                                   dimension=self.index.d, ntotal=self.index.ntotal, keyed=self.keyed)
+            with open(paths["info"], 'w', encoding='utf-8') as f:
+                json.dump(self.index_info, f, ensure_ascii=False, indent=2)
+
+            # Chỉ thay con trỏ khi mọi file của thế hệ đã ghi xong: đây là bước duy nhất worker khác thấy
+            def write_current(tmp_path: str):
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({"generation": generation, "ntotal": self.index.ntotal,
+                               "saved_at": time.strftime("%Y-%m-%dT%H:%M:%S")}, f)
+
+            atomic_write(self.current_path, write_current)
+            self.generation = generation
+            logger.info(f"Lưu chỉ mục và metadata thành công (thế hệ {generation}).")
 
         except Exception as e:
             logger.error(f"Lỗi khi lưu chỉ mục hoặc metadata: {e}")
+            if self._read_current() != generation:
+                shutil.rmtree(os.path.dirname(paths["index"]), ignore_errors=True)
             raise
 
+        self._remove_old_files()
+
+    def _remove_old_files(self):
+        """Xóa file cũ (trước khi lưu theo thế hệ) và các thế hệ cũ hơn ``KEEP_GENERATIONS``.
+
+        Worker đang mmap file đã xóa vẫn đọc được cho đến khi tải lại.
+        """
+        for path in (self.index_path, self.records_path, self.metadata_path, self.ids_path, self.info_path):
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logger.warning(f"Không xóa được file chỉ mục cũ {path}: {e}")
+        try:
+            generations = sorted(os.listdir(self.generations_dir))
+        except OSError:
+            return
+        old = [g for g in generations if g != self.generation][:max(0, len(generations) - KEEP_GENERATIONS)]
+        for generation in old:
+            shutil.rmtree(os.path.join(self.generations_dir, generation), ignore_errors=True)
+
     def load_index(self):
-        """Tải chỉ mục FAISS và metadata từ file nếu tồn tại."""
+        """Tải thế hệ chỉ mục hiện tại (hoặc các file cũ) cùng metadata nếu tồn tại.
+
+        Nếu số vector, số metadata và ID không khớp nhau, chỉ mục được đặt lại thành rỗng
+        thay vì phục vụ kết quả trỏ sai metadata.
+        """
         loaded = False
-        if os.path.exists(self.index_path) and os.path.exists(self.metadata_path):
+        self.generation = self._read_current()
+        paths = self._paths(self.generation)
+        legacy_metadata = self.generation is None and os.path.exists(self.metadata_path)
+        if os.path.exists(paths["index"]) and (os.path.exists(paths["records"]) or legacy_metadata):
             try:
-                logger.info(f"Đang tải chỉ mục FAISS từ: {self.index_path}")
-                self.index = faiss.read_index(self.index_path)
-                logger.info(f"Tải chỉ mục thành công. Số vector: {self.index.ntotal}, Chiều: {self.index.d}")
+                logger.info(f"Đang tải chỉ mục FAISS từ: {paths['index']}")
+                self.index, self.mmapped = read_index(paths["index"], self.mmap)
+                logger.info(f"Tải chỉ mục thành công{' (mmap)' if self.mmapped else ''}. Số vector: {self.index.ntotal}, Chiều: {self.index.d}")
 
                 if self.index.d != self.dimension:
                     logger.warning(f"Chiều của chỉ mục đã tải ({self.index.d}) không khớp với chiều khai báo ({self.dimension}). Sẽ sử dụng chiều từ file.")
                     self.dimension = self.index.d
 
-                logger.info(f"Đang tải metadata từ: {self.metadata_path}")
-                with open(self.metadata_path, 'rb') as f:
-                    self.metadata = pickle.load(f)
+                # Loại chỉ mục lấy từ file info (chỉ mục cũ không có file info: suy ra từ lớp FAISS)
+                self.index_info = self._read_info(paths["info"])
+                self.index_info["index_type"] = describe_index(self.index)
+                self.index_info["metric"] = index_metric(self.index)
+                set_search_params(self.index, self.nprobe, self.ef_search)
+                logger.info(f"Loại chỉ mục: {self.index_info['index_type']}, metric: {self.index_info['metric']}")
+
+                self.metadata = self._load_metadata(paths["records"])
                 logger.info(f"Tải metadata thành công. Số lượng metadata: {len(self.metadata)}")
+                self._set_ids(np.load(paths["ids"], mmap_mode="r") if os.path.exists(paths["ids"]) else None)
 
-                if self.index.ntotal != len(self.metadata):
-                    logger.error(f"Số lượng vector trong chỉ mục ({self.index.ntotal}) không khớp với metadata ({len(self.metadata)}). Chỉ mục có thể bị hỏng.")
+                problem = self._consistency_problem()
+                if problem:
+                    logger.error(f"{problem} Chỉ mục bị hỏng, đặt lại chỉ mục rỗng (chạy lại build_image_index để dựng lại).")
+                    self.index = None
+                    self.mmapped = False
                 else:
                     loaded = True
+                    if self.index_info["metric"] != self.metric:
+                        self._migrate_metric()
 
             except faiss.FaissException as e:
                 logger.error(f"Lỗi FAISS khi tải chỉ mục từ {self.index_path}: {e}")
@@ -175,9 +614,74 @@ class FaissIndexer:
             logger.info("Không tìm thấy file chỉ mục hoặc metadata. Chỉ mục sẽ được tạo khi có dữ liệu.")
 
         if not loaded and self.index is None:
+            self.generation = None
             logger.info(f"Khởi tạo chỉ mục FAISS trống với chiều {self.dimension}")
-            self.index = faiss.IndexFlatL2(self.dimension)
+            self.index, self.index_info = create_index("flat", self.dimension, metric=self.metric)
             self.metadata = []
+            self._set_ids(None)
+
+    def _consistency_problem(self) -> Optional[str]:
+        """Mô tả chỗ không khớp giữa chỉ mục, metadata và ID vừa tải, None nếu khớp."""
+        if self.index.ntotal != len(self.metadata):
+            return f"Số lượng vector trong chỉ mục ({self.index.ntotal}) không khớp với metadata ({len(self.metadata)})."
+        if not self.keyed:
+            if bool(self.index_info.get("keyed")):
+                return "Chỉ mục theo ID nhưng thiếu file ID."
+            return None
+        if len(self.ids) != len(self.metadata):
+            return f"Số lượng ID ({len(self.ids)}) không khớp với metadata ({len(self.metadata)})."
+        if len(self._positions) != len(self.ids):
+            return "File ID có ID trùng lặp."
+        if isinstance(self.index, faiss.IndexIDMap):
+            index_ids = faiss.vector_to_array(self.index.id_map)
+            if not np.array_equal(np.sort(index_ids), np.sort(np.asarray(self.ids, dtype=np.int64))):
+                return "ID trong chỉ mục không khớp với file ID."
+        return None
+
+    def _load_metadata(self, records_path: str) -> Sequence[Dict[str, Any]]:
+        """Metadata từ file bản ghi (map vào bộ nhớ); file pickle cũ được đọc và chuyển sang file bản ghi."""
+        if os.path.exists(records_path):
+            logger.info(f"Đang tải metadata từ: {records_path}")
+            return RecordFile(records_path)
+
+        logger.info(f"Đang tải metadata từ: {self.metadata_path}")
+        with open(self.metadata_path, 'rb') as f:
+            metadata = pickle.load(f)
+        try:
+            write_records(self.records_path, metadata)
+            logger.info(f"Đã chuyển metadata pickle sang {self.records_path}")
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Không chuyển được metadata sang file bản ghi: {e}")
+        return metadata
+
+    def _ensure_writable(self):
+        """Đọc lại toàn bộ chỉ mục vào bộ nhớ nếu đang dùng bản mmap (bản mmap không sửa được)."""
+        if self.mmapped:
+            logger.info("Đọc lại chỉ mục vào bộ nhớ trước khi sửa.")
+            self.index, self.mmapped = read_index(self._paths(self.generation)["index"])
+            set_search_params(self.index, self.nprobe, self.ef_search)
+
+    def _migrate_metric(self):
+        """Dựng lại chỉ mục đã tải theo ``self.metric`` từ các vector đang lưu, giữ nguyên loại chỉ mục và metadata."""
+        old_metric = self.index_info.get("metric")
+        logger.info(f"Chuyển chỉ mục {self.index_path} từ metric {old_metric} sang {self.metric}...")
+        vectors = reconstruct_vectors(self.index, self.ids)
+        index_type, self.index_type = self.index_type, self.index_info.get("index_type", self.index_type)
+        try:
+            self.build_index(vectors, list(self.metadata), self.ids)
+        finally:
+            self.index_type = index_type
+        logger.info(f"Đã chuyển chỉ mục sang metric {self.metric} ({self.index.ntotal} vector).")
+
+    def _read_info(self, info_path: str) -> Dict[str, Any]:
+        if not os.path.exists(info_path):
+            return {}
+        try:
+            with open(info_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Không đọc được file info {info_path}: {e}")
+            return {}
 
     def get_index_size(self) -> int:
         """Trả về số lượng vector hiện có trong chỉ mục."""
@@ -53,6 +53,11 @@ class ImageFeatureExtractor:
 
         logger.info(f"Khởi tạo trích xuất đặc trưng ViT với vector đầu ra có chiều: {self.feature_dim}")
 
+    @torch.no_grad()
+    def warmup(self) -> None:
+        """Chạy một lượt forward trên ảnh rỗng để khởi tạo kernel trước request đầu tiên."""
+        self.model(torch.zeros(1, 3, 224, 224, device=self.device))
+
     @torch.no_grad()
     def extract_features(self, image_source: str) -> Optional[np.ndarray]:
         """
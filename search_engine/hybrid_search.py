@@ -1,24 +1,68 @@
-import sqlite3
-from typing import List, Dict, Any, Tuple
+from functools import partial
+from typing import List, Dict, Any, Tuple, Optional
 import numpy as np
 from config import Config
-from search_engine.feature_extractor import ImageFeatureExtractor
 from search_engine.faiss_indexer import FaissIndexer
-from system.embeddings import PhoBERTEmbeddings
+from search_engine.product_catalog import get_product_catalog
+from search_engine.description_embeddings import DescriptionEmbeddings
+from system.model_registry import model_registry, register_default_models, PHOBERT, VIT
+from system.inference_pool import run_inference, InferenceBusy, MODEL_POOL
 
 class HybridSearchResult:
     def __init__(self, config: Config):
         self.config = config
-        self.feature_extractor = ImageFeatureExtractor()
-        self.indexer = FaissIndexer(
+        # ViT và PhoBERT được chia sẻ qua model registry, không tải lại cho mỗi instance
+        register_default_models(config)
+        # Tải model và chỉ mục ảnh (kể cả chuyển đổi chỉ mục cũ) trên pool suy luận, không chặn hub
+        runner = partial(run_inference, MODEL_POOL)
+        self.feature_extractor = model_registry.get(VIT, runner=runner)
+        self.indexer = run_inference(
+            MODEL_POOL, FaissIndexer.from_config,
+            config,
             index_path=config.image_index_path,
             metadata_path=config.image_metadata_path,
             dimension=self.feature_extractor.feature_dim
         )
-        self.embeddings = PhoBERTEmbeddings()
-
-    def _normalize_scores(self, results: List[Tuple[Any, float]]) -> Dict[str, float]:
-        """Chuẩn hóa điểm và tính xác suất"""
+        self.embeddings = model_registry.get(PHOBERT, runner=runner)
+        self.catalog = get_product_catalog(config.db_path, cache_enabled=config.product_cache_enabled)
+        # Ma trận embedding mô tả sản phẩm tính sẵn, được gán từ description vector store
+        self.description_embeddings: Optional[DescriptionEmbeddings] = None
+
+    def set_description_embeddings(self, description_embeddings: Optional[DescriptionEmbeddings]):
+        """Gán ma trận embedding mô tả sản phẩm dùng cho MBR"""
+        self.description_embeddings = description_embeddings
+
+    def _description_vectors(self, product_ids: List[Any], metas: List[Dict[str, Any]]) -> np.ndarray:
+        """Vector mô tả đã chuẩn hóa L2 cho từng kết quả.
+
+        Lấy từ ma trận tính sẵn theo product ID; chỉ những mô tả không có trong ma trận
+        mới được embed, và được embed chung một batch.
+        """
+        vectors = None
+        missing = list(range(len(product_ids)))
+        if self.description_embeddings is not None:
+            vectors = self.description_embeddings.get(product_ids)
+            missing = [i for i, pid in enumerate(product_ids) if pid not in self.description_embeddings]
+
+        if missing:
+            texts = [metas[i].get('description') or '' for i in missing]
+            embedded = self.embeddings.embed_documents_array(texts)
+            embedded = embedded / (np.linalg.norm(embedded, axis=1, keepdims=True) + 1e-8)
+            if vectors is None:
+                vectors = np.zeros((len(product_ids), embedded.shape[1]), dtype=np.float32)
+            vectors[missing] = embedded
+
+        if vectors is None:
+            return np.zeros((0, self.embeddings.model.config.hidden_size), dtype=np.float32)
+        return vectors
+
+    def _normalize_scores(self, results: List[Tuple[Any, float]], similarity: bool = False) -> Dict[str, float]:
+        """Chuẩn hóa điểm và tính xác suất.
+
+        ``similarity=True``: điểm là cosine (chỉ mục ảnh metric ip), xác suất là softmax của
+        cosine với nhiệt độ cố định nên so sánh được giữa các truy vấn. Ngược lại điểm là
+        khoảng cách và được chuẩn hóa z-score trong từng truy vấn.
+        """
         if not results:
             print("Không có kết quả để chuẩn hóa")
             return {}
@@ -38,6 +82,11 @@ class HybridSearchResult:
             except Exception as e:
                 print(f"Lỗi khi xử lý kết quả: {e}")
 
+        if not distances:
+            return {}
+        if similarity:
+            return self._similarity_probs(distances)
+
         values = np.array(list(distances.values()))
         mean, std = np.mean(values), np.std(values)
         normalized_dist = {pid: (dist - mean) / (std + 1e-6) for pid, dist in distances.items()}
@@ -61,18 +110,34 @@ class HybridSearchResult:
 
         return probs
 
+    def _similarity_probs(self, similarities: Dict[Any, float]) -> Dict[Any, float]:
+        """Softmax của độ tương đồng cosine với nhiệt độ IMAGE_SCORE_TEMPERATURE ({} nếu không có kết quả)."""
+        if not similarities:
+            return {}
+        temperature = max(self.config.image_score_temperature, 1e-6)
+        values = np.array(list(similarities.values()), dtype=np.float64) / temperature
+        weights = np.exp(values - values.max())
+        probs = dict(zip(similarities.keys(), (weights / weights.sum()).tolist()))
+
+        print("\n=== Xác suất cuối cùng (softmax cosine) ===")
+        for pid, prob in probs.items():
+            print(f"Product {pid}: Cosine = {similarities[pid]:.4f}, Probability = {prob:.4f}")
+        return probs
+
     def search_by_image_features(self, image_path: str, k: int = 5) -> List[Tuple[Dict[str, Any], float]]:
         """Tìm kiếm sản phẩm dựa trên đặc trưng ảnh"""
         try:
             print(f"\n=== Trích xuất đặc trưng ảnh từ {image_path} ===")
-            query_feature = self.feature_extractor.extract_features(image_path)
+            query_feature = run_inference(MODEL_POOL, self.feature_extractor.extract_features, image_path)
             if query_feature is None:
                 print("Không thể trích xuất đặc trưng ảnh")
                 return []
             print("Trích xuất đặc trưng ảnh thành công")
 
             print("\n=== Tìm kiếm trong FAISS index ===")
-            return self.indexer.search(query_feature, k)
+            return run_inference(MODEL_POOL, self.indexer.search, query_feature, k)
+        except InferenceBusy:
+            raise
         except Exception as e:
             print(f"Lỗi khi tìm kiếm theo đặc trưng ảnh: {e}")
             return []
@@ -87,7 +152,7 @@ class HybridSearchResult:
         text_probs = self._normalize_scores([
             (r, r.get('score', 0.0)) if isinstance(r, dict) else r for r in text_results
         ])
-        image_probs = self._normalize_scores(image_results)
+        image_probs = self._normalize_scores(image_results, similarity=self.indexer.higher_is_better)
 
         candidates = {}
         for results in (text_results, image_results):
@@ -97,25 +162,26 @@ class HybridSearchResult:
                 if product_id and product_id not in candidates:
                     candidates[product_id] = meta if isinstance(meta, dict) else meta.metadata
 
-        def compute_similarity(desc1, desc2):
-            emb1 = np.array(self.embeddings.embed_query(desc1))
-            emb2 = np.array(self.embeddings.embed_query(desc2))
-            return float(np.dot(emb1, emb2) / (np.linalg.norm(emb1) * np.linalg.norm(emb2) + 1e-8))
-
-        scores = []
-        for candidate_id, candidate in candidates.items():
-            desc_cand = candidate.get('description', '')
-            sim_image = sum(
-                image_probs.get(meta.get('product_id'), 0.0) * compute_similarity(desc_cand, meta.get('description', ''))
-                for meta, _ in image_results
-            )
-            sim_text = sum(
-                text_probs.get(
-                    (r if isinstance(r, dict) else r[0]).get('product_id'), 0.0
-                ) * compute_similarity(desc_cand, (r if isinstance(r, dict) else r[0]).get('description', ''))
-                for r in text_results
-            )
-            scores.append((candidate_id, alpha * sim_image + (1 - alpha) * sim_text))
+        def result_meta(r):
+            return r if isinstance(r, dict) else r[0]
+
+        image_metas = [meta for meta, _ in image_results]
+        text_metas = [result_meta(r) for r in text_results]
+        candidate_ids = list(candidates.keys())
+
+        # Vector mô tả (đã chuẩn hóa) cho ứng viên, kết quả ảnh và kết quả văn bản
+        cand_vectors = self._description_vectors(candidate_ids, [candidates[cid] for cid in candidate_ids])
+        image_vectors = self._description_vectors([m.get('product_id') for m in image_metas], image_metas)
+        text_vectors = self._description_vectors([m.get('product_id') for m in text_metas], text_metas)
+
+        image_weights = np.array([image_probs.get(m.get('product_id'), 0.0) for m in image_metas], dtype=np.float32)
+        text_weights = np.array([text_probs.get(m.get('product_id'), 0.0) for m in text_metas], dtype=np.float32)
+
+        # Một phép nhân ma trận cho toàn bộ cặp ứng viên × kết quả
+        sim_image = cand_vectors @ image_vectors.T @ image_weights if len(image_metas) else np.zeros(len(candidate_ids))
+        sim_text = cand_vectors @ text_vectors.T @ text_weights if len(text_metas) else np.zeros(len(candidate_ids))
+        total = alpha * sim_image + (1 - alpha) * sim_text
+        scores = [(cid, float(score)) for cid, score in zip(candidate_ids, total)]
 
         scores.sort(key=lambda x: -x[1])
         top_candidates = [candidates[cid] for cid, _ in scores[:k]]
@@ -126,36 +192,14 @@ class HybridSearchResult:
 
         return top_candidates
 
-    def _get_product_info(self, product_id: int) -> Dict[str, Any]:
-        """Lấy thông tin sản phẩm từ database với giá các biến thể sử dụng GROUP_CONCAT"""
+    def get_products_info(self, product_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """Lấy thông tin nhiều sản phẩm (tên, mô tả, giá các biến thể) trong một lần tra cứu"""
         try:
-            conn = sqlite3.connect(self.config.db_path)
-            cursor = conn.cursor()
-
-            # Sử dụng GROUP_CONCAT để gộp thông tin biến thể thành một chuỗi
-            cursor.execute("""
-                SELECT
-                    p.Name_Product as name,
-                    p.Descriptions as description,
-                    v.Price as price,
-                    'Biến thể: ' || GROUP_CONCAT(v."Beverage Option", ', ') || '; Giá: ' || GROUP_CONCAT(v.Price || ' VND', ', ') as variant_prices
-                FROM Product p
-                JOIN Variant v ON p.ID = v.Product_id
-                WHERE p.ID = ?
-                GROUP BY p.ID, p.Name_Product, p.Descriptions
-            """, (product_id,))
-
-            row = cursor.fetchone()
-            conn.close()
-
-            if row:
-                return {
-                    'name': row[0],
-                    'description': row[1],
-                    'price': row[2],
-                    'variant_prices': row[3] if row[3] else 'Không có thông tin giá'
-                }
-            return None
+            return self.catalog.get_products_info(product_ids)
         except Exception as e:
-            print(f"Lỗi khi lấy thông tin sản phẩm {product_id}: {e}")
-            return None
+            print(f"Lỗi khi lấy thông tin sản phẩm {product_ids}: {e}")
+            return {}
+
+    def _get_product_info(self, product_id: int) -> Dict[str, Any]:
+        """Lấy thông tin một sản phẩm với giá các biến thể"""
+        return self.get_products_info([product_id]).get(product_id)
@@ -0,0 +1,164 @@
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+from db_pool import get_pool, TableWatcher
+from search_engine.product_matcher import ProductNameMatcher
+
+# Thông tin sản phẩm kèm giá các biến thể, gộp bằng GROUP_CONCAT
+_PRODUCT_INFO_SQL = """
+    SELECT
+        p.ID as id,
+        p.Name_Product as name,
+        p.Descriptions as description,
+        v.Price as price,
+        'Biến thể: ' || GROUP_CONCAT(v."Beverage Option", ', ') || '; Giá: ' || GROUP_CONCAT(v.Price || ' VND', ', ') as variant_prices
+    FROM Product p
+    JOIN Variant v ON p.ID = v.Product_id
+    {where}
+    GROUP BY p.ID, p.Name_Product, p.Descriptions
+"""
+
+# Ảnh đại diện của mỗi tên sản phẩm: Link_Image của dòng đầu tiên trong phép JOIN
+_PRODUCT_IMAGE_SQL = """
+    SELECT p.Name_Product, Link_Image
+    FROM Variant v
+    JOIN Product p ON v.Product_id = p.Id
+"""
+
+
+class ProductCatalog:
+    """Tra cứu thông tin sản phẩm (tên, mô tả, giá biến thể) theo lô.
+
+    Khi bật cache, toàn bộ catalog được đọc bằng một truy vấn và giữ trong bộ nhớ;
+    cache được làm mới khi nội dung bảng Product hoặc Variant thay đổi.
+    Khi tắt cache, mỗi lần gọi ``get_products_info`` là một truy vấn ``IN (...)``.
+
+    Bảng tên -> ảnh và automaton ``ProductNameMatcher`` dùng để tìm sản phẩm trong câu trả
+    luôn được giữ trong bộ nhớ và dựng lại theo cùng phiên bản bảng.
+    """
+
+    WATCHED_TABLES = ("Product", "Variant")
+
+    def __init__(self, db_path: str, cache_enabled: bool = True):
+        self.pool = get_pool(db_path)
+        self.cache_enabled = cache_enabled
+        self._watcher = TableWatcher(self.pool, self.WATCHED_TABLES)
+        self._products: Dict[Any, Dict[str, Any]] = {}
+        self._version: Optional[str] = None
+        self._images: Dict[str, Any] = {}
+        self._matcher = ProductNameMatcher([])
+        self._matcher_version: Optional[str] = None
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.reloads = 0
+        self.matcher_builds = 0
+        self.matches = 0
+
+    @staticmethod
+    def _row_to_info(row) -> Dict[str, Any]:
+        return {
+            'name': row[1],
+            'description': row[2],
+            'price': row[3],
+            'variant_prices': row[4] if row[4] else 'Không có thông tin giá'
+        }
+
+    def _ensure_loaded(self):
+        version = self._watcher.version()
+        if version == self._version:
+            return
+        with self._lock:
+            if version == self._version:
+                return
+            rows = self.pool.fetchall(_PRODUCT_INFO_SQL.format(where=""))
+            self.queries += 1
+            self.reloads += 1
+            self._products = {row[0]: self._row_to_info(row) for row in rows}
+            self._version = version
+            print(f"Product catalog loaded: {len(self._products)} products")
+
+    def get_products_info(self, product_ids: Iterable[Any]) -> Dict[Any, Dict[str, Any]]:
+        """Trả về {product_id: info} cho các ID có trong database (ID không tồn tại bị bỏ qua)."""
+        ids = list(dict.fromkeys(pid for pid in product_ids if pid is not None))
+        if not ids:
+            return {}
+
+        if self.cache_enabled:
+            self._ensure_loaded()
+            return {pid: self._products[pid] for pid in ids if pid in self._products}
+
+        placeholders = ", ".join("?" for _ in ids)
+        rows = self.pool.fetchall(_PRODUCT_INFO_SQL.format(where=f"WHERE p.ID IN ({placeholders})"), ids)
+        self.queries += 1
+        return {row[0]: self._row_to_info(row) for row in rows}
+
+    def get_product_info(self, product_id: Any) -> Optional[Dict[str, Any]]:
+        return self.get_products_info([product_id]).get(product_id)
+
+    def _ensure_matcher(self):
+        version = self._watcher.version()
+        if version == self._matcher_version:
+            return
+        with self._lock:
+            if version == self._matcher_version:
+                return
+            images: Dict[str, Any] = {}
+            for name, image in self.pool.fetchall(_PRODUCT_IMAGE_SQL):
+                images.setdefault(name, image)
+            for (name,) in self.pool.fetchall("SELECT DISTINCT Name_Product FROM Product"):
+                images.setdefault(name, None)
+            self.queries += 2
+            self.matcher_builds += 1
+            self._images = images
+            self._matcher = ProductNameMatcher(images)
+            self._matcher_version = version
+            print(f"Product name matcher built: {len(self._matcher)} names, {self._matcher.stats()['states']} states")
+
+    def find_product_names(self, text: str) -> List[str]:
+        """Tên sản phẩm xuất hiện trong ``text`` (ưu tiên tên dài, không chồng lấn, theo thứ tự xuất hiện)."""
+        self._ensure_matcher()
+        names = self._matcher.find(text)
+        self.matches += 1
+        return names
+
+    def images_for_names(self, names: Iterable[str]) -> List[Dict[str, Any]]:
+        """[{name, image}] cho các tên có ảnh, giữ thứ tự và bỏ tên trùng."""
+        self._ensure_matcher()
+        images = self._images
+        return [
+            {"name": name, "image": images[name]}
+            for name in dict.fromkeys(names)
+            if images.get(name) is not None
+        ]
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+            self._matcher_version = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cache_enabled": self.cache_enabled,
+            "cached_products": len(self._products),
+            "queries": self.queries,
+            "reloads": self.reloads,
+            "matcher_names": len(self._matcher),
+            "matcher_builds": self.matcher_builds,
+            "matches": self.matches,
+        }
+
+
+_catalogs: Dict[str, ProductCatalog] = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_product_catalog(db_path: str, cache_enabled: bool = True) -> ProductCatalog:
+    """Catalog dùng chung theo đường dẫn database; ``cache_enabled`` chỉ có tác dụng ở lần tạo đầu tiên."""
+    catalog = _catalogs.get(db_path)
+    if catalog is None:
+        with _catalogs_lock:
+            catalog = _catalogs.get(db_path)
+            if catalog is None:
+                catalog = ProductCatalog(db_path, cache_enabled=cache_enabled)
+                _catalogs[db_path] = catalog
+    return catalog
@@ -0,0 +1,91 @@
+from collections import deque
+from typing import Any, Dict, Iterable, List, Tuple
+
+
+class ProductNameMatcher:
+    """Tìm tên sản phẩm trong văn bản bằng automaton Aho–Corasick (không phân biệt hoa thường).
+
+    Automaton được dựng một lần từ danh sách tên; mỗi lần ``find`` chỉ duyệt văn bản một
+    lượt để lấy mọi lần xuất hiện, rồi chọn kết quả theo đúng quy tắc cũ của
+    ``extract_product_images``: tên dài hơn được ưu tiên, các đoạn khớp không chồng lên
+    nhau, mỗi tên lấy lần xuất hiện đầu tiên còn hợp lệ, kết quả theo thứ tự xuất hiện.
+    """
+
+    def __init__(self, names: Iterable[str]):
+        self.names: List[str] = []
+        # Mỗi node: bảng chuyển, fail link, danh sách id tên kết thúc tại node (kể cả qua fail link)
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[int]] = [[]]
+
+        seen = set()
+        for name in names:
+            key = (name or "").lower()
+            if not key.strip() or key in seen:
+                continue
+            seen.add(key)
+            self._insert(key, len(self.names))
+            self.names.append(name)
+        self._lengths = [len(name.lower()) for name in self.names]
+        self._build_links()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _insert(self, key: str, name_id: int):
+        node = 0
+        for char in key:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = next_node
+        self._output[node].append(name_id)
+
+    def _build_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def occurrences(self, text: str) -> List[Tuple[int, int, int]]:
+        """Mọi lần xuất hiện ``(start, end, name_id)`` của các tên trong ``text``."""
+        found = []
+        node = 0
+        goto, fail, output, lengths = self._goto, self._fail, self._output, self._lengths
+        for position, char in enumerate(text.lower()):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for name_id in output[node]:
+                found.append((position + 1 - lengths[name_id], position + 1, name_id))
+        return found
+
+    def find(self, text: str) -> List[str]:
+        """Tên sản phẩm xuất hiện trong ``text``: ưu tiên tên dài, không chồng lấn, theo thứ tự xuất hiện."""
+        if not text or not self.names:
+            return []
+        candidates = sorted(self.occurrences(text), key=lambda m: (-(m[1] - m[0]), m[0]))
+        chosen: List[Tuple[int, int, int]] = []
+        used = set()
+        for start, end, name_id in candidates:
+            if name_id in used:
+                continue
+            if any(start < chosen_end and end > chosen_start for chosen_start, chosen_end, _ in chosen):
+                continue
+            chosen.append((start, end, name_id))
+            used.add(name_id)
+        chosen.sort()
+        return [self.names[name_id] for _, _, name_id in chosen]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"names": len(self.names), "states": len(self._goto)}
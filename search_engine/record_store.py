@@ -0,0 +1,102 @@
+import os
+import json
+import mmap
+import struct
+import logging
+import tempfile
+from typing import Any, Callable, Iterable, Iterator, List, Sequence, Union
+
+import numpy as np
+
+# Cấu hình logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Định dạng: MAGIC | số bản ghi n (uint64) | n + 1 offset (uint64, tính từ đầu vùng dữ liệu) | dữ liệu JSON UTF-8
+MAGIC = b"RECORDS1"
+_HEADER = struct.Struct("<8sQ")
+
+
+def atomic_write(path: str, writer: Callable[[str], None]):
+    """Gọi ``writer(tmp_path)`` rồi ``os.replace`` sang ``path``.
+
+    Process khác đang mmap file cũ vẫn đọc được inode cũ cho đến khi tải lại, và không ai
+    thấy file ghi dở.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    os.close(fd)
+    try:
+        writer(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_records(path: str, records: Iterable[Any]):
+    """Ghi danh sách bản ghi (dict/list/str/số, serialize được bằng JSON) ra ``path`` (ghi nguyên tử)."""
+    blobs = [json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") for record in records]
+    offsets = np.zeros(len(blobs) + 1, dtype="<u8")
+    np.cumsum([len(blob) for blob in blobs], out=offsets[1:])
+
+    def writer(tmp_path: str):
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, len(blobs)))
+            f.write(offsets.tobytes())
+            for blob in blobs:
+                f.write(blob)
+
+    atomic_write(path, writer)
+
+
+class RecordFile(Sequence):
+    """Danh sách bản ghi chỉ đọc, map thẳng từ file ghi bởi ``write_records``.
+
+    Chỉ bảng offset được xem như mảng numpy trên vùng mmap; mỗi bản ghi chỉ được giải mã
+    JSON khi truy cập. Nhiều worker mở cùng file dùng chung page cache của hệ điều hành,
+    và thời gian mở không phụ thuộc số bản ghi.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _HEADER.size:
+                raise ValueError(f"File bản ghi {path} bị cắt cụt")
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"File {path} không phải định dạng bản ghi ({magic!r})")
+        self._count = count
+        self._offsets = np.frombuffer(self._mm, dtype="<u8", count=count + 1, offset=_HEADER.size)
+        self._data_start = _HEADER.size + 8 * (count + 1)
+        if self._data_start + int(self._offsets[-1]) > size:
+            raise ValueError(f"File bản ghi {path} bị cắt cụt")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _decode(self, i: int) -> Any:
+        start = self._data_start + int(self._offsets[i])
+        end = self._data_start + int(self._offsets[i + 1])
+        return json.loads(self._mm[start:end].decode("utf-8"))
+
+    def __getitem__(self, i: Union[int, slice]) -> Any:
+        if isinstance(i, slice):
+            return [self._decode(j) for j in range(*i.indices(self._count))]
+        i = int(i)
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(f"Bản ghi {i} nằm ngoài phạm vi ({self._count})")
+        return self._decode(i)
+
+    def __iter__(self) -> Iterator[Any]:
+        for i in range(self._count):
+            yield self._decode(i)
+
+    def to_list(self) -> List[Any]:
+        return list(self)
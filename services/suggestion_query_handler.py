@@ -1,15 +1,28 @@
-from typing import Dict, List, Optional
+import re
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 from flask import session
 from system.rag_system import OptimizedRAGSystem
 from services.suggestion_service import SuggestionService
+from system.inference_pool import InferenceBusy
+
+# Ranh giới câu/dòng: tên sản phẩm không nằm vắt qua đây nên có thể tìm ảnh theo từng đoạn
+_SEGMENT_BOUNDARY = re.compile(r"[.!?:;\n]")
 
 class SuggestionQueryHandler:
     """Handler class for processing suggestion queries"""
 
-    def __init__(self, rag_system: OptimizedRAGSystem, suggestion_service: SuggestionService):
-        self.rag_system = rag_system
+    def __init__(self, rag_system: Union[OptimizedRAGSystem, Callable[[], OptimizedRAGSystem]],
+                 suggestion_service: SuggestionService):
+        # Có thể truyền hàm trả về RAG system để nó chỉ được tạo khi cần (app.py tải nền lúc khởi động)
+        self._rag_system = rag_system
         self.suggestion_service = suggestion_service
 
+    @property
+    def rag_system(self) -> OptimizedRAGSystem:
+        if isinstance(self._rag_system, OptimizedRAGSystem):
+            return self._rag_system
+        return self._rag_system()
+
     def get_user_key_from_session(self) -> str:
         """Get user key from session"""
         user_key = "anonymous"
@@ -64,15 +77,22 @@ class SuggestionQueryHandler:
 
     def _get_product_images_for_query(self, formatted_data: Dict) -> List:
         """Get product images for query results"""
-        from search_engine.get_URL_img import extract_product_images
+        from search_engine.product_catalog import get_product_catalog
 
-        product_images = []
-        if formatted_data["type"] == "products":
-            for item in formatted_data["items"]:
-                product_name = item["name"]
-                image_info = extract_product_images(product_name, self.suggestion_service.db_path)
-                if image_info:
-                    product_images.extend(image_info)
+        if formatted_data["type"] != "products":
+            return []
+
+        # Tên lấy từ kết quả truy vấn là tên sản phẩm chính xác: tra thẳng bảng tên -> ảnh
+        catalog = get_product_catalog(self.suggestion_service.db_path)
+        names = [item["name"] for item in formatted_data["items"]]
+        product_images = catalog.images_for_names(names)
+
+        # Tên không khớp chính xác (ví dụ khác hoa thường) thì tìm bằng automaton như trước
+        found = {image["name"] for image in product_images}
+        for name in names:
+            if name in found or not name:
+                continue
+            product_images.extend(catalog.images_for_names(catalog.find_product_names(name)))
 
         return product_images
 
@@ -85,8 +105,12 @@ class SuggestionQueryHandler:
         user_key = self.get_user_key_from_session()
 
         try:
-            # Get response from RAG system
-            response = self.rag_system.answer_query(user_key, user_query)
+            # Get response from RAG system, collecting per-stage timings (ms)
+            timings = {}
+            response = self.rag_system.answer_query(
+                user_key, user_query,
+                on_stage=lambda name, seconds: timings.__setitem__(name, round(seconds * 1000, 1))
+            )
 
             # Extract product images from the response
             from search_engine.get_URL_img import extract_product_images
@@ -96,8 +120,12 @@ class SuggestionQueryHandler:
             return {
                 "role": "assistant",
                 "content": response,
-                "product_images": product_images
+                "product_images": product_images,
+                "timings": timings
             }
+        except InferenceBusy as e:
+            print(f"Inference pools saturated, rejecting chat message: {e}")
+            return {"error": "Máy chủ đang bận, vui lòng thử lại sau giây lát.", "busy": True}, 503
         except Exception as e:
             print(f"Error getting RAG response: {e}")
 
@@ -106,6 +134,64 @@ class SuggestionQueryHandler:
 
             return {"error": "Failed to get response from assistant"}, 500
 
+    def stream_chat_message(self, user_key: str, user_query: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Stream câu trả lời chat thành các sự kiện ``(tên, dữ liệu)``.
+
+        ``token`` cho từng đoạn câu trả lời, sau đó ``product_images`` và ``done`` (câu trả lời
+        đầy đủ, timings); ``error`` nếu có lỗi. Session phải được kiểm tra trước khi gọi
+        (``ensure_valid_session``) vì generator chạy sau khi response đã bắt đầu gửi. Ảnh sản
+        phẩm được tìm dần trên từng câu đã sinh xong nên sẵn sàng ngay khi LLM dừng.
+        """
+        from search_engine.get_URL_img import extract_product_images
+
+        timings = {}
+        text = ""
+        scanned = 0
+        product_images = []
+        seen_products = set()
+
+        def scan(segment: str):
+            if not segment.strip():
+                return
+            for product in extract_product_images(segment, self.suggestion_service.db_path):
+                if product["name"] not in seen_products:
+                    seen_products.add(product["name"])
+                    product_images.append(product)
+
+        try:
+            events = self.rag_system.answer_query_stream(
+                user_key, user_query,
+                on_stage=lambda name, seconds: timings.__setitem__(name, round(seconds * 1000, 1))
+            )
+            for kind, value in events:
+                if kind == "token":
+                    text += value
+                    yield "token", {"text": value}
+                    # Tìm ảnh trên các câu vừa hoàn chỉnh
+                    boundary = max((m.end() for m in _SEGMENT_BOUNDARY.finditer(text, scanned)), default=scanned)
+                    if boundary > scanned:
+                        scan(text[scanned:boundary])
+                        scanned = boundary
+                elif kind == "done":
+                    # Câu trả lời đầy đủ có thể khác phần đã stream (vd. lỗi giữa chừng): quét lại từ đầu
+                    if value == text.strip():
+                        scan(text[scanned:])
+                    else:
+                        product_images.clear()
+                        seen_products.clear()
+                        scan(value)
+                    yield "product_images", {"product_images": product_images}
+                    yield "done", {"role": "assistant", "content": value, "timings": timings}
+                elif isinstance(value, InferenceBusy):
+                    print(f"Inference pools saturated, rejecting chat message: {value}")
+                    yield "error", {"error": "Máy chủ đang bận, vui lòng thử lại sau giây lát.", "busy": True}
+                else:
+                    raise value
+        except Exception as e:
+            print(f"Error streaming RAG response: {e}")
+            self._add_to_chat_history(user_key, user_query, f"ERROR: {e}")
+            yield "error", {"error": "Failed to get response from assistant"}
+
     def process_menu_suggestion(self, suggestion_type: str, category_id: Optional[str] = None) -> Dict:
         """Process menu suggestion request and return LLM-generated response"""
         # Ensure valid session
@@ -51,12 +51,9 @@ function addMessage(role, content) {
     messageDiv.classList.add('chat-message');
     messageDiv.classList.add(role === 'user' ? 'user-message' : 'assistant-message');
 
-    content = content.replace(/\(?(https?:\/\/[^\s]+)\)?/g, '<a href="$1" target="_blank" style="color: inherit;">$1</a>');
-    content = content.replace(/\n/g, '<br>');
-
     const contentWrapper = document.createElement('div');
     contentWrapper.classList.add('message-content');
-    contentWrapper.innerHTML = content;
+    contentWrapper.innerHTML = formatMessageContent(content);
 
     messageDiv.appendChild(contentWrapper);
     chatHistory.appendChild(messageDiv);
@@ -67,6 +64,41 @@ function addMessage(role, content) {
     return messageDiv;
 }
 
+function formatMessageContent(content) {
+    content = content.replace(/\(?(https?:\/\/[^\s]+)\)?/g, '<a href="$1" target="_blank" style="color: inherit;">$1</a>');
+    return content.replace(/\n/g, '<br>');
+}
+
+// Cập nhật nội dung tin nhắn đang stream
+function updateMessage(messageDiv, content) {
+    messageDiv.querySelector('.message-content').innerHTML = formatMessageContent(content);
+    chatHistory.scrollTop = chatHistory.scrollHeight;
+}
+
+// Đọc response server-sent events từ fetch, gọi onEvent(tên, dữ liệu JSON) cho từng sự kiện
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let eventName = 'message';
+            let data = '';
+            for (const line of rawEvent.split('\n')) {
+                if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                else if (line.startsWith('data:')) data += line.slice(5).trim();
+            }
+            if (data) onEvent(eventName, JSON.parse(data));
+        }
+    }
+}
+
 function ensureSuggestedQuestionsVisible() {
     if (typeof updateScrollShadows === 'function') {
         setTimeout(updateScrollShadows, 100);
@@ -175,7 +207,7 @@ async function sendMessage() {
     chatHistory.scrollTop = chatHistory.scrollHeight;
 
     try {
-        const response = await fetch("/chat", {
+        const response = await fetch("/chat/stream", {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -183,12 +215,11 @@ async function sendMessage() {
             body: JSON.stringify({ prompt: prompt })
         });
 
-        const indicator = document.getElementById('thinking-indicator');
-        if (indicator) {
-            chatHistory.removeChild(indicator);
-        }
-
         if (!response.ok) {
+            const indicator = document.getElementById('thinking-indicator');
+            if (indicator) {
+                chatHistory.removeChild(indicator);
+            }
             let errorMsg = `Lỗi ${response.status}: ${response.statusText}`;
             try {
                 const errorData = await response.json();
@@ -196,22 +227,53 @@ async function sendMessage() {
             } catch (e) { /* Ignore if body isn't JSON */ }
             addMessage('assistant', `⚠️ Xin lỗi, đã có lỗi xảy ra: ${errorMsg}`);
         } else {
-            const data = await response.json();
-            if (data.role === 'assistant') {
-                const messageDiv = addMessage('assistant', data.content);
-
-                if (data.content && currentVoiceMode) {
-                    console.log("Đang phát âm thanh cho phản hồi (chế độ giọng nói)");
-                    textToSpeech(data.content);
-                } else if (data.content) {
-                    console.log("Không phát âm thanh vì không ở chế độ nhập giọng nói");
+            // Tin nhắn trợ lý được tạo khi có token đầu tiên và cập nhật dần theo stream
+            let messageDiv = null;
+            let streamedText = '';
+            let productImages = null;
+            const showMessage = (content) => {
+                if (!messageDiv) {
+                    const indicator = document.getElementById('thinking-indicator');
+                    if (indicator) {
+                        chatHistory.removeChild(indicator);
+                    }
+                    messageDiv = addMessage('assistant', content);
+                } else {
+                    updateMessage(messageDiv, content);
                 }
-
-                voiceInputMode = false;
-
-                if (data.product_images) {
-                    displayProductImages(data.product_images);
+            };
+
+            await readEventStream(response, (event, data) => {
+                if (event === 'token') {
+                    streamedText += data.text;
+                    showMessage(streamedText);
+                } else if (event === 'product_images') {
+                    productImages = data.product_images;
+                } else if (event === 'done') {
+                    // Nội dung cuối cùng do server xác nhận (có thể khác phần đã stream nếu lỗi giữa chừng)
+                    showMessage(data.content || streamedText);
+                    console.log('Chat timings (ms):', data.timings);
+
+                    if (data.content && currentVoiceMode) {
+                        console.log("Đang phát âm thanh cho phản hồi (chế độ giọng nói)");
+                        textToSpeech(data.content);
+                    } else if (data.content) {
+                        console.log("Không phát âm thanh vì không ở chế độ nhập giọng nói");
+                    }
+
+                    voiceInputMode = false;
+
+                    if (productImages) {
+                        displayProductImages(productImages);
+                    }
+                } else if (event === 'error') {
+                    showMessage(`⚠️ Xin lỗi, đã có lỗi xảy ra: ${data.error}`);
                 }
+            });
+
+            const indicator = document.getElementById('thinking-indicator');
+            if (indicator) {
+                chatHistory.removeChild(indicator);
             }
         }
 
@@ -0,0 +1,189 @@
+import time
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+
+def bbox_iou(a: Optional[List[int]], b: Optional[List[int]]) -> float:
+    """IoU của hai bbox ``[x1, y1, x2, y2]``."""
+    if not a or not b:
+        return 0.0
+    ix1, iy1 = max(a[0], b[0]), max(a[1], b[1])
+    ix2, iy2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0, ix2 - ix1) * max(0, iy2 - iy1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+@dataclass
+class AuthStreamState:
+    """Trạng thái xác thực của một SID (một camera/kiosk)."""
+    busy: bool = False
+    done: bool = False
+    last_started: float = 0.0
+    # Kết quả nhận dạng gần nhất, dùng lại khi khuôn mặt gần như đứng yên
+    last_bbox: Optional[List[int]] = None
+    last_match: Any = None
+    last_recognized_at: float = 0.0
+    reuse_streak: int = 0
+    # Chuỗi frame liên tiếp khớp cùng một khách hàng
+    match_id: Optional[int] = None
+    match_streak: int = 0
+    stats: Dict[str, float] = field(default_factory=lambda: {
+        "received": 0, "dropped_busy": 0, "dropped_rate": 0, "dropped_done": 0,
+        "processed": 0, "recognized": 0, "reused": 0, "process_ms_total": 0.0,
+    })
+
+
+class AuthFrameGovernor:
+    """Điều tiết các frame ``video_frame`` gửi lên để xác thực khuôn mặt.
+
+    - Bỏ frame khi frame trước của cùng SID chưa xử lý xong, khi SID gửi nhanh hơn
+      ``max_fps``, hoặc khi số frame đang xử lý trên toàn server đã đạt ``max_concurrent``.
+    - Bỏ qua ArcFace và so khớp khi bbox gần như không đổi (IoU >= ``reuse_iou``) so
+      với lần nhận dạng trước; kết quả cũ được dùng lại tối đa ``reuse_max_frames`` frame
+      liên tiếp hoặc ``reuse_max_age`` giây.
+    - Chỉ báo xác thực thành công khi cùng một khách hàng khớp ``stable_frames`` frame
+      liên tiếp; sau đó luồng của SID kết thúc và mọi frame đến sau bị bỏ.
+    """
+
+    def __init__(self, max_fps: float = 4.0, max_concurrent: int = 4, reuse_iou: float = 0.85,
+                 reuse_max_frames: int = 1, reuse_max_age: float = 2.0, stable_frames: int = 3,
+                 stats_every: int = 10):
+        self.min_interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.max_concurrent = max(1, max_concurrent)
+        self.reuse_iou = reuse_iou
+        self.reuse_max_frames = max(0, reuse_max_frames)
+        self.reuse_max_age = reuse_max_age
+        self.stable_frames = max(1, stable_frames)
+        self.stats_every = max(1, stats_every)
+        self._states: Dict[str, AuthStreamState] = {}
+        self._lock = threading.Lock()
+        self._active = 0
+
+    @classmethod
+    def from_config(cls, config) -> "AuthFrameGovernor":
+        return cls(
+            max_fps=config.auth_max_fps,
+            max_concurrent=config.auth_max_concurrent,
+            reuse_iou=config.auth_reuse_iou,
+            reuse_max_frames=config.auth_reuse_max_frames,
+            reuse_max_age=config.auth_reuse_max_age,
+            stable_frames=config.auth_stable_frames,
+            stats_every=config.auth_stats_every,
+        )
+
+    def open(self, sid: str):
+        with self._lock:
+            self._states[sid] = AuthStreamState()
+
+    def close(self, sid: str):
+        with self._lock:
+            self._states.pop(sid, None)
+
+    def try_acquire(self, sid: str) -> Optional[str]:
+        """Đánh dấu SID đang xử lý một frame. Trả về None nếu được xử lý, ngược lại lý do bỏ frame."""
+        now = time.monotonic()
+        with self._lock:
+            state = self._states.get(sid)
+            if state is None:
+                return "unknown"
+            state.stats["received"] += 1
+            if state.done:
+                reason = "done"
+            elif state.busy:
+                reason = "busy"
+            elif now - state.last_started < self.min_interval:
+                reason = "rate"
+            elif self._active >= self.max_concurrent:
+                reason = "busy"
+            else:
+                state.busy = True
+                state.last_started = now
+                self._active += 1
+                return None
+            state.stats[f"dropped_{reason}"] += 1
+            return reason
+
+    def release(self, sid: str, elapsed: float):
+        with self._lock:
+            self._active = max(0, self._active - 1)
+            state = self._states.get(sid)
+            if state is None:
+                return
+            state.busy = False
+            state.stats["processed"] += 1
+            state.stats["process_ms_total"] += elapsed * 1000
+
+    def reusable_match(self, sid: str, bbox: List[int]) -> Any:
+        """Kết quả nhận dạng trước nếu khuôn mặt gần như chưa di chuyển, ngược lại None."""
+        with self._lock:
+            state = self._states.get(sid)
+            if (state is None or state.last_bbox is None or state.last_match is None
+                    or state.reuse_streak >= self.reuse_max_frames
+                    or time.monotonic() - state.last_recognized_at > self.reuse_max_age
+                    or bbox_iou(state.last_bbox, bbox) < self.reuse_iou):
+                return None
+            state.reuse_streak += 1
+            state.stats["reused"] += 1
+            return state.last_match
+
+    def remember(self, sid: str, bbox: List[int], match: Any):
+        """Lưu kết quả của một lần nhận dạng đầy đủ (ArcFace + so khớp)."""
+        with self._lock:
+            state = self._states.get(sid)
+            if state is None:
+                return
+            state.last_bbox = bbox
+            state.last_match = match
+            state.last_recognized_at = time.monotonic()
+            state.reuse_streak = 0
+            state.stats["recognized"] += 1
+
+    def observe(self, sid: str, match: Any) -> int:
+        """Cập nhật chuỗi khớp liên tiếp; trả về độ dài chuỗi (0 nếu frame không khớp ai)."""
+        with self._lock:
+            state = self._states.get(sid)
+            if state is None:
+                return 0
+            if isinstance(match, dict) and 'id' in match:
+                if match['id'] == state.match_id:
+                    state.match_streak += 1
+                else:
+                    state.match_id, state.match_streak = match['id'], 1
+                if state.match_streak >= self.stable_frames:
+                    state.done = True
+            else:
+                # Không khớp hoặc mất khuôn mặt: phải xác nhận lại từ đầu
+                state.match_id, state.match_streak = None, 0
+                if match is None:
+                    state.last_bbox, state.last_match = None, None
+            return state.match_streak
+
+    def is_confirmed(self, sid: str) -> bool:
+        with self._lock:
+            state = self._states.get(sid)
+            return state is not None and state.done
+
+    def should_report(self, sid: str) -> bool:
+        with self._lock:
+            state = self._states.get(sid)
+            return state is not None and state.stats["received"] % self.stats_every == 0
+
+    def stats(self, sid: Optional[str] = None) -> Dict[str, Any]:
+        """Thống kê backpressure của một SID, hoặc tổng hợp mọi SID."""
+        with self._lock:
+            states = [self._states[sid]] if sid in self._states else ([] if sid else list(self._states.values()))
+            totals: Dict[str, Any] = {key: 0 for key in AuthStreamState().stats}
+            for state in states:
+                for key, value in state.stats.items():
+                    totals[key] += value
+            processed = totals["processed"]
+            totals["avg_process_ms"] = round(totals.pop("process_ms_total") / processed, 1) if processed else 0.0
+            totals["drop_rate"] = round(
+                (totals["dropped_busy"] + totals["dropped_rate"] + totals["dropped_done"]) / totals["received"], 3
+            ) if totals["received"] else 0.0
+            if sid is None:
+                totals["streams"] = len(states)
+                totals["active"] = self._active
+            return totals
@@ -1,76 +1,106 @@
-import json
-import os
-from typing import List, Dict, Any, Optional
+import atexit
+import threading
+from collections import deque
+from typing import List, Dict, Any, Deque
 from datetime import datetime
 
+from .history_backends import create_backend, Operation
+
 
 class ChatHistory:
-    def __init__(self, history_file: str = "chat_histories.json", max_history_per_user: int = 3):
-        """Initializes ChatHistory to manage multiple user histories."""
+    def __init__(self, history_file: str = "chat_histories.json", max_history_per_user: int = 3,
+                 backend: str = "json", flush_interval: float = 1.0, compact_every: int = 1000):
+        """Initializes ChatHistory to manage multiple user histories.
+
+        Lịch sử được giữ trong bộ nhớ (mỗi user một deque giới hạn ``max_history_per_user``)
+        và ghi xuống backend theo kiểu write-behind: ``add_chat`` chỉ đưa thao tác vào bộ
+        đệm, luồng nền flush bộ đệm mỗi ``flush_interval`` giây. ``flush_interval <= 0``
+        ghi ngay trong ``add_chat``.
+        """
         self.history_file = history_file
-        self.max_history_per_user = max_history_per_user
+        self.max_history_per_user = max(1, max_history_per_user)
+        self.flush_interval = flush_interval
+        self.backend = create_backend(backend, history_file, self.max_history_per_user, compact_every)
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._pending: List[Operation] = []
+        self.flushes = 0
+        self.compactions = 0
         # Use a dictionary to store histories, keyed by user_key (e.g., user_id or 'anonymous')
-        self.histories: Dict[str, List[Dict[str, Any]]] = self._load_histories()
-        print(f"Chat histories loaded for keys: {list(self.histories.keys())}") # Debug log
+        self._histories: Dict[str, Deque[Dict[str, Any]]] = {
+            key: deque(entries, maxlen=self.max_history_per_user)
+            for key, entries in self.backend.load(self.max_history_per_user).items()
+        }
+        print(f"Chat histories loaded ({self.backend.name} backend) for {len(self._histories)} keys")
+
+        self._stop = threading.Event()
+        self._flusher = None
+        if self.flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="chat-history-flusher", daemon=True)
+            self._flusher.start()
+        atexit.register(self.close)
+
+    @property
+    def histories(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Bản sao lịch sử của mọi user dưới dạng list (định dạng của chat_histories.json)."""
+        with self._lock:
+            return {key: list(entries) for key, entries in self._histories.items()}
 
-    def _load_histories(self) -> Dict[str, List[Dict[str, Any]]]:
-        """Load all user chat histories from a single file."""
-        if os.path.exists(self.history_file):
-            try:
-                with open(self.history_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # Ensure data is a dictionary
-                    if isinstance(data, dict):
-                        return data
-                    else:
-                        print("Warning: History file does not contain a dictionary. Creating new.")
-                        # Optionally, try to migrate old list format if needed, or just start fresh
-                        return {}
-            except json.JSONDecodeError:
-                print(f"Error decoding JSON from {self.history_file}. Starting fresh.")
-                return {}
-            except Exception as e:
-                print(f"Error loading chat histories: {e}. Starting fresh.")
-                return {}
-        return {}
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
 
-    def _save_histories(self):
-        """Save all user chat histories to the file."""
-        try:
-            with open(self.history_file, 'w', encoding='utf-8') as f:
-                json.dump(self.histories, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"Error saving chat histories: {e}")
+    def flush(self, compact: bool = False):
+        """Ghi các thao tác đang chờ xuống backend; compaction khi backend yêu cầu (hoặc ``compact``)."""
+        with self._flush_lock:
+            with self._lock:
+                operations, self._pending = self._pending, []
+                # Snapshot lấy cùng lúc với bộ đệm nên khớp đúng trạng thái sau các thao tác này
+                snapshot = self.histories if (compact or self.backend.needs_compaction(len(operations))) else None
+            if not operations and snapshot is None:
+                return
+            if operations:
+                try:
+                    self.backend.write(operations)
+                    self.flushes += 1
+                except Exception as e:
+                    print(f"Error saving chat histories: {e}")
+                    # Giữ lại để lần flush sau ghi tiếp, theo đúng thứ tự
+                    with self._lock:
+                        self._pending = operations + self._pending
+                    return
+            if snapshot is not None:
+                try:
+                    self.backend.compact(snapshot)
+                    self.compactions += 1
+                except Exception as e:
+                    print(f"Error compacting chat histories: {e}")
 
     def add_chat(self, user_key: str, query: str, response: str):
         """Add a new chat entry for a specific user key."""
-        if user_key not in self.histories:
-            self.histories[user_key] = []
-
         chat_entry = {
             "timestamp": datetime.now().isoformat(),
             "query": query,
             "response": response
         }
-        self.histories[user_key].append(chat_entry)
-
-        # Keep only the last max_history entries for this user
-        if len(self.histories[user_key]) > self.max_history_per_user:
-            self.histories[user_key] = self.histories[user_key][-self.max_history_per_user:]
-
-        self._save_histories() # Save after modification
+        with self._lock:
+            if user_key not in self._histories:
+                self._histories[user_key] = deque(maxlen=self.max_history_per_user)
+            # deque có maxlen: tự bỏ mục cũ nhất, chỉ giữ max_history_per_user mục gần nhất
+            self._histories[user_key].append(chat_entry)
+            self._pending.append(("append", user_key, chat_entry))
 
+        if self.flush_interval <= 0:
+            self.flush()
 
-  
     def get_latest_chat(self, user_key: str) -> str:
-        """Lấy đoạn chat gần nhất theo timestamp cho một user cụ thể."""
-        user_history = self.histories.get(user_key, [])
-        if not user_history:
-            return ""
+        """Lấy đoạn chat gần nhất cho một user cụ thể (mục được thêm sau cùng)."""
+        with self._lock:
+            user_history = self._histories.get(user_key)
+            if not user_history:
+                return ""
+            latest_entry = user_history[-1]
 
-        # Sắp xếp theo timestamp giảm dần và lấy phần tử đầu tiên
-        latest_entry = max(user_history, key=lambda x: datetime.fromisoformat(x['timestamp']))
-        
         history_text = ""
         history_text += f"Q: {latest_entry['query']}\n"
         history_text += f"A: {latest_entry['response']}\n"
@@ -78,9 +108,30 @@ class ChatHistory:
 
     def clear_history(self, user_key: str):
         """Clear chat history for a specific user key."""
-        if user_key in self.histories:
-            self.histories[user_key] = []
-            self._save_histories()
-            print(f"Chat history cleared for user_key: {user_key}")
-        else:
-            print(f"No chat history found to clear for user_key: {user_key}") 
+        with self._lock:
+            if user_key not in self._histories:
+                print(f"No chat history found to clear for user_key: {user_key}")
+                return
+            self._histories[user_key] = deque(maxlen=self.max_history_per_user)
+            self._pending.append(("clear", user_key, None))
+        if self.flush_interval <= 0:
+            self.flush()
+        print(f"Chat history cleared for user_key: {user_key}")
+
+    def close(self):
+        """Dừng luồng flush, ghi nốt bộ đệm và compaction lần cuối."""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self.flush(compact=True)
+        self.backend.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": self.backend.name,
+                "users": len(self._histories),
+                "pending_writes": len(self._pending),
+                "flushes": self.flushes,
+                "compactions": self.compactions,
+            }
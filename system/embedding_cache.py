@@ -0,0 +1,149 @@
+import os
+import re
+import time
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import numpy as np
+
+
+def normalize_query_text(text: str) -> str:
+    """Chuẩn hóa câu truy vấn làm khóa cache: Unicode NFC, gộp khoảng trắng.
+
+    Không chuyển chữ thường vì PhoBERT phân biệt hoa thường, embedding sẽ khác.
+    """
+    text = unicodedata.normalize("NFC", text or "")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class EmbeddingCache:
+    """Cache embedding truy vấn gồm tầng LRU trong bộ nhớ và tầng SQLite tùy chọn trên đĩa.
+
+    Khóa cache là (tên model, câu truy vấn đã chuẩn hóa). Khi ``enabled`` là False
+    cache bị bỏ qua hoàn toàn (không đọc, không ghi).
+    """
+
+    def __init__(self, model_name: str, max_entries: int = 1024,
+                 disk_path: Optional[str] = None, max_disk_entries: int = 50000,
+                 enabled: bool = True):
+        self.model_name = model_name
+        self.max_entries = max(1, max_entries)
+        self.max_disk_entries = max(1, max_disk_entries)
+        self.enabled = enabled
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._disk: Optional[sqlite3.Connection] = None
+        if disk_path:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(disk_path)), exist_ok=True)
+                self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+                self._disk.execute("PRAGMA journal_mode=WAL")
+                self._disk.execute("""
+                    CREATE TABLE IF NOT EXISTS query_embeddings (
+                        key TEXT PRIMARY KEY,
+                        vector BLOB NOT NULL,
+                        last_used REAL NOT NULL
+                    )
+                """)
+                self._disk.execute("CREATE INDEX IF NOT EXISTS idx_query_embeddings_last_used ON query_embeddings(last_used)")
+                self._disk.commit()
+            except sqlite3.Error as e:
+                print(f"Error opening embedding cache at {disk_path}: {e}. Using memory cache only.")
+                self._disk = None
+
+    def _key(self, text: str) -> str:
+        raw = f"{self.model_name}\x00{normalize_query_text(text)}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        if not self.enabled:
+            return None
+        key = self._key(text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+
+            vector = self._disk_get(key)
+            if vector is not None:
+                self._memory_put(key, vector)
+                self.disk_hits += 1
+                return vector
+
+            self.misses += 1
+            return None
+
+    def put(self, text: str, vector) -> None:
+        if not self.enabled:
+            return
+        key = self._key(text)
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._memory_put(key, vector)
+            self._disk_put(key, vector)
+
+    def _memory_put(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _disk_get(self, key: str) -> Optional[np.ndarray]:
+        if self._disk is None:
+            return None
+        try:
+            row = self._disk.execute("SELECT vector FROM query_embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._disk.execute("UPDATE query_embeddings SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._disk.commit()
+            return np.frombuffer(row[0], dtype=np.float32).copy()
+        except sqlite3.Error as e:
+            print(f"Error reading embedding cache: {e}")
+            return None
+
+    def _disk_put(self, key: str, vector: np.ndarray):
+        if self._disk is None:
+            return
+        try:
+            self._disk.execute(
+                "INSERT OR REPLACE INTO query_embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                (key, vector.tobytes(), time.time())
+            )
+            # Giữ tầng đĩa trong giới hạn: xóa các mục lâu không dùng nhất
+            self._disk.execute("""
+                DELETE FROM query_embeddings WHERE key IN (
+                    SELECT key FROM query_embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_disk_entries,))
+            self._disk.commit()
+        except sqlite3.Error as e:
+            print(f"Error writing embedding cache: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._disk is not None:
+                self._disk.execute("DELETE FROM query_embeddings")
+                self._disk.commit()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "memory_entries": len(self._memory),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+        }
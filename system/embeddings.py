@@ -1,27 +1,84 @@
-from langchain_core.embeddings import Embeddings 
+from langchain_core.embeddings import Embeddings
 from transformers import AutoModel, AutoTokenizer
+import numpy as np
 import torch
-from typing import List
+from typing import List, Optional
+from .embedding_cache import EmbeddingCache
+from .inference_pool import run_inference, MODEL_POOL
 
 class PhoBERTEmbeddings(Embeddings):
-    def __init__(self, model_name: str = "vinai/phobert-base"):
+    def __init__(self, model_name: str = "vinai/phobert-base", batch_size: int = 32,
+                 query_cache: Optional[EmbeddingCache] = None):
+        self.model_name = model_name
+        self.query_cache = query_cache
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
         self.model = AutoModel.from_pretrained(model_name)
-        self.max_length = 256 
+        self.model.eval()
+        self.max_length = 256
+        self.batch_size = max(1, batch_size)
+
+    @staticmethod
+    def _mean_pool(last_hidden_state: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        """Mean pooling chỉ trên các token thật, bỏ qua token padding."""
+        mask = attention_mask.unsqueeze(-1).to(last_hidden_state.dtype)
+        summed = (last_hidden_state * mask).sum(dim=1)
+        counts = mask.sum(dim=1).clamp(min=1e-9)
+        return summed / counts
+
+    def _encode_batch(self, encodings: List[List[int]]) -> np.ndarray:
+        """Pad một nhóm input_ids đã tokenize và chạy một lượt forward."""
+        batch = self.tokenizer.pad({"input_ids": encodings}, padding=True, return_tensors="pt")
+        with torch.no_grad():
+            outputs = self.model(**batch)
+        pooled = self._mean_pool(outputs.last_hidden_state, batch["attention_mask"])
+        return pooled.numpy().astype(np.float32, copy=False)
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        embeddings = []
-        for text in texts:
-            inputs = self.tokenizer(text, return_tensors="pt", truncation=True, padding=True, max_length=self.max_length)
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-            mean_emb = outputs.last_hidden_state.mean(dim=1).squeeze(0).numpy() 
-            embeddings.append(mean_emb.tolist())
+        """Embed danh sách văn bản theo batch (giao diện ``Embeddings`` của LangChain: list các list float)."""
+        return self.embed_documents_array(texts).tolist()
+
+    def embed_documents_array(self, texts: List[str]) -> np.ndarray:
+        """Như ``embed_documents`` nhưng trả về mảng float32 có shape (n, dim), dùng cho các đường batch nội bộ.
+
+        Văn bản được sắp xếp theo độ dài token trước khi chia batch để giảm padding,
+        sau đó kết quả được trả về đúng thứ tự ban đầu.
+        """
+        return run_inference(MODEL_POOL, self._embed_documents, texts)
+
+    def _embed_documents(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.model.config.hidden_size), dtype=np.float32)
+
+        encodings = self.tokenizer(
+            list(texts), truncation=True, max_length=self.max_length, padding=False
+        )["input_ids"]
+        order = sorted(range(len(encodings)), key=lambda i: len(encodings[i]))
+
+        embeddings = np.empty((len(texts), self.model.config.hidden_size), dtype=np.float32)
+        for start in range(0, len(order), self.batch_size):
+            batch_idx = order[start:start + self.batch_size]
+            embeddings[batch_idx] = self._encode_batch([encodings[i] for i in batch_idx])
         return embeddings
 
     def embed_query(self, text: str) -> List[float]:
+        if self.query_cache is not None:
+            cached = self.query_cache.get(text)
+            if cached is not None:
+                return cached.tolist()
+
+        mean_emb = run_inference(MODEL_POOL, self._encode_query, text)
+
+        if self.query_cache is not None:
+            self.query_cache.put(text, mean_emb)
+        return mean_emb.tolist()
+
+    def warmup(self, text: str = "cà phê sữa đá") -> None:
+        """Chạy một lượt forward (query và batch tài liệu) để khởi tạo kernel, không ghi cache."""
+        self._encode_query(text)
+        self._embed_documents([text, text + " ít đường"])
+
+    def _encode_query(self, text: str) -> np.ndarray:
         inputs = self.tokenizer(text, return_tensors="pt", truncation=True, padding=True, max_length=self.max_length)
         with torch.no_grad():
             outputs = self.model(**inputs)
-        mean_emb = outputs.last_hidden_state.mean(dim=1).squeeze(0).numpy()
-        return mean_emb.tolist() 
\ No newline at end of file
+        return self._mean_pool(outputs.last_hidden_state, inputs["attention_mask"]).squeeze(0).numpy()
@@ -1,13 +1,15 @@
 import cv2
 import numpy as np
 import sqlite3
-import json
 import os
 from pathlib import Path
+import onnxruntime
 from insightface.model_zoo import get_model
 from insightface.model_zoo.arcface_onnx import ArcFaceONNX
 from insightface.utils.face_align import norm_crop
 from insightface.app.common import Face
+from db_pool import default_db_path
+from .face_gallery import get_face_gallery
 BASE_DIR = Path(os.path.dirname(__file__)).parent  
 
 class DetectedFace:
@@ -16,11 +18,29 @@ class DetectedFace:
         self.landmarks = landmarks
         self.confidence = confidence
 
+def create_session_options(intra_op_threads: int = 0, inter_op_threads: int = 1) -> onnxruntime.SessionOptions:
+    """SessionOptions cho các session ONNX dùng chung giữa mọi kết nối.
+
+    Các session được gọi song song từ nhiều worker của pool suy luận, nên mỗi lần chạy
+    chỉ nên dùng vài thread: ``intra_op_threads = 0`` để ONNX Runtime tự chọn.
+    """
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = max(0, intra_op_threads)
+    options.inter_op_num_threads = max(0, inter_op_threads)
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return options
+
 class ArcFaceRecognizer:
-    def __init__(self):
+    def __init__(self, session_options=None, providers=None):
         model_dir = os.path.join(BASE_DIR, 'models')
         recog_model_path = os.path.join(model_dir, 'w600k_r50.onnx')
-        self._recognizer = ArcFaceONNX(recog_model_path)
+        session = onnxruntime.InferenceSession(
+            recog_model_path,
+            sess_options=session_options,
+            providers=providers or onnxruntime.get_available_providers()
+        )
+        self._recognizer = ArcFaceONNX(recog_model_path, session=session)
         self._recognizer.prepare(ctx_id=0)  # Dùng GPU nếu có
 
     def _convert_input_face(self, face: DetectedFace) -> Face:
@@ -53,11 +73,32 @@ class ArcFaceRecognizer:
         features = self._recognizer.get_feat(aligned_face)
         return features
 
+    def infer_batch(self, images, faces) -> np.ndarray:
+        """Căn chỉnh từng khuôn mặt rồi chạy ArcFace một lần cho cả batch; trả về (n, dim)."""
+        aligned_faces = [
+            norm_crop(image, self._convert_input_face(face).kps)
+            for image, face in zip(images, faces)
+        ]
+        return self._recognizer.get_feat(aligned_faces)
+
+    def warmup(self):
+        """Chạy ArcFace một lần trên ảnh khuôn mặt rỗng đã căn chỉnh."""
+        width, height = self._recognizer.input_size
+        self._recognizer.get_feat(np.zeros((height, width, 3), dtype=np.uint8))
+
 
 class FaceAuthTransformer:
-    def __init__(self, model_name="det_10g.onnx"):
-        """Initialize Face detection and recognition models."""
+    def __init__(self, model_name="det_10g.onnx", intra_op_threads: int = 0, inter_op_threads: int = 1,
+                 db_path=None):
+        """Initialize Face detection and recognition models.
+
+        Một instance (lấy qua ``model_registry``) được dùng chung cho mọi kết nối; các
+        session ONNX Runtime an toàn khi gọi ``run`` đồng thời từ nhiều thread.
+        ``db_path`` là database chứa gallery khuôn mặt (mặc định ``default_db_path()``).
+        """
         print("🟢 Initializing FaceAuthTransformer...")
+        self.db_path = db_path
+        session_options = create_session_options(intra_op_threads, inter_op_threads)
 
         model_dir = os.path.join(BASE_DIR, 'models')
         det_model_path = os.path.join(model_dir, model_name)
@@ -66,78 +107,121 @@ class FaceAuthTransformer:
             raise FileNotFoundError(f"Detection model not found at {det_model_path}")
         
         print(f"📦 Loading RetinaFace model from {det_model_path}")
-        self.det_model = get_model(det_model_path)
+        self.det_model = get_model(det_model_path, sess_options=session_options,
+                                   providers=onnxruntime.get_available_providers())
         self.det_model.prepare(ctx_id=-1, input_size=(640, 640), det_thresh=0.5)
         print("✅ RetinaFace loaded successfully.")
 
-        self.arcface_recognizer = ArcFaceRecognizer()
+        self.arcface_recognizer = ArcFaceRecognizer(session_options)
         print("✅ ArcFace Recognizer loaded successfully.")
 
-    def recognize_face(self, frame):
-        """Detect and recognize face in a single frame."""
-        result = {'match': None, 'bbox': None, 'confidence': None, 'embedding': None}
+    def warmup(self):
+        """Chạy RetinaFace trên một frame camera rỗng và ArcFace một lần để khởi tạo session."""
+        self.detect_face(np.zeros((480, 640, 3), dtype=np.uint8))
+        self.arcface_recognizer.warmup()
+
+    def detect_face(self, frame):
+        """Detect the most confident face in a frame.
 
+        Trả về ``(face, bbox, confidence)`` với ``bbox = [x1, y1, x2, y2]``, hoặc None nếu
+        không có khuôn mặt đạt ngưỡng.
+        """
         if frame is None:
-            return result
+            return None
+
+        # Detect faces using RetinaFace
+        bboxes, landmarks = self.det_model.detect(frame, max_num=0, metric='default')
+        if len(bboxes) == 0:
+            return None
+        order = np.argsort(bboxes[:, 4])[::-1]
+        best = order[0]
+        conf = float(bboxes[best][4])
+        if conf < self.det_model.det_thresh:
+            return None  # No valid face detected
+
+        # Extract the bounding box and landmarks
+        x1, y1, x2, y2 = bboxes[best][:4].astype(int)
+        bbox = [int(x1), int(y1), int(x2), int(y2)]
+
+        # Create a DetectedFace object with landmarks and bbox
+        face_landmarks = landmarks[best]
+        if face_landmarks.ndim == 2:
+            face_landmarks = face_landmarks.flatten()
 
         try:
-            # Detect faces using RetinaFace
-            bboxes, landmarks = self.det_model.detect(frame, max_num=0, metric='default')
-            bboxes = sorted(bboxes, key=lambda b: b[4], reverse=True)
-            x1, y1, x2, y2, conf = bboxes[0]
-            if conf < self.det_model.det_thresh:
-                return result  # No valid face detected
-
-            # Extract the bounding box and landmarks
-            x1, y1, x2, y2 = bboxes[0][:4].astype(int)
-            result['bbox'] = [int(x1), int(y1), int(x2), int(y2)]
-            result['confidence'] = float(conf)
-
-            # Create a DetectedFace object with landmarks and bbox
-            landmarks = landmarks[0]
-            if landmarks.ndim == 2:
-                landmarks = landmarks.flatten()
-
-            try:
-                face = DetectedFace(
-                    bbox={"x": float(x1), "y": float(y1), "w": float(x2 - x1), "h": float(y2 - y1)},
-                    landmarks={
-                        "left_eye": (float(landmarks[0]), float(landmarks[1])),
-                        "right_eye": (float(landmarks[2]), float(landmarks[3])),
-                        "nose": (float(landmarks[4]), float(landmarks[5])),
-                        "left_mouth": (float(landmarks[6]), float(landmarks[7])),
-                        "right_mouth": (float(landmarks[8]), float(landmarks[9])),
-                    },
-                    confidence=float(conf)
-                )
-
-            except Exception as e:
-                print(f"❌ Lỗi khi tạo landmark cho ảnh : {e}")
-                return result
+            face = DetectedFace(
+                bbox={"x": float(x1), "y": float(y1), "w": float(x2 - x1), "h": float(y2 - y1)},
+                landmarks={
+                    "left_eye": (float(face_landmarks[0]), float(face_landmarks[1])),
+                    "right_eye": (float(face_landmarks[2]), float(face_landmarks[3])),
+                    "nose": (float(face_landmarks[4]), float(face_landmarks[5])),
+                    "left_mouth": (float(face_landmarks[6]), float(face_landmarks[7])),
+                    "right_mouth": (float(face_landmarks[8]), float(face_landmarks[9])),
+                },
+                confidence=conf
+            )
+        except Exception as e:
+            print(f"❌ Lỗi khi tạo landmark cho ảnh : {e}")
+            return None
+
+        return face, bbox, conf
 
-            # Crop face region for recognition
-            image = frame
+    def embed(self, frame, face: DetectedFace):
+        """Tính embedding ArcFace (1 chiều) cho khuôn mặt đã detect; None nếu không hợp lệ."""
+        # Extract features using ArcFace
+        embedding = self.arcface_recognizer.infer(frame, face)
+        print(f"📸 Embedding từ frame: shape = {embedding.shape}")
 
-            # Extract features using ArcFace
-            embedding = self.arcface_recognizer.infer(image, face)
-            print(f"📸 Embedding từ frame: shape = {embedding.shape}")
-            
-            if embedding is not None and len(embedding.shape) == 2 and embedding.shape[0] == 1:
-                embedding = embedding.squeeze(0)
+        if embedding is not None and len(embedding.shape) == 2 and embedding.shape[0] == 1:
+            embedding = embedding.squeeze(0)
 
-            # Kiểm tra embedding hợp lệ
-            if embedding is None or embedding.ndim != 1 or np.linalg.norm(embedding) == 0:
+        # Kiểm tra embedding hợp lệ
+        if embedding is None or embedding.ndim != 1 or np.linalg.norm(embedding) == 0:
+            print("❌ Embedding từ frame không hợp lệ.")
+            return None
+        return embedding
+
+    def embed_batch(self, frames, faces):
+        """Embedding ArcFace cho nhiều (frame, khuôn mặt) trong một lần chạy session.
+
+        Trả về danh sách cùng độ dài, phần tử None nếu embedding không hợp lệ.
+        """
+        if not frames:
+            return []
+        features = np.atleast_2d(self.arcface_recognizer.infer_batch(frames, faces))
+        embeddings = []
+        for embedding in features:
+            if embedding.ndim != 1 or np.linalg.norm(embedding) == 0:
                 print("❌ Embedding từ frame không hợp lệ.")
-                result['match'] = False
-                return result
+                embeddings.append(None)
+            else:
+                embeddings.append(embedding)
+        return embeddings
+
+    def recognize(self, frame, face: DetectedFace):
+        """Tính embedding ArcFace cho khuôn mặt đã detect và so khớp với database.
+
+        Trả về ``(match, embedding)``: ``match`` là dict khách hàng, False nếu không khớp
+        hoặc embedding không hợp lệ.
+        """
+        embedding = self.embed(frame, face)
+        if embedding is None:
+            return False, None
 
-            # Lưu embedding vào kết quả
-            result['embedding'] = embedding
+        # Compare with database
+        match_info = find_matching_face(embedding, db_path=self.db_path)
+        return (match_info if match_info else False), embedding
 
-            # Compare with database
-            match_info = find_matching_face(embedding)
-            result['match'] = match_info if match_info else False
+    def recognize_face(self, frame):
+        """Detect and recognize face in a single frame."""
+        result = {'match': None, 'bbox': None, 'confidence': None, 'embedding': None}
 
+        try:
+            detection = self.detect_face(frame)
+            if detection is None:
+                return result
+            face, result['bbox'], result['confidence'] = detection
+            result['match'], result['embedding'] = self.recognize(frame, face)
             return result
 
         except Exception as e:
@@ -146,70 +230,36 @@ class FaceAuthTransformer:
 
     def get_face_embedding(self, frame):
         """Get face embedding from a frame without matching with database."""
-        result = self.recognize_face(frame)
-        return result.get('embedding')
+        try:
+            detection = self.detect_face(frame)
+            if detection is None:
+                return None
+            return self.embed(frame, detection[0])
+        except Exception as e:
+            print(f"❌ Error during face embedding: {e}")
+            return None
 
 
 
-def find_matching_face(embedding, threshold=0.21):
-    conn = None
-    best_match_info = None
-    max_similarity = -1.0
+def find_matching_face(embedding, threshold=0.21, db_path=None):
+    """So khớp embedding với gallery khuôn mặt trong bộ nhớ (xem ``FaceGallery``).
 
-    db_path = os.path.join(BASE_DIR, 'Database.db')
+    ``db_path`` là database đã cấu hình (``config.db_path``); None thì dùng ``default_db_path()``.
+    """
+    db_path = db_path or default_db_path()
     try:
         if not os.path.exists(db_path):
             print(f"❌ Database not found at {db_path}")
             return None
 
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT embedding, name, id FROM customers WHERE embedding IS NOT NULL")
-        results = cursor.fetchall()
-
         if embedding is None or embedding.ndim != 1 or embedding.size == 0:
             print("❌ Embedding từ frame không hợp lệ.")
             return None
 
-        for db_embedding_str, name, id in results:
-            try:
-                if not db_embedding_str:
-                    continue
-
-                db_embeddings = json.loads(db_embedding_str)
-            
-                for idx, emb in enumerate(db_embeddings):
-                    db_embedding = np.array(emb, dtype=np.float32)
-
-
-                    if db_embedding.ndim != 1 or db_embedding.size == 0:
-                        print("⚠️ DB embedding bị lỗi hoặc rỗng.")
-                        continue
-
-                    if embedding.shape != db_embedding.shape:
-                        print(f"⚠️ Không khớp chiều embedding: frame={embedding.shape}, db={db_embedding.shape} (name={name}, id={id})")
-                        continue
-
-                    similarity = np.dot(embedding, db_embedding) / (
-                        np.linalg.norm(embedding) * np.linalg.norm(db_embedding)
-                    )
-                    similarity = float(similarity)
-
-                    if similarity > max_similarity:
-                        max_similarity = similarity
-                        best_match_info = {'name': name, 'id': id, 'similarity': similarity}
-
-            except json.JSONDecodeError:
-                print("❌ Lỗi khi giải mã JSON embedding.")
-                continue
-            except Exception as e:
-                print(f"❌ Lỗi khi xử lý embedding trong DB: {e}")
-                continue
-
-        if best_match_info and max_similarity >= threshold:
-            print(f"🎯 Match found: {best_match_info['name']} (ID: {best_match_info['id']}), Similarity: {max_similarity:.4f}")
-            return {'name': best_match_info['name'], 'id': best_match_info['id']}
+        match = get_face_gallery(db_path).match(embedding, threshold)
+        if match:
+            print(f"🎯 Match found: {match['name']} (ID: {match['id']}), Similarity: {match['similarity']:.4f}")
+            return {'name': match['name'], 'id': match['id']}
 
         print("🔍 Không tìm thấy match nào đạt ngưỡng.")
         return None
@@ -220,6 +270,3 @@ def find_matching_face(embedding, threshold=0.21):
     except Exception as e:
         print(f"Unexpected error: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
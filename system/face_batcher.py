@@ -0,0 +1,102 @@
+import time
+import queue
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from .inference_pool import InferencePool
+
+
+class _PendingEmbedding:
+    __slots__ = ("frame", "face", "done", "embedding", "error", "enqueued_at")
+
+    def __init__(self, frame, face):
+        self.frame = frame
+        self.face = face
+        self.done = threading.Event()
+        self.embedding: Optional[np.ndarray] = None
+        self.error: Optional[BaseException] = None
+        self.enqueued_at = time.monotonic()
+
+
+class FaceEmbeddingBatcher:
+    """Gom các yêu cầu ArcFace của mọi SID thành micro-batch.
+
+    Mỗi ``embed`` đưa (frame, khuôn mặt) vào hàng đợi chung rồi chờ. Các collector lấy
+    yêu cầu đầu tiên, gom thêm trong tối đa ``window_ms`` (hoặc đến ``max_batch``) rồi
+    chạy một lần ``embed_batch`` trên ``pool``. Trong lúc một batch đang chạy, yêu cầu mới
+    tiếp tục dồn lại nên batch tự lớn lên khi tải cao. Số collector bằng số worker của
+    pool để các batch vẫn chạy song song.
+    """
+
+    def __init__(self, model_getter: Callable[[], Any], pool: InferencePool,
+                 max_batch: int = 16, window_ms: float = 5.0):
+        self.model_getter = model_getter
+        self.pool = pool
+        self.max_batch = max(1, max_batch)
+        self.window = max(0.0, window_ms) / 1000.0
+        self._queue: "queue.Queue[_PendingEmbedding]" = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.max_batch_seen = 0
+        self.wait_seconds_total = 0.0
+        self._collectors = [
+            threading.Thread(target=self._collect_loop, name=f"face-batcher-{i}", daemon=True)
+            for i in range(pool.workers)
+        ]
+        for collector in self._collectors:
+            collector.start()
+
+    def embed(self, frame, face) -> Optional[np.ndarray]:
+        """Embedding của một khuôn mặt đã detect (chặn đến khi batch chứa nó chạy xong)."""
+        pending = _PendingEmbedding(frame, face)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.embedding
+
+    def _collect_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._run_batch(batch)
+
+    def _run_batch(self, batch: List[_PendingEmbedding]):
+        started = time.monotonic()
+        try:
+            model = self.model_getter()
+            embeddings = self.pool.run(model.embed_batch, [p.frame for p in batch], [p.face for p in batch])
+            for pending, embedding in zip(batch, embeddings):
+                pending.embedding = embedding
+        except Exception as e:
+            print(f"❌ Error during batched face embedding ({len(batch)} faces): {e}")
+            for pending in batch:
+                pending.error = e
+        finally:
+            with self._stats_lock:
+                self.batches += 1
+                self.items += len(batch)
+                self.max_batch_seen = max(self.max_batch_seen, len(batch))
+                self.wait_seconds_total += sum(started - p.enqueued_at for p in batch)
+            for pending in batch:
+                pending.done.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "batches": self.batches,
+                "items": self.items,
+                "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+                "max_batch_size": self.max_batch_seen,
+                "avg_wait_ms": round(self.wait_seconds_total / self.items * 1000, 2) if self.items else 0.0,
+                "queued": self._queue.qsize(),
+            }
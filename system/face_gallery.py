@@ -0,0 +1,254 @@
+import os
+import json
+import struct
+import hashlib
+import argparse
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from db_pool import get_pool
+
+# Định dạng nhị phân của cột Customers.embedding: magic, số hàng, số chiều, rồi float32 little-endian
+_MAGIC = b"FEMB"
+_HEADER = struct.Struct("<4sII")
+
+def encode_embeddings(embeddings: np.ndarray) -> bytes:
+    """Mã hóa ma trận embedding (n, dim) thành BLOB float32."""
+    matrix = np.atleast_2d(np.asarray(embeddings, dtype="<f4"))
+    return _HEADER.pack(_MAGIC, matrix.shape[0], matrix.shape[1]) + matrix.tobytes()
+
+
+def decode_embeddings(value: Any) -> Optional[np.ndarray]:
+    """Giải mã cột embedding: BLOB nhị phân mới hoặc chuỗi JSON (danh sách vector) cũ."""
+    if value is None:
+        return None
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        raw = bytes(value)
+        if raw[:4] == _MAGIC:
+            _, rows, dim = _HEADER.unpack_from(raw)
+            return np.frombuffer(raw, dtype="<f4", count=rows * dim, offset=_HEADER.size).reshape(rows, dim).astype(np.float32)
+        value = raw.decode("utf-8")
+    if not value:
+        return None
+    return np.atleast_2d(np.asarray(json.loads(value), dtype=np.float32))
+
+
+def _l2_normalize(matrix: np.ndarray) -> np.ndarray:
+    return matrix / (np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-8)
+
+
+class FaceGallery:
+    """Ma trận embedding khuôn mặt (đã chuẩn hóa L2) của mọi khách hàng đã đăng ký, giữ trong bộ nhớ.
+
+    So khớp một khuôn mặt là một phép nhân ma trận-vector; khi số embedding vượt
+    ``faiss_threshold`` thì dùng index FAISS HNSW theo inner product. Gallery được nạp
+    từ database một lần, cập nhật từng phần qua ``add`` khi đăng ký, và chỉ nạp lại khi
+    bảng Customers bị thay đổi từ nơi khác.
+    """
+
+    def __init__(self, db_path: str, faiss_threshold: int = 5000):
+        self.db_path = db_path
+        self.pool = get_pool(db_path)
+        self.faiss_threshold = max(1, faiss_threshold)
+        self._lock = threading.Lock()
+        # (ma trận embedding, customer id của từng hàng) được thay cùng lúc để luồng đọc luôn thấy cặp khớp nhau
+        self._state: Tuple[Optional[np.ndarray], np.ndarray] = (None, np.zeros(0, dtype=np.int64))
+        self._names: Dict[int, str] = {}
+        self._index = None
+        self._loaded = False
+        self._file_version = None
+        self._signature = None
+        self.reloads = 0
+        self.matches = 0
+
+    def _table_signature(self) -> str:
+        """Dấu thay đổi của gallery: checksum của id, tên và độ dài embedding các khách hàng có embedding.
+
+        Chỉ đọc cột nhỏ (không đọc BLOB) và không cần thêm bảng hay trigger vào database; phát
+        hiện được thêm/xóa khách hàng, đổi tên và đổi số embedding. Ghi đè embedding cùng kích
+        thước tại chỗ không bị phát hiện, nhưng ứng dụng không sửa embedding đã lưu.
+        """
+        digest = hashlib.sha1()
+        for row in self.pool.fetchall(
+                "SELECT id, name, length(embedding) FROM customers WHERE embedding IS NOT NULL ORDER BY id"):
+            digest.update(repr(row).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _ensure_loaded(self):
+        file_version = self.pool.file_version()
+        if self._loaded and file_version == self._file_version:
+            return
+        with self._lock:
+            if self._loaded and file_version == self._file_version:
+                return
+            signature = self._table_signature()
+            if not self._loaded or signature != self._signature:
+                self._load()
+                signature = self._table_signature()
+            self._signature = signature
+            self._file_version = self.pool.file_version()
+
+    def _load(self):
+        """Đọc toàn bộ embedding từ database (chỉ đọc). Gọi khi đang giữ ``_lock``."""
+        rows = self.pool.fetchall("SELECT id, name, embedding FROM customers WHERE embedding IS NOT NULL")
+        blocks: List[np.ndarray] = []
+        ids: List[int] = []
+        names: Dict[int, str] = {}
+        legacy = 0
+        dim = None
+        for customer_id, name, value in rows:
+            try:
+                matrix = decode_embeddings(value)
+            except (ValueError, json.JSONDecodeError) as e:
+                print(f"❌ Lỗi khi giải mã embedding của khách hàng {customer_id}: {e}")
+                continue
+            if matrix is None or matrix.size == 0:
+                continue
+            dim = dim or matrix.shape[1]
+            if matrix.shape[1] != dim:
+                print(f"⚠️ Không khớp chiều embedding: gallery={dim}, db={matrix.shape[1]} (name={name}, id={customer_id})")
+                continue
+            if isinstance(value, str):
+                legacy += 1
+            blocks.append(matrix)
+            ids.extend([customer_id] * matrix.shape[0])
+            names[customer_id] = name
+
+        self._names = names
+        self._state = (_l2_normalize(np.vstack(blocks)) if blocks else None, np.asarray(ids, dtype=np.int64))
+        self._rebuild_index()
+        self._loaded = True
+        self.reloads += 1
+        print(f"🟢 Face gallery loaded: {len(names)} customers, {len(ids)} embeddings")
+
+        if legacy:
+            print(f"⚠️ {legacy} embedding vẫn ở định dạng JSON; chạy `python -m system.face_gallery --migrate-legacy` để chuyển sang nhị phân")
+
+    def _rebuild_index(self):
+        matrix = self._state[0]
+        if matrix is None or len(matrix) < self.faiss_threshold:
+            self._index = None
+            return
+        index = faiss.IndexHNSWFlat(matrix.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efSearch = 64
+        index.add(np.ascontiguousarray(matrix))
+        self._index = index
+
+    def add(self, customer_id: int, name: str, embeddings: Iterable[np.ndarray]):
+        """Thêm embedding của khách hàng vừa đăng ký mà không nạp lại cả gallery."""
+        vectors = [np.asarray(e, dtype=np.float32).reshape(-1) for e in embeddings if e is not None]
+        if not vectors:
+            return
+        block = _l2_normalize(np.vstack(vectors))
+        with self._lock:
+            matrix, customer_ids = self._state
+            if matrix is not None and block.shape[1] != matrix.shape[1]:
+                print(f"⚠️ Không khớp chiều embedding khi thêm khách hàng {customer_id}, bỏ qua")
+                return
+            self._names[customer_id] = name
+            # Ghép thành ma trận mới để các luồng đang so khớp vẫn dùng được ma trận cũ
+            self._state = (
+                block if matrix is None else np.vstack([matrix, block]),
+                np.concatenate([customer_ids, np.full(len(block), customer_id, dtype=np.int64)])
+            )
+            if self._index is not None:
+                self._index.add(np.ascontiguousarray(block))
+            else:
+                self._rebuild_index()
+            self._signature = self._table_signature()
+            self._file_version = self.pool.file_version()
+        print(f"🟢 Face gallery: added {len(block)} embeddings for customer {customer_id}")
+
+    def match(self, embedding: np.ndarray, threshold: float = 0.21) -> Optional[Dict[str, Any]]:
+        """Khách hàng có embedding gần nhất (cosine) nếu đạt ngưỡng, ngược lại None."""
+        self._ensure_loaded()
+        matrix, customer_ids = self._state
+        if matrix is None:
+            return None
+        query = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if query.shape[0] != matrix.shape[1]:
+            print(f"⚠️ Không khớp chiều embedding: frame={query.shape[0]}, gallery={matrix.shape[1]}")
+            return None
+        query = query / (np.linalg.norm(query) + 1e-8)
+
+        index = self._index
+        if index is not None:
+            # HNSW không an toàn khi vừa thêm vừa tìm, nên tìm kiếm dưới cùng khóa với ``add``
+            with self._lock:
+                similarities, positions = index.search(query[None, :], 1)
+            best, similarity = int(positions[0][0]), float(similarities[0][0])
+            if best < 0 or best >= len(customer_ids):
+                return None
+        else:
+            similarities = matrix @ query
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+
+        self.matches += 1
+        customer_id = int(customer_ids[best])
+        if similarity < threshold:
+            return None
+        return {'name': self._names.get(customer_id), 'id': customer_id, 'similarity': similarity}
+
+    def stats(self) -> Dict[str, Any]:
+        matrix = self._state[0]
+        return {
+            "customers": len(self._names),
+            "embeddings": 0 if matrix is None else len(matrix),
+            "index": "hnsw" if self._index is not None else "matrix",
+            "reloads": self.reloads,
+            "matches": self.matches,
+        }
+
+
+_galleries: Dict[str, FaceGallery] = {}
+_galleries_lock = threading.Lock()
+
+
+def get_face_gallery(db_path: str) -> FaceGallery:
+    """Gallery dùng chung cho file database (mỗi đường dẫn một gallery)."""
+    key = os.path.abspath(db_path)
+    gallery = _galleries.get(key)
+    if gallery is None:
+        with _galleries_lock:
+            gallery = _galleries.get(key)
+            if gallery is None:
+                gallery = FaceGallery(key, faiss_threshold=int(os.getenv("FACE_GALLERY_FAISS_THRESHOLD", 5000)))
+                _galleries[key] = gallery
+    return gallery
+
+
+def migrate_legacy_embeddings(db_path: str) -> int:
+    """Chuyển các embedding JSON cũ trong Customers sang BLOB nhị phân. Trả về số hàng đã chuyển."""
+    pool = get_pool(db_path)
+    rows = pool.fetchall("SELECT id, embedding FROM customers WHERE typeof(embedding) = 'text'")
+    legacy: List[Tuple[bytes, int]] = []
+    for customer_id, value in rows:
+        try:
+            matrix = decode_embeddings(value)
+        except (ValueError, json.JSONDecodeError) as e:
+            print(f"❌ Lỗi khi giải mã embedding của khách hàng {customer_id}: {e}")
+            continue
+        if matrix is not None and matrix.size:
+            legacy.append((encode_embeddings(matrix), customer_id))
+    if legacy:
+        with pool.connection(readonly=False) as conn:
+            conn.executemany("UPDATE customers SET embedding = ? WHERE id = ?", legacy)
+    print(f"Đã chuyển {len(legacy)} embedding JSON sang định dạng nhị phân")
+    return len(legacy)
+
+
+if __name__ == "__main__":
+    from db_pool import default_db_path
+
+    parser = argparse.ArgumentParser(description="Bảo trì gallery khuôn mặt trong bảng Customers")
+    parser.add_argument("--db", default=default_db_path(), help="Đường dẫn database")
+    parser.add_argument("--migrate-legacy", action="store_true", help="Chuyển embedding JSON cũ sang BLOB nhị phân")
+    args = parser.parse_args()
+    if args.migrate_legacy:
+        migrate_legacy_embeddings(args.db)
+    else:
+        parser.print_help()
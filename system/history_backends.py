@@ -0,0 +1,192 @@
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+# Một thao tác ghi: ("append", user_key, entry) hoặc ("clear", user_key, None)
+Operation = Tuple[str, str, Optional[Dict[str, Any]]]
+
+
+def _sort_entries(entries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    try:
+        return sorted(entries, key=lambda x: datetime.fromisoformat(x['timestamp']))
+    except (KeyError, TypeError, ValueError):
+        return list(entries)
+
+
+def atomic_write_json(path: str, data: Any):
+    """Ghi JSON ra file tạm cùng thư mục rồi ``os.replace``: file đích luôn là bản cũ hoặc bản mới đầy đủ."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".json", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class JsonHistoryBackend:
+    """Snapshot JSON (cùng định dạng ``chat_histories.json`` cũ) cộng một log JSONL chỉ ghi nối.
+
+    Mỗi lần flush chỉ nối các thao tác mới vào ``<file>.log``; khi log đủ dài, snapshot
+    được ghi lại nguyên tử từ dữ liệu trong bộ nhớ và log được xóa (compaction).
+    """
+
+    name = "json"
+
+    def __init__(self, path: str, compact_every: int = 1000):
+        self.path = path
+        self.log_path = path + ".log"
+        self.compact_every = max(1, compact_every)
+        self._log_records = 0
+
+    def load(self, max_per_user: int) -> Dict[str, List[Dict[str, Any]]]:
+        histories: Dict[str, List[Dict[str, Any]]] = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if isinstance(data, dict):
+                    histories = {str(k): list(v) for k, v in data.items() if isinstance(v, list)}
+                else:
+                    print("Warning: History file does not contain a dictionary. Creating new.")
+            except json.JSONDecodeError:
+                print(f"Error decoding JSON from {self.path}. Starting fresh.")
+            except Exception as e:
+                print(f"Error loading chat histories: {e}. Starting fresh.")
+
+        # Phát lại các thao tác chưa được compaction vào snapshot
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Dòng cuối có thể bị cắt ngang nếu tiến trình dừng giữa lúc ghi
+                        continue
+                    self._log_records += 1
+                    if record.get("op") == "clear":
+                        histories[record["user_key"]] = []
+                    else:
+                        histories.setdefault(record["user_key"], []).append(record["entry"])
+
+        return {key: _sort_entries(entries)[-max_per_user:] for key, entries in histories.items()}
+
+    def write(self, operations: List[Operation]):
+        lines = []
+        for op, user_key, entry in operations:
+            record = {"op": op, "user_key": user_key}
+            if entry is not None:
+                record["entry"] = entry
+            lines.append(json.dumps(record, ensure_ascii=False))
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_records += len(lines)
+
+    def needs_compaction(self, incoming: int = 0) -> bool:
+        return self._log_records + incoming >= self.compact_every
+
+    def compact(self, histories: Dict[str, List[Dict[str, Any]]]):
+        """``histories`` phải là trạng thái ngay sau thao tác cuối cùng đã ghi vào log."""
+        atomic_write_json(self.path, histories)
+        # Snapshot mới đã chứa mọi thao tác trong log
+        with open(self.log_path, 'w', encoding='utf-8'):
+            pass
+        self._log_records = 0
+
+    def close(self):
+        pass
+
+
+class SQLiteHistoryBackend:
+    """Bảng ``chat_history`` trong một file SQLite riêng, đánh index theo ``user_key``."""
+
+    name = "sqlite"
+
+    def __init__(self, path: str, max_per_user: int = 3, compact_every: int = 1000):
+        self.path = path
+        self.max_per_user = max_per_user
+        self.compact_every = max(1, compact_every)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS chat_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_key TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                query TEXT NOT NULL,
+                response TEXT NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_user ON chat_history(user_key, id)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._pending_compaction = 0
+
+    def load(self, max_per_user: int) -> Dict[str, List[Dict[str, Any]]]:
+        histories: Dict[str, List[Dict[str, Any]]] = {}
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT user_key, timestamp, query, response FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY user_key ORDER BY id DESC) AS rn
+                    FROM chat_history
+                ) WHERE rn <= ? ORDER BY user_key, id
+            """, (max_per_user,)).fetchall()
+        for user_key, timestamp, query, response in rows:
+            histories.setdefault(user_key, []).append({"timestamp": timestamp, "query": query, "response": response})
+        return histories
+
+    def write(self, operations: List[Operation]):
+        with self._lock, self._conn:
+            for op, user_key, entry in operations:
+                if op == "clear":
+                    self._conn.execute("DELETE FROM chat_history WHERE user_key = ?", (user_key,))
+                else:
+                    self._conn.execute(
+                        "INSERT INTO chat_history (user_key, timestamp, query, response) VALUES (?, ?, ?, ?)",
+                        (user_key, entry["timestamp"], entry["query"], entry["response"])
+                    )
+                    self._pending_compaction += 1
+
+    def needs_compaction(self, incoming: int = 0) -> bool:
+        return self._pending_compaction + incoming >= self.compact_every
+
+    def compact(self, histories: Dict[str, List[Dict[str, Any]]]):
+        """Xóa các dòng cũ vượt quá ``max_per_user`` của mỗi user."""
+        with self._lock, self._conn:
+            self._conn.execute("""
+                DELETE FROM chat_history WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, ROW_NUMBER() OVER (PARTITION BY user_key ORDER BY id DESC) AS rn
+                        FROM chat_history
+                    ) WHERE rn > ?
+                )
+            """, (self.max_per_user,))
+            self._pending_compaction = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_backend(kind: str, path: str, max_per_user: int, compact_every: int = 1000):
+    if kind == "sqlite":
+        return SQLiteHistoryBackend(path, max_per_user=max_per_user, compact_every=compact_every)
+    if kind != "json":
+        print(f"Unknown chat history backend '{kind}', using json")
+    return JsonHistoryBackend(path, compact_every=compact_every)
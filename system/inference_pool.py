@@ -0,0 +1,178 @@
+import math
+import time
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional
+
+try:
+    from eventlet import tpool
+    from eventlet.patcher import is_monkey_patched
+except ImportError:  # chạy script/benchmark không có eventlet
+    tpool = None
+    is_monkey_patched = None
+
+# Pool cho PhoBERT, ViT, FAISS và pool cho RetinaFace/ArcFace, giải mã ảnh camera
+MODEL_POOL = "model"
+FACE_POOL = "face"
+
+# Đánh dấu thread đang chạy bên trong một pool: lời gọi lồng nhau chạy luôn tại chỗ
+_worker_state = threading.local()
+
+
+class InferenceBusy(RuntimeError):
+    """Pool suy luận đã đầy: hàng đợi vượt ``max_queue`` hoặc chờ quá ``queue_timeout``."""
+
+    def __init__(self, pool_name: str, reason: str):
+        super().__init__(f"Inference pool '{pool_name}' is busy ({reason})")
+        self.pool_name = pool_name
+        self.reason = reason
+
+
+def _hub_is_patched() -> bool:
+    return is_monkey_patched is not None and is_monkey_patched("thread")
+
+
+def _run_marked(fn: Callable[..., Any], args, kwargs) -> Any:
+    previous = getattr(_worker_state, "inside", False)
+    _worker_state.inside = True
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _worker_state.inside = previous
+
+
+class InferencePool:
+    """Chạy các hàm suy luận nặng CPU (ONNX Runtime, torch, FAISS, OpenCV) ngoài hub eventlet.
+
+    Khi process đã ``eventlet.monkey_patch()``, mỗi lời gọi ``run`` được chuyển sang
+    thread hệ điều hành thật qua ``eventlet.tpool`` nên greenlet gọi nhường hub cho các
+    socket khác trong lúc chờ. Số lời gọi chạy đồng thời bị giới hạn ở ``workers``; tối đa
+    ``max_queue`` lời gọi được xếp hàng chờ, mỗi lời gọi chờ tối đa ``queue_timeout`` giây.
+    Vượt các giới hạn này thì ``run`` ném ``InferenceBusy`` ngay để request trả 503 / "busy"
+    thay vì dồn ứ. Không có eventlet (script, benchmark) thì hàm được gọi trong thread hiện tại.
+
+    Lời gọi ``run`` từ bên trong một hàm đang chạy trong pool (ví dụ embed_query bên trong
+    một bước retrieval đã offload) được chạy luôn tại chỗ để không chiếm thêm slot.
+
+    Hàm chạy trong pool chỉ nên tính toán thuần (model, numpy, FAISS): không dùng lock hay
+    kết nối database của process vì chúng đã bị monkey-patch thành bản green.
+    """
+
+    def __init__(self, name: str, workers: int = 2, max_queue: int = 32, queue_timeout: float = 10.0):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(self.workers)
+        self._stats_lock = threading.Lock()
+        self._wait_samples: Deque[float] = deque(maxlen=1000)
+        self.calls = 0
+        self.errors = 0
+        self.rejected = 0
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.run_seconds_total = 0.0
+
+    def configure(self, workers: Optional[int] = None, max_queue: Optional[int] = None,
+                  queue_timeout: Optional[float] = None):
+        """Đổi giới hạn của pool; số worker chỉ đổi được khi pool đang rảnh."""
+        with self._stats_lock:
+            if max_queue is not None:
+                self.max_queue = max(0, max_queue)
+            if queue_timeout is not None:
+                self.queue_timeout = queue_timeout
+            if workers is not None and max(1, workers) != self.workers:
+                if self.active or self.waiting:
+                    print(f"Inference pool '{self.name}' is in use, keeping {self.workers} workers")
+                else:
+                    self.workers = max(1, workers)
+                    self._slots = threading.BoundedSemaphore(self.workers)
+
+    def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        if getattr(_worker_state, "inside", False):
+            return fn(*args, **kwargs)
+
+        with self._stats_lock:
+            if self.waiting >= self.max_queue and self.active >= self.workers:
+                self.rejected += 1
+                raise InferenceBusy(self.name, f"{self.waiting} calls queued")
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+            slots = self._slots
+
+        queued_at = time.perf_counter()
+        acquired = slots.acquire(timeout=self.queue_timeout) if self.queue_timeout and self.queue_timeout > 0 else slots.acquire()
+        started = time.perf_counter()
+        with self._stats_lock:
+            self.waiting -= 1
+            self._wait_samples.append(started - queued_at)
+            if not acquired:
+                self.rejected += 1
+                raise InferenceBusy(self.name, f"waited {self.queue_timeout}s for a worker")
+            self.calls += 1
+            self.active += 1
+
+        try:
+            if tpool is not None and _hub_is_patched():
+                return tpool.execute(_run_marked, fn, args, kwargs)
+            return _run_marked(fn, args, kwargs)
+        except Exception:
+            with self._stats_lock:
+                self.errors += 1
+            raise
+        finally:
+            slots.release()
+            with self._stats_lock:
+                self.active -= 1
+                self.run_seconds_total += time.perf_counter() - started
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            waits = sorted(self._wait_samples)
+            return {
+                "workers": self.workers,
+                "active": self.active,
+                "queue_depth": self.waiting,
+                "max_queue_depth": self.max_waiting,
+                "max_queue": self.max_queue,
+                "calls": self.calls,
+                "errors": self.errors,
+                "rejected": self.rejected,
+                "avg_wait_ms": round(sum(waits) / len(waits) * 1000, 2) if waits else 0.0,
+                "p95_wait_ms": round(waits[min(len(waits) - 1, math.ceil(0.95 * len(waits)) - 1)] * 1000, 2) if waits else 0.0,
+                "avg_run_ms": round(self.run_seconds_total / self.calls * 1000, 2) if self.calls else 0.0,
+                "offloaded": tpool is not None and _hub_is_patched(),
+            }
+
+
+_pools: Dict[str, InferencePool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_inference_pool(name: str, workers: int = 2) -> InferencePool:
+    """Pool dùng chung theo tên; ``workers`` chỉ có tác dụng ở lần tạo đầu tiên."""
+    pool = _pools.get(name)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(name)
+            if pool is None:
+                pool = InferencePool(name, workers)
+                _pools[name] = pool
+    return pool
+
+
+def configure_pool(name: str, workers: int, max_queue: int, queue_timeout: float) -> InferencePool:
+    """Tạo (hoặc cập nhật giới hạn của) pool dùng chung theo cấu hình."""
+    pool = get_inference_pool(name, workers)
+    pool.configure(workers=workers, max_queue=max_queue, queue_timeout=queue_timeout)
+    return pool
+
+
+def run_inference(name: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """``get_inference_pool(name).run(fn, ...)``."""
+    return get_inference_pool(name).run(fn, *args, **kwargs)
+
+
+def pool_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: pool.stats() for name, pool in list(_pools.items())}
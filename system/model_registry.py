@@ -0,0 +1,163 @@
+import os
+import time
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from config import Config
+from system.inference_pool import configure_pool, MODEL_POOL, FACE_POOL
+
+
+class ModelRegistry:
+    """Registry dùng chung trong process: mỗi model chỉ được tải một lần.
+
+    Model được đăng ký bằng một hàm loader và chỉ được tải khi ``get`` được gọi
+    lần đầu (hoặc khi ``preload`` lúc khởi động). Mỗi model có lock riêng nên
+    nhiều luồng/greenlet gọi đồng thời vẫn chỉ tải một bản.
+    """
+
+    def __init__(self):
+        self._loaders: Dict[str, Callable[[], Any]] = {}
+        self._models: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._load_times: Dict[str, float] = {}
+        self._registry_lock = threading.Lock()
+
+    def register(self, name: str, loader: Callable[[], Any], replace: bool = False):
+        """Đăng ký loader cho một model. Không ghi đè loader đã có trừ khi replace=True."""
+        with self._registry_lock:
+            if name in self._loaders and not replace:
+                return
+            self._loaders[name] = loader
+            self._locks.setdefault(name, threading.Lock())
+
+    def is_registered(self, name: str) -> bool:
+        return name in self._loaders
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def get(self, name: str, runner: Optional[Callable[[Callable[[], Any]], Any]] = None) -> Any:
+        """Trả về model đã tải, tải lần đầu nếu cần.
+
+        ``runner`` (ví dụ ``InferencePool.run``) nhận loader và chạy nó; dùng để tải model
+        ngoài hub eventlet. Lock của model vẫn được giữ ở luồng gọi ``get``.
+        """
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        if name not in self._loaders:
+            raise KeyError(f"Model '{name}' chưa được đăng ký trong registry")
+
+        with self._locks[name]:
+            # Kiểm tra lại sau khi giữ lock: luồng khác có thể đã tải xong
+            model = self._models.get(name)
+            if model is None:
+                print(f"Loading model '{name}'...")
+                start = time.perf_counter()
+                loader = self._loaders[name]
+                model = runner(loader) if runner is not None else loader()
+                self._load_times[name] = time.perf_counter() - start
+                self._models[name] = model
+                print(f"Model '{name}' loaded in {self._load_times[name]:.2f}s")
+        return model
+
+    def preload(self, names: Optional[Iterable[str]] = None):
+        """Tải trước các model (mặc định là tất cả model đã đăng ký)."""
+        for name in list(names if names is not None else self._loaders):
+            try:
+                self.get(name)
+            except Exception as e:
+                print(f"Error preloading model '{name}': {e}")
+
+    def release(self, name: str):
+        """Giải phóng model khỏi registry (ví dụ sau khi script build index chạy xong)."""
+        with self._locks.get(name, self._registry_lock):
+            self._models.pop(name, None)
+            self._load_times.pop(name, None)
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Ước lượng bộ nhớ (bytes) của từng model đã tải."""
+        return {name: _estimate_model_bytes(model) for name, model in self._models.items()}
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Trạng thái, thời gian tải và bộ nhớ ước lượng của từng model đã đăng ký."""
+        memory = self.memory_usage()
+        return {
+            name: {
+                "loaded": name in self._models,
+                "load_time_s": round(self._load_times[name], 3) if name in self._load_times else None,
+                "memory_mb": round(memory[name] / (1024 * 1024), 1) if name in memory else None,
+            }
+            for name in self._loaders
+        }
+
+
+def _estimate_model_bytes(obj: Any, _depth: int = 0) -> int:
+    """Cộng kích thước tham số torch và kích thước file ONNX tìm thấy trong đối tượng."""
+    try:
+        import torch
+        if isinstance(obj, torch.nn.Module):
+            tensors = list(obj.parameters()) + list(obj.buffers())
+            return sum(t.numel() * t.element_size() for t in tensors)
+    except ImportError:
+        pass
+
+    model_file = getattr(obj, "model_file", None)
+    if isinstance(model_file, str) and os.path.exists(model_file):
+        return os.path.getsize(model_file)
+
+    if _depth >= 2 or not hasattr(obj, "__dict__"):
+        return 0
+    return sum(_estimate_model_bytes(value, _depth + 1) for value in vars(obj).values())
+
+
+model_registry = ModelRegistry()
+
+PHOBERT = "phobert"
+VIT = "vit"
+FACE_AUTH = "face_auth"
+
+
+def register_default_models(config: Config):
+    """Đăng ký loader cho PhoBERT, ViT và RetinaFace/ArcFace dùng chung toàn process.
+
+    Đồng thời cấu hình các pool suy luận mà những model này chạy trên đó.
+    """
+    configure_pool(MODEL_POOL, config.model_workers, config.inference_max_queue, config.inference_queue_timeout)
+    configure_pool(FACE_POOL, config.face_workers, config.inference_max_queue, config.inference_queue_timeout)
+
+    def load_phobert():
+        from system.embeddings import PhoBERTEmbeddings
+        from system.embedding_cache import EmbeddingCache
+        query_cache = EmbeddingCache(
+            model_name=config.embedding_model,
+            max_entries=config.query_cache_size,
+            disk_path=config.query_cache_path or None,
+            max_disk_entries=config.query_cache_disk_size,
+            enabled=config.query_cache_enabled
+        )
+        return PhoBERTEmbeddings(
+            model_name=config.embedding_model,
+            batch_size=config.embedding_batch_size,
+            query_cache=query_cache
+        )
+
+    def load_vit():
+        from search_engine.feature_extractor import ImageFeatureExtractor
+        return ImageFeatureExtractor()
+
+    def load_face_auth():
+        from system.face_auth import FaceAuthTransformer
+        # Mỗi worker của pool khuôn mặt chạy một session; chia đều CPU giữa các worker
+        workers = max(1, config.face_workers)
+        intra_op_threads = config.face_intra_op_threads or max(1, (os.cpu_count() or 1) // workers)
+        return FaceAuthTransformer(
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=config.face_inter_op_threads,
+            db_path=config.db_path
+        )
+
+    model_registry.register(PHOBERT, load_phobert)
+    model_registry.register(VIT, load_vit)
+    model_registry.register(FACE_AUTH, load_face_auth)
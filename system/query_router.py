@@ -0,0 +1,236 @@
+import re
+import json
+import os
+import threading
+import unicodedata
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+SQL_TOOL = "use_sql_tool"
+VECTOR_TOOL = "use_vector_tool"
+
+# Luật từ khóa: (pattern, trọng số). Trọng số dương nghiêng về SQL, âm nghiêng về vector.
+# Pattern được so khớp trên câu hỏi đã bỏ dấu nên người dùng gõ không dấu vẫn khớp.
+KEYWORD_RULES: List[Tuple[str, float]] = [
+    (r"\bbao nhieu\b", 0.6),
+    (r"\b(tong|trung binh|dem|so luong|thong ke|doanh thu|doanh so)\b", 0.7),
+    (r"\b(liet ke|danh sach|tat ca (cac )?(san pham|mon|do uong|loai))\b", 0.6),
+    (r"\b(re nhat|dat nhat|cao nhat|thap nhat|nhieu nhat|it nhat|ban chay)\b", 0.7),
+    (r"\btop\s*\d+\b", 0.7),
+    (r"\bgia (duoi|tren|tu|khoang|bao nhieu|cua)\b", 0.6),
+    (r"\b(duoi|tren|khong qua)\s*\d+\s*(k|nghin|ngan|vnd|d|dong)?\b", 0.5),
+    (r"\b(sap xep|so sanh gia|lich su mua|da mua|don hang)\b", 0.6),
+    (r"\b(cac loai|nhung loai|may loai|danh muc)\b", 0.4),
+    (r"\b(nhu the nao|the nao|ra sao|co ngon khong|vi gi|huong vi)\b", -0.6),
+    (r"\b(goi y|tu van|nen uong|nen chon|de xuat|phu hop)\b", -0.6),
+    (r"\b(xin chao|chao ban|hello|cam on|tam biet)\b", -0.8),
+    (r"\b(ban la ai|ban co the lam gi|gioi thieu|mo ta|la gi)\b", -0.6),
+    (r"\b(giai nhiet|tinh tao|it ngot|healthy|de ngu)\b", -0.5),
+]
+
+# Câu hỏi mẫu đã gán nhãn cho bộ phân loại láng giềng gần nhất
+DEFAULT_EXAMPLES: List[Tuple[str, str]] = [
+    ("Có bao nhiêu sản phẩm trong menu?", SQL_TOOL),
+    ("Liệt kê các loại Classic Espresso Drinks", SQL_TOOL),
+    ("Cho tôi xem các loại Shaken Iced Beverages", SQL_TOOL),
+    ("Sản phẩm nào giá dưới 50k?", SQL_TOOL),
+    ("Món nào đắt nhất?", SQL_TOOL),
+    ("Top 3 đồ uống bán chạy nhất", SQL_TOOL),
+    ("Giá của Caffè Latte size lớn là bao nhiêu?", SQL_TOOL),
+    ("Tôi đã mua những gì?", SQL_TOOL),
+    ("Lịch sử đơn hàng của tôi", SQL_TOOL),
+    ("Tổng số đồ uống trong danh mục Frappuccino", SQL_TOOL),
+    ("Caffè Mocha có những biến thể nào?", SQL_TOOL),
+    ("Sắp xếp các món theo giá tăng dần", SQL_TOOL),
+    ("Có những danh mục đồ uống nào?", SQL_TOOL),
+    ("Món rẻ nhất trong menu là gì?", SQL_TOOL),
+    ("So sánh giá Cappuccino và Caffè Americano", SQL_TOOL),
+    ("Trà sữa trân châu đường đen có vị như thế nào?", VECTOR_TOOL),
+    ("Gợi ý cho tôi đồ uống giải nhiệt", VECTOR_TOOL),
+    ("Chào bạn", VECTOR_TOOL),
+    ("Bạn có thể làm gì?", VECTOR_TOOL),
+    ("Cửa hàng mở cửa mấy giờ?", VECTOR_TOOL),
+    ("Tôi muốn uống gì đó ít ngọt", VECTOR_TOOL),
+    ("Đồ uống nào giúp tỉnh táo buổi sáng?", VECTOR_TOOL),
+    ("Mô tả Caffè Americano", VECTOR_TOOL),
+    ("Tôi không uống được cà phê, nên chọn món nào?", VECTOR_TOOL),
+    ("Có món nào hợp với trời mưa không?", VECTOR_TOOL),
+    ("Vanilla Latte có ngon không?", VECTOR_TOOL),
+    ("Tư vấn cho tôi một món uống kèm bánh ngọt", VECTOR_TOOL),
+    ("Cảm ơn bạn nhé", VECTOR_TOOL),
+    ("Espresso khác gì Americano?", VECTOR_TOOL),
+    ("Đồ uống nào phù hợp cho người ăn kiêng?", VECTOR_TOOL),
+]
+
+# Đại từ / cách nói tỉnh lược cho thấy câu hỏi dựa vào lượt chat trước ("Nó giá bao nhiêu?",
+# "Còn size lớn thì sao?"). So khớp trên câu hỏi còn dấu vì bỏ dấu thì "nó" trùng "no".
+FOLLOW_UP_PATTERNS: List[str] = [
+    r"\b(nó|chúng nó|mấy món đó)\b",
+    r"\b(món|cái|loại|ly|cốc|đồ uống|sản phẩm|size|vị)\s+(đó|này|kia|ấy|trên|vừa rồi)\b",
+    r"^(còn|vậy|thế|thế còn|vậy còn)\b",
+    r"\b(thì sao|thì thế nào|thì như thế nào)\b",
+    r"\b(vừa rồi|lúc nãy|ở trên|bên trên|như trên)\b",
+]
+
+
+def is_context_dependent(query: str) -> bool:
+    """Câu hỏi có thể phụ thuộc lượt chat trước: có đại từ/cách nói tỉnh lược, hoặc rất ngắn
+    (tối đa 3 từ, vd. "Giá bao nhiêu?", "Cái gì?")."""
+    text = unicodedata.normalize("NFC", (query or "").lower()).strip()
+    if len(text.split()) <= 3:
+        return True
+    return any(re.search(pattern, text) for pattern in FOLLOW_UP_PATTERNS)
+
+
+def strip_accents(text: str) -> str:
+    """Chữ thường, bỏ dấu tiếng Việt (kể cả đ → d) và gộp khoảng trắng."""
+    text = unicodedata.normalize("NFD", text.lower()).replace("đ", "d")
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    return " ".join(text.split())
+
+
+@dataclass
+class RouteDecision:
+    """Kết quả định tuyến: tool được chọn, độ tin cậy trong [0, 1] và nguồn quyết định."""
+    tool: str
+    confidence: float
+    source: str  # "rules", "knn", "rules+knn" hoặc "llm"
+    scores: Dict[str, float] = field(default_factory=dict)
+
+    @property
+    def needs_llm(self) -> bool:
+        return self.source == "llm"
+
+
+class QueryRouter:
+    """Chọn giữa ``use_sql_tool`` và ``use_vector_tool`` mà không gọi LLM.
+
+    Điểm của luật từ khóa và điểm của bộ phân loại k láng giềng gần nhất (cosine trên
+    embedding PhoBERT của các câu hỏi mẫu) được cộng có trọng số thành một điểm trong
+    [-1, 1]; dấu cho biết tool, độ lớn là độ tin cậy. Nơi gọi chỉ gọi LLM chọn tool khi
+    độ tin cậy thấp hơn ngưỡng.
+
+    Độ tin cậy của kNN là mức đồng thuận nhãn của k câu mẫu gần nhất nhân với khoảng cách
+    (margin) giữa câu mẫu gần nhất của hai nhãn, chia cho ``margin_scale``: câu hỏi nằm giữa
+    hai nhóm câu mẫu có độ tin cậy thấp dù mọi láng giềng cùng nhãn.
+    """
+
+    def __init__(self, embeddings=None, examples: Optional[Sequence[Tuple[str, str]]] = None,
+                 confidence_threshold: float = 0.35, k: int = 5, rule_weight: float = 0.5,
+                 margin_scale: float = 0.05):
+        self.embeddings = embeddings
+        self.examples = list(examples) if examples else list(DEFAULT_EXAMPLES)
+        self.confidence_threshold = confidence_threshold
+        self.k = max(1, k)
+        self.rule_weight = rule_weight
+        self.margin_scale = margin_scale
+        self._rules = [(re.compile(pattern), weight) for pattern, weight in KEYWORD_RULES]
+        self._example_vectors: Optional[np.ndarray] = None
+        self._example_labels: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+        self.counts = {"rules": 0, "knn": 0, "rules+knn": 0, "llm": 0}
+
+    @classmethod
+    def from_config(cls, config, embeddings) -> "QueryRouter":
+        examples = None
+        if config.router_examples_path:
+            examples = cls.load_examples(config.router_examples_path)
+        return cls(embeddings, examples=examples, confidence_threshold=config.router_confidence_threshold)
+
+    @staticmethod
+    def load_examples(path: str) -> List[Tuple[str, str]]:
+        """Đọc câu hỏi mẫu từ file JSON dạng [{"query": ..., "tool": ...}], gộp với bộ mẫu mặc định."""
+        examples = list(DEFAULT_EXAMPLES)
+        if not os.path.exists(path):
+            print(f"Warning: Router examples file not found at {path}, using default examples")
+            return examples
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for item in json.load(f):
+                    if item.get("tool") in (SQL_TOOL, VECTOR_TOOL) and item.get("query"):
+                        examples.append((item["query"], item["tool"]))
+        except Exception as e:
+            print(f"Error loading router examples from {path}: {e}")
+        return examples
+
+    def rule_score(self, query: str) -> Tuple[float, int]:
+        """Tổng trọng số các luật khớp (kẹp về [-1, 1]) và số luật khớp."""
+        text = strip_accents(query)
+        hits = [weight for pattern, weight in self._rules if pattern.search(text)]
+        return float(np.clip(sum(hits), -1.0, 1.0)), len(hits)
+
+    def _ensure_examples(self):
+        if self._example_vectors is not None:
+            return
+        with self._lock:
+            if self._example_vectors is not None:
+                return
+            vectors = np.asarray(self.embeddings.embed_documents([q for q, _ in self.examples]), dtype=np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-8
+            self._example_labels = np.array([1.0 if tool == SQL_TOOL else -1.0 for _, tool in self.examples], dtype=np.float32)
+            self._example_vectors = vectors
+            print(f"Query router: embedded {len(self.examples)} labelled examples")
+
+    def knn_score(self, query: str) -> float:
+        """Điểm kNN trong [-1, 1]: dấu theo phiếu của k câu mẫu gần nhất, độ lớn đã hiệu chỉnh theo margin."""
+        if self.embeddings is None:
+            return 0.0
+        self._ensure_examples()
+        vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        vector /= np.linalg.norm(vector) + 1e-8
+        similarities = self._example_vectors @ vector
+        labels = self._example_labels
+        k = min(self.k, len(similarities))
+        nearest = np.argpartition(-similarities, k - 1)[:k]
+        # Phiếu có trọng số theo cosine: tỉ lệ đồng thuận nhãn trong k láng giềng
+        weights = np.clip(similarities[nearest], 1e-6, None)
+        agreement = float((weights * labels[nearest]).sum() / weights.sum())
+        # Cosine giữa các câu PhoBERT (mean pooling) thường đều cao, nên khoảng cách giữa câu mẫu
+        # gần nhất của mỗi nhãn mới cho biết câu hỏi có thật sự gần một nhóm hơn nhóm kia
+        if (labels > 0).any() and (labels < 0).any():
+            margin = abs(float(similarities[labels > 0].max() - similarities[labels < 0].max()))
+            agreement *= min(1.0, margin / self.margin_scale) if self.margin_scale > 0 else 1.0
+        return agreement
+
+    def route(self, query: str) -> RouteDecision:
+        """Định tuyến câu hỏi; ``source == "llm"`` nghĩa là độ tin cậy thấp, cần hỏi LLM."""
+        rules, hits = self.rule_score(query)
+        try:
+            knn = self.knn_score(query)
+        except Exception as e:
+            print(f"Error in query router kNN classifier: {e}")
+            knn = 0.0
+
+        if hits and self.embeddings is not None:
+            score, source = self.rule_weight * rules + (1 - self.rule_weight) * knn, "rules+knn"
+        elif hits:
+            score, source = rules, "rules"
+        else:
+            score, source = knn, "knn"
+
+        # Câu rất ngắn không khớp luật nào (vd. "Cái gì?") thường phụ thuộc vào ngữ cảnh hội thoại
+        if not hits and len(query.split()) <= 3:
+            score *= 0.5
+
+        decision = RouteDecision(
+            tool=SQL_TOOL if score > 0 else VECTOR_TOOL,
+            confidence=round(abs(score), 4),
+            source=source,
+            scores={"rules": round(rules, 4), "knn": round(knn, 4)}
+        )
+        if decision.confidence < self.confidence_threshold:
+            decision.source = "llm"
+        self.counts[decision.source] += 1
+        return decision
+
+    def stats(self) -> Dict[str, float]:
+        total = sum(self.counts.values())
+        local = total - self.counts["llm"]
+        return {
+            **self.counts,
+            "total": total,
+            "local_rate": round(local / total, 4) if total else 0.0,
+            "confidence_threshold": self.confidence_threshold,
+        }
@@ -1,4 +1,9 @@
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Callable, Iterator, Optional
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import partial
 from langchain_community.vectorstores import FAISS
 from langchain_google_genai import ChatGoogleGenerativeAI
 import os
@@ -10,6 +15,7 @@ from langchain_core.embeddings import Embeddings
 from transformers import AutoModel, AutoTokenizer
 import torch
 from config import Config
+from db_pool import get_pool, TableWatcher
 from utils import (
     load_table_data,
     execute_sql_query,
@@ -22,20 +28,52 @@ from .prompts import PromptManager
 from search_engine.feature_extractor import ImageFeatureExtractor
 from search_engine.faiss_indexer import FaissIndexer
 from search_engine.hybrid_search import HybridSearchResult
+from search_engine.description_embeddings import DescriptionEmbeddings, FILE_NAME as DESCRIPTION_EMBEDDINGS_FILE
 import faiss
 from .tool_manager import ToolManager
-from .embeddings import PhoBERTEmbeddings
+from .schema_cache import SchemaCache
+from .vector_store_io import load_vector_store
+from .vector_store_sync import (
+    table_documents, description_documents, sync_and_save, read_version,
+    TABLE_LEGACY_FIELDS, DESCRIPTION_LEGACY_FIELDS, DESCRIPTION_SQL
+)
+from .model_registry import model_registry, register_default_models, PHOBERT
+from .stage_timer import StageTimer
+from .query_router import QueryRouter, SQL_TOOL, VECTOR_TOOL, is_context_dependent
+from .response_cache import ResponseCache
+from .sql_plan_cache import SQLPlanCache
+from .inference_pool import run_inference, InferenceBusy, MODEL_POOL
+
+# Tiền tố của các câu trả lời lỗi do _answer_with_* trả về; không đưa vào response cache
+_ERROR_RESPONSE_PREFIXES = ("Lỗi", "Xin lỗi, tôi không thể thực hiện", "Không thể tìm kiếm")
 
 class OptimizedRAGSystem:
     def __init__(self, config: Config):
         self.config = config
-        self.chat_history = ChatHistory()
+        self.chat_history = ChatHistory(
+            history_file=self.config.chat_history_db_path if self.config.chat_history_backend == "sqlite" else self.config.chat_history_path,
+            max_history_per_user=self.config.max_history_per_user,
+            backend=self.config.chat_history_backend,
+            flush_interval=self.config.chat_history_flush_interval,
+            compact_every=self.config.chat_history_compact_every
+        )
         self.tool_manager = ToolManager()
+        # Các bước I/O của một request (tra cứu DB, retrieval) chạy song song với lời gọi LLM chọn tool.
+        # Khi chạy dưới eventlet (app.py), threading đã được monkey-patch nên đây là green thread.
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.config.pipeline_workers,
+            thread_name_prefix="rag-pipeline"
+        )
+        # Chỉ một lần đồng bộ vector store chạy tại một thời điểm; truy vấn đọc tham chiếu store hiện tại
+        self._vector_store_lock = threading.Lock()
         self._initialize_components()
 
     def _initialize_components(self):
         """Khởi tạo các thành phần chính"""
-        self.embeddings = PhoBERTEmbeddings()
+        register_default_models(self.config)
+        # Các bước nặng CPU khi khởi tạo (tải PhoBERT, đọc FAISS, đồng bộ, chỉ mục ảnh) chạy trên pool suy luận
+        self.embeddings = model_registry.get(PHOBERT, runner=partial(run_inference, MODEL_POOL))
+        self.query_router = QueryRouter.from_config(self.config, self.embeddings) if self.config.router_enabled else None
 
         self.llm = ChatGoogleGenerativeAI(
             model=self.config.llm_model,
@@ -43,18 +81,47 @@ class OptimizedRAGSystem:
             google_api_key=self.config.google_api_key
         )
 
+        self.db_pool = get_pool(self.config.db_path, self.config.db_timeout)
+        # Schema được dựng một lần lúc khởi động và giữ trong bộ nhớ
+        self.schema_cache = SchemaCache(self.config.db_path)
+        # Phiên bản dữ liệu các bảng trong schema, dùng chung cho các cache phía dưới
+        self.data_watcher = TableWatcher(self.db_pool, self.schema_cache.table_names())
+        # Cache câu trả lời theo ngữ nghĩa, bị xóa khi dữ liệu thay đổi
+        self.response_cache = ResponseCache(
+            self.data_watcher.version,
+            similarity_threshold=self.config.response_cache_threshold,
+            max_entries=self.config.response_cache_size,
+            ttl_seconds=self.config.response_cache_ttl,
+            enabled=self.config.response_cache_enabled
+        )
+        # Cache SQL đã sinh theo dạng câu hỏi; tên sản phẩm/danh mục được tách thành tham số
+        self.sql_plan_cache = SQLPlanCache(
+            self._load_sql_entities,
+            self.data_watcher.version,
+            max_entries=self.config.sql_plan_cache_size,
+            enabled=self.config.sql_plan_cache_enabled
+        )
+
         self.vector_store = self._initialize_vector_store()
         self.description_vector_store = self._initialize_description_vector_store()
+        self.hybrid_search = HybridSearchResult(self.config)
+        self.hybrid_search.set_description_embeddings(
+            run_inference(
+                MODEL_POOL, DescriptionEmbeddings.load_or_build,
+                self.config.description_vector_store_path, self.description_vector_store
+            )
+        )
+        if self.config.vector_sync_on_start:
+            try:
+                self.sync_vector_stores()
+            except Exception as e:
+                print(f"Error syncing vector stores: {e}")
 
     def _initialize_vector_store(self) -> FAISS:
         """Load vector store or create new if not found"""
         if os.path.exists(self.config.vector_store_path):
             try:
-                return FAISS.load_local(
-                    self.config.vector_store_path,
-                    self.embeddings,
-                    allow_dangerous_deserialization=True
-                )
+                return self._load_store(self.config.vector_store_path)
             except Exception as e:
                 print(f"Error loading vector store: {e}")
                 return self._create_new_vector_store()
@@ -63,21 +130,13 @@ class OptimizedRAGSystem:
     def _create_new_vector_store(self) -> FAISS:
         """Create a new FAISS vector store"""
         try:
-            os.makedirs(self.config.vector_store_path, exist_ok=True)
-            documents = load_table_data(self.config.db_path)
+            documents = self._table_documents()
             if not documents:
                 print("No documents loaded from database")
                 return None
-            texts = [doc["content"] for doc in documents]
-            metadatas = [doc["metadata"] for doc in documents]
-
-            print(f"Creating vector store with {len(texts)} documents")
-            vector_store = FAISS.from_texts(
-                texts=texts,
-                embedding=self.embeddings,
-                metadatas=metadatas
-            )
-            vector_store.save_local(self.config.vector_store_path)
+
+            print(f"Creating vector store with {len(documents)} documents")
+            vector_store, _ = self._sync_store(None, documents, self.config.vector_store_path, TABLE_LEGACY_FIELDS)
             print("Vector store created and saved successfully")
             return vector_store
 
@@ -89,11 +148,7 @@ class OptimizedRAGSystem:
         """Initialize or create description vector store"""
         if os.path.exists(self.config.description_vector_store_path):
             try:
-                return FAISS.load_local(
-                    self.config.description_vector_store_path,
-                    self.embeddings,
-                    allow_dangerous_deserialization=True
-                )
+                return self._load_store(self.config.description_vector_store_path)
             except Exception as e:
                 print(f"Error loading description vector store: {e}")
                 return self._create_description_vector_store()
@@ -102,30 +157,16 @@ class OptimizedRAGSystem:
     def _create_description_vector_store(self) -> FAISS:
         """Create FAISS vector store for product descriptions"""
         try:
-            os.makedirs(self.config.description_vector_store_path, exist_ok=True)
-            conn = sqlite3.connect(self.config.db_path)
-            cursor = conn.cursor()
-            cursor.execute("""SELECT Product.ID,Name_Product, Descriptions
-                           FROM Product ;""")
-            products = cursor.fetchall()
-            conn.close()
-            if not products:
+            documents = self._description_documents()
+            if not documents:
                 print("No product descriptions found.")
                 return None
-            print(f"Số sản phẩm được vector hóa: {len(products)}")
-            descriptions = [
-                f"{product[2]}" for product in products
-            ]
-            metadatas = [
-                {"ID":product[0],"name": product[1], "description": product[2]} for product in products
-            ]
-
-            vector_store = FAISS.from_texts(
-                texts=descriptions,
-                embedding=self.embeddings,
-                metadatas=metadatas
-            )
-            vector_store.save_local(self.config.description_vector_store_path)
+            print(f"Số sản phẩm được vector hóa: {len(documents)}")
+
+            vector_store, _ = self._sync_store(None, documents, self.config.description_vector_store_path,
+                                               DESCRIPTION_LEGACY_FIELDS)
+            # Lưu ma trận embedding mô tả theo product ID cạnh vector store cho MBR
+            self._save_description_embeddings(vector_store)
             print("Description vector store created and saved successfully.")
             return vector_store
 
@@ -133,85 +174,160 @@ class OptimizedRAGSystem:
             print(f"Error creating description vector store: {e}")
             return None
 
+    def _table_documents(self) -> List[Dict[str, Any]]:
+        """Một document cho mỗi hàng của mọi bảng, khóa ``<bảng>:<rowid>``."""
+        return table_documents(load_table_data(self.config.db_path))
+
+    def _description_documents(self) -> List[Dict[str, Any]]:
+        """Một document mô tả cho mỗi sản phẩm, khóa là product ID."""
+        return description_documents(self.db_pool.fetchall(DESCRIPTION_SQL))
+
+    def _load_store(self, path: str) -> FAISS:
+        """Tải vector store trên pool suy luận (đọc index FAISS và docstore không chặn hub)."""
+        return run_inference(MODEL_POOL, load_vector_store, path, self.embeddings, mmap=self.config.index_mmap)
+
+    def _sync_store(self, vector_store: Optional[FAISS], documents: List[Dict[str, Any]],
+                    path: str, legacy_fields: Tuple[str, ...]) -> Tuple[Optional[FAISS], Dict[str, int]]:
+        """Đồng bộ một store với ``documents`` trên pool suy luận, lưu nếu có thay đổi và ghi dấu phiên bản dữ liệu.
+
+        Document được đọc từ database trên hub trước đó; trong pool chỉ còn embed, FAISS và ghi file.
+        """
+        return run_inference(MODEL_POOL, sync_and_save, vector_store, documents, self.embeddings, path,
+                             self.config.vector_sync_batch_size, legacy_fields)
+
+    def _save_description_embeddings(self, vector_store: FAISS) -> DescriptionEmbeddings:
+        """Dựng ma trận embedding mô tả từ vector đã lưu và ghi cạnh store, trên pool suy luận."""
+        def build() -> DescriptionEmbeddings:
+            matrix = DescriptionEmbeddings.from_vector_store(vector_store)
+            matrix.save(os.path.join(self.config.description_vector_store_path, DESCRIPTION_EMBEDDINGS_FILE))
+            return matrix
+
+        return run_inference(MODEL_POOL, build)
+
+    def sync_vector_stores(self) -> Dict[str, Any]:
+        """Đồng bộ vector store dữ liệu bảng và vector store mô tả với database, rồi thay store đang dùng.
+
+        Chỉ hàng mới hoặc đã đổi được embed; store mới được dựng trên bản sao rồi gán thay store cũ,
+        nên truy vấn đang chạy vẫn dùng store cũ và không cần khởi động lại. Nếu database không
+        trả về hàng nào (ví dụ lỗi đọc), store tương ứng được giữ nguyên.
+        """
+        results: Dict[str, Any] = {}
+        with self._vector_store_lock:
+            start = time.perf_counter()
+            documents = self._table_documents()
+            if documents:
+                store, results["vector_store"] = self._sync_store(
+                    self.vector_store, documents, self.config.vector_store_path, TABLE_LEGACY_FIELDS
+                )
+                self.vector_store = store
+            else:
+                results["vector_store"] = None
+                print("No documents loaded from database, keeping current vector store")
+
+            documents = self._description_documents()
+            if documents:
+                store, results["description_vector_store"] = self._sync_store(
+                    self.description_vector_store, documents, self.config.description_vector_store_path,
+                    DESCRIPTION_LEGACY_FIELDS
+                )
+                if store is not self.description_vector_store:
+                    self.hybrid_search.set_description_embeddings(self._save_description_embeddings(store))
+                    self.description_vector_store = store
+            else:
+                results["description_vector_store"] = None
+                print("No product descriptions found, keeping current description vector store")
+            results["seconds"] = round(time.perf_counter() - start, 3)
+        print(f"Vector store sync: {results}")
+        return results
 
+    def vector_store_versions(self) -> Dict[str, Any]:
+        """Dấu phiên bản của lần đồng bộ gần nhất của từng vector store."""
+        return {
+            "vector_store": read_version(self.config.vector_store_path),
+            "description_vector_store": read_version(self.config.description_vector_store_path),
+        }
 
-    def _get_database_schema(self) -> str:
-        """Get database schema information with descriptions"""
-        try:
-            conn = sqlite3.connect(self.config.db_path)
-            cursor = conn.cursor()
-
-            # Định nghĩa mô tả cho từng bảng
-            table_descriptions = {
-                    "order": "Lưu thông tin đơn hàng của khách hàng",
-                    "product": "Chứa thông tin về tên, mô tả về thành phần, màu sắc đồ uống,... và hình ảnh của các sản phẩm đang bán",
-                    "variant": "Chứa thông tin chi tiết về từng biến thể của một sản phẩm đồ uống như kích cỡ, hàm lượng dinh dường, giá, hạng bán ra.",
-                    "categories": "Lưu danh sách các danh mục phân loại sản phẩm đồ uống. Mỗi danh mục tương ứng với một nhóm sản phẩm cùng loại (ví dụ: cà phê, trà, nước ép). Các sản phẩm thuộc danh mục lưu ở bảng productproduct",
-            }
-
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            tables = cursor.fetchall()
-
-            schema_info = []
-            for table in tables:
-                table_name = table[0]
-
-                if table_name.lower() in ["customers"]:
-                    continue
-
-                cursor.execute(f"PRAGMA table_info({table_name})")
-                columns = cursor.fetchall()
-
-                cursor.execute(f"PRAGMA foreign_key_list({table_name})")
-                foreign_keys = cursor.fetchall()
-
-                cursor.execute(f"PRAGMA index_list({table_name})")
-                indexes = cursor.fetchall()
-
-                column_info = []
-                for col in columns:
-                    col_name = col[1]
-                    col_type = col[2]
-                    is_pk = col[5] == 1
-                    pk_info = " (PRIMARY KEY)" if is_pk else ""
-                    column_info.append(f"{col_name} ({col_type}){pk_info}")
-
-                fk_info = []
-                for fk in foreign_keys:
-                    ref_table = fk[2]
-                    from_col = fk[3]
-                    to_col = fk[4]
-                    fk_info.append(f"FOREIGN KEY ({from_col}) REFERENCES {ref_table}({to_col})")
-
-                index_info = []
-                for idx in indexes:
-                    idx_name = idx[1]
-                    is_unique = idx[2] == 1
-                    if not idx_name.startswith('sqlite_autoindex'):
-                        index_info.append(f"{'UNIQUE ' if is_unique else ''}INDEX {idx_name}")
-
-                description = table_descriptions.get(table_name.lower(), "Không có mô tả.")
-                table_info = [f"Bảng {table_name}: {description}"]
-                table_info.extend(column_info)
-                if fk_info:
-                    table_info.append("\nKhóa ngoại:")
-                    table_info.extend(fk_info)
-                if index_info:
-                    table_info.append("\nChỉ mục:")
-                    table_info.extend(index_info)
-
-                schema_info.append("\n".join(table_info))
-
-            conn.close()
-            return "\n\n".join(schema_info)
 
+
+    def _load_sql_entities(self) -> Dict[str, List[str]]:
+        """Tên sản phẩm và danh mục dùng để tách tham số khỏi câu hỏi cho SQL plan cache"""
+        entities = {}
+        for kind, sql in (("product", "SELECT Name_Product FROM Product"), ("category", "SELECT Name_Cat FROM Categories")):
+            try:
+                entities[kind] = [row[0] for row in self.db_pool.fetchall(sql) if row[0]]
+            except Exception as e:
+                print(f"Error loading {kind} names for SQL plan cache: {e}")
+                entities[kind] = []
+        return entities
+
+    def _get_database_schema(self, compact: bool = False) -> str:
+        """Get cached database schema information with descriptions"""
+        try:
+            if compact:
+                return self.schema_cache.get_compact_schema()
+            return self.schema_cache.get_schema()
         except Exception as e:
             print(f"Error getting database schema: {e}")
             return ""
 
 
-    def _answer_with_vector(self, user_key: str, query: str, user_info: dict, purchase_history: list, is_image_upload: bool = False, image_path: str = None) -> str:
-        """Answer query using vector search, with a special prompt for image uploads"""
+    def _similarity_search(self, vector_store: FAISS, query: str, k: int) -> List[Tuple[Any, float]]:
+        """Embed câu hỏi (qua cache + pool suy luận) rồi tìm FAISS trên pool suy luận"""
+        query_vector = self.embeddings.embed_query(query)
+        return run_inference(MODEL_POOL, vector_store.similarity_search_with_score_by_vector, query_vector, k=k)
+
+    def warmup(self, query: str = "cà phê"):
+        """Chạy thử một lượt retrieval trên mỗi vector store đã có; store trống (database chưa có dữ liệu) được bỏ qua.
+
+        Câu hỏi mẫu của router cũng được embed ở đây thay vì ở request đầu tiên được định tuyến.
+        """
+        if self.query_router is not None and self.query_router.embeddings is not None:
+            self.query_router._ensure_examples()
+        for name, store in (("vector_store", self.vector_store),
+                            ("description_vector_store", self.description_vector_store)):
+            if store is None:
+                print(f"Warm-up: {name} is empty, skipping")
+                continue
+            self._similarity_search(store, query, 1)
+
+    def _retrieve_text_docs(self, query: str) -> List[Tuple[Any, float]]:
+        """Tìm kiếm văn bản trên vector store chính (dùng cho retrieval suy đoán)"""
+        return self._similarity_search(self.vector_store, query, self.config.top_k_results)
+
+    @staticmethod
+    def _future_result(future: Optional[Future], name: str, default: Any = None) -> Any:
+        """Lấy kết quả của một bước chạy song song; lỗi được log và thay bằng giá trị mặc định"""
+        if future is None:
+            return default
+        try:
+            return future.result()
+        except Exception as e:
+            print(f"Error in pipeline stage {name}: {e}")
+            return default
+
+    def _generate_answer(self, prompt: str, on_token: Optional[Callable[[str], None]] = None) -> str:
+        """Gọi LLM sinh câu trả lời cuối; với ``on_token`` thì stream và gọi nó cho từng đoạn text"""
+        if on_token is None:
+            response = self.llm.invoke(prompt)
+            return getattr(response, "content", str(response)).strip()
+
+        parts = []
+        for chunk in self.llm.stream(prompt):
+            text = getattr(chunk, "content", chunk)
+            if isinstance(text, str) and text:
+                parts.append(text)
+                on_token(text)
+        return "".join(parts).strip()
+
+    def _answer_with_vector(self, user_key: str, query: str, user_info: dict, purchase_history: list, is_image_upload: bool = False, image_path: str = None,
+                            text_docs: Optional[List[Tuple[Any, float]]] = None, timer: Optional[StageTimer] = None,
+                            on_token: Optional[Callable[[str], None]] = None) -> str:
+        """Answer query using vector search, with a special prompt for image uploads.
+
+        ``text_docs`` là kết quả retrieval đã chạy trước (suy đoán) cho vector store chính;
+        nếu không có thì tìm kiếm lại ở đây.
+        """
+        timer = timer or StageTimer(label=f"user={user_key}")
         try:
             print("\n=== Bắt đầu tìm kiếm ===")
             print(f"Query: {query}")
@@ -228,10 +344,11 @@ class OptimizedRAGSystem:
 
             # Tìm kiếm dựa trên mô tả văn bản
             print("\n=== Tìm kiếm dựa trên mô tả văn bản ===")
-            text_docs = vector_store.similarity_search_with_score(
-                query,
-                k=self.config.top_k_results
-            )
+            if text_docs is None or is_image_upload:
+                with timer.stage("retrieval"):
+                    text_docs = self._similarity_search(vector_store, query, self.config.top_k_results)
+            else:
+                print("Dùng kết quả retrieval đã chạy song song với bước chọn tool")
             print(f"Số kết quả tìm kiếm văn bản: {len(text_docs)}")
             for i, (doc, score) in enumerate(text_docs):
                 print(f"\nKết quả văn bản {i+1}:")
@@ -241,59 +358,62 @@ class OptimizedRAGSystem:
 
             if is_image_upload and image_path:
                 print("\n=== Tìm kiếm dựa trên đặc trưng ảnh ===")
-                # Khởi tạo hybrid search
-                hybrid_search = HybridSearchResult(self.config)
+                hybrid_search = self.hybrid_search
 
                 # Tìm kiếm dựa trên đặc trưng ảnh
-                image_results = hybrid_search.search_by_image_features(
-                    image_path,  # Sử dụng đường dẫn ảnh upload
-                    k=self.config.top_k_results
-                )
+                with timer.stage("image_search"):
+                    image_results = hybrid_search.search_by_image_features(
+                        image_path,  # Sử dụng đường dẫn ảnh upload
+                        k=self.config.top_k_results
+                    )
                 print(f"Số kết quả tìm kiếm ảnh: {len(image_results)}")
-                for i, (meta, dist) in enumerate(image_results):
+                for i, (meta, score) in enumerate(image_results):
                     print(f"\nKết quả ảnh {i+1}:")
                     print(f"Metadata: {meta}")
-                    print(f"Distance: {dist}")
+                    print(f"{'Similarity' if hybrid_search.indexer.higher_is_better else 'Distance'}: {score}")
+
+                # Lấy thông tin tất cả sản phẩm xuất hiện trong hai danh sách kết quả bằng một lần tra cứu
+                products_info = hybrid_search.get_products_info(
+                    [doc.metadata.get('ID') for doc, _ in text_docs] +
+                    [meta.get('product_id') for meta, _ in image_results]
+                )
 
                 # Chuẩn hóa metadata từ kết quả văn bản
                 text_results = []
                 for doc, score in text_docs:
                     # Lấy product_id từ metadata của văn bản
                     product_id = doc.metadata.get('ID')
-                    if product_id:
-                        # Lấy thông tin sản phẩm từ database
-                        product_info = hybrid_search._get_product_info(product_id)
-                        if product_info:
-                            text_results.append({
-                                'product_id': product_id,
-                                'name': product_info['name'],
-                                'description': product_info['description'],
-                                'price': product_info['price'],
-                                'score': score
-                            })
+                    product_info = products_info.get(product_id)
+                    if product_info:
+                        text_results.append({
+                            'product_id': product_id,
+                            'name': product_info['name'],
+                            'description': product_info['description'],
+                            'price': product_info['price'],
+                            'score': score
+                        })
 
                 # Chuẩn hóa metadata từ kết quả ảnh
                 image_results_normalized = []
                 for meta, dist in image_results:
                     product_id = meta.get('product_id')
-                    if product_id:
-
-                        product_info = hybrid_search._get_product_info(product_id)
-                        if product_info:
-                            image_results_normalized.append(({
-                                'product_id': product_id,
-                                'name': product_info['name'],
-                                'description': product_info['description'],
-                                'price': product_info['price'],
-                            }, dist))
+                    product_info = products_info.get(product_id)
+                    if product_info:
+                        image_results_normalized.append(({
+                            'product_id': product_id,
+                            'name': product_info['name'],
+                            'description': product_info['description'],
+                            'price': product_info['price'],
+                        }, dist))
 
                 # Kết hợp kết quả từ hai phương pháp
-                combined_results = hybrid_search.combine_results_mbr(
-                    text_results=text_results,
-                    image_results=image_results_normalized,
-                    alpha=0.5,
-                    k=self.config.top_k_results
-                )
+                with timer.stage("mbr_fusion"):
+                    combined_results = hybrid_search.combine_results_mbr(
+                        text_results=text_results,
+                        image_results=image_results_normalized,
+                        alpha=0.5,
+                        k=self.config.top_k_results
+                    )
                 print(f"Số kết quả sau khi kết hợp: {len(combined_results)}")
                 for i, result in enumerate(combined_results):
                     print(f"\nKết quả kết hợp {i+1}:")
@@ -302,27 +422,22 @@ class OptimizedRAGSystem:
                 # Tạo context từ kết quả kết hợp với rank
                 context = []
                 for i, result in enumerate(combined_results):
-                    # Lấy product_id từ kết quả
-                    product_id = result.get('product_id')
-                    # Lấy thông tin chi tiết sản phẩm với giá các biến thể
-                    detailed_info = hybrid_search._get_product_info(product_id)
-                    # Thêm thông tin vào context
+                    # Thông tin chi tiết sản phẩm với giá các biến thể đã có sẵn từ lần tra cứu ở trên
+                    detailed_info = products_info[result.get('product_id')]
                     context.append(f"Rank {i+1}: Tên: {detailed_info['name']}, Mô tả: {detailed_info['description']}, Giá: {detailed_info['variant_prices']}")
             else:
+                products_info = self.hybrid_search.get_products_info(
+                    [doc.metadata.get('ID') for doc, _ in text_docs]
+                )
                 # Tạo context từ kết quả văn bản với rank
                 context = []
                 for i, (doc, score) in enumerate(text_docs):
-                    # Lấy product_id từ metadata
-                    product_id = doc.metadata.get('ID')
-                    if product_id:
-                        # Khởi tạo hybrid search để lấy thông tin chi tiết sản phẩm
-                        hybrid_search = HybridSearchResult(self.config)
-                        # Lấy thông tin chi tiết sản phẩm với giá các biến thể
-                        detailed_info = hybrid_search._get_product_info(product_id)
-                        # Thêm thông tin vào context
+                    # Lấy thông tin chi tiết sản phẩm với giá các biến thể
+                    detailed_info = products_info.get(doc.metadata.get('ID'))
+                    if detailed_info:
                         context.append(f"Rank {i+1}: Tên: {detailed_info['name']}, Mô tả: {detailed_info['description']}, Giá: {detailed_info['variant_prices']}")
                     else:
-                        # Trường hợp hiếm gặp khi không có product_id
+                        # Trường hợp không có product_id (tài liệu từ các bảng khác)
                         context.append(f"Rank {i+1}: {doc.page_content}")
 
             recent_history = self.chat_history.get_latest_chat(user_key)
@@ -334,43 +449,69 @@ class OptimizedRAGSystem:
 
             print("\n=== Prompt gửi cho LLM ===")
             print(prompt)
-            response = self.llm.invoke(prompt)
-
-            return getattr(response, "content", str(response)).strip()
+            with timer.stage("answer_generation"):
+                return self._generate_answer(prompt, on_token)
 
+        except InferenceBusy:
+            raise
         except Exception as e:
             print(f"\n=== Lỗi xảy ra ===")
             print(f"Error: {str(e)}")
             return f"Lỗi khi xử lý câu hỏi: {str(e)}"
 
 
-    def _answer_with_sql(self, user_key: str, query: str, user_info: dict, purchase_history: list) -> str:
-        """Answer query using SQL"""
+    def _answer_with_sql(self, user_key: str, query: str, user_info: dict, purchase_history: list, timer: Optional[StageTimer] = None,
+                         use_plan_cache: bool = False, on_token: Optional[Callable[[str], None]] = None) -> str:
+        """Answer query using SQL.
+
+        Với ``use_plan_cache``, SQL được lấy từ SQL plan cache nếu đã có plan cho cùng dạng câu
+        hỏi, bỏ qua bước LLM sinh SQL. SQL mà LLM giải nghĩa bằng lịch sử chat (tên món không có
+        trong câu hỏi) bị ``SQLPlanCache`` từ chối lưu nên plan được tra cả khi có lịch sử.
+        """
+        timer = timer or StageTimer(label=f"user={user_key}")
         try:
+            schema_info = self._get_database_schema()
             # Lấy đoạn chat gần nhất
             latest_chat = self.chat_history.get_latest_chat(user_key)
+            cached_plan = None
+            if use_plan_cache:
+                with timer.stage("sql_plan_lookup"):
+                    cached_plan = self.sql_plan_cache.lookup(query, schema_info)
+
+            if cached_plan is not None:
+                plan, sql_params = cached_plan
+                sql_query_string = plan.template_sql
+                print(f"Using cached SQL plan (from '{plan.source_query}'): {sql_query_string} with {sql_params}")
+            else:
+                sql_prompt = PromptManager.get_sql_generation_prompt(
+                    query=query,
+                    schema_info=schema_info,
+                    history=latest_chat
+                )
+                with timer.stage("sql_generation"):
+                    sql_query_response = self.llm.invoke(sql_prompt)
 
-            sql_prompt = PromptManager.get_sql_generation_prompt(
-                query=query,
-                schema_info=self._get_database_schema(),
-                history=latest_chat
-            )
-            sql_query_response = self.llm.invoke(sql_prompt)
+                sql_query_string = sql_query_response.content.strip() if hasattr(sql_query_response, 'content') else str(sql_query_response).strip()
 
-            sql_query_string = sql_query_response.content.strip() if hasattr(sql_query_response, 'content') else str(sql_query_response).strip()
+                if sql_query_string.startswith("```") and sql_query_string.endswith("```"):
+                    sql_query_string = "\n".join(sql_query_string.splitlines()[1:-1]).strip()
+                print("Generated SQL query:", sql_query_string)
 
-            if sql_query_string.startswith("```") and sql_query_string.endswith("```"):
-                sql_query_string = "\n".join(sql_query_string.splitlines()[1:-1]).strip()
-            print("Generated SQL query:", sql_query_string)
+                if not validate_sql_query(sql_query_string):
+                    return "Xin lỗi, tôi không thể thực hiện truy vấn này vì lý do an toàn hoặc truy vấn không hợp lệ."
+                sql_params = None
 
-            if not validate_sql_query(sql_query_string):
-                return "Xin lỗi, tôi không thể thực hiện truy vấn này vì lý do an toàn hoặc truy vấn không hợp lệ."
+            with timer.stage("sql_execution"):
+                results = execute_sql_query(
+                    self.config.db_path,
+                    sql_query_string,
+                    self.config.db_timeout,
+                    params=sql_params
+                )
 
-            results = execute_sql_query(
-                self.config.db_path,
-                sql_query_string,
-                self.config.db_timeout
-            )
+            # Chỉ lưu plan khi SQL vừa sinh chạy ra kết quả (execute_sql_query trả [] cả khi lỗi)
+            if use_plan_cache and cached_plan is None and results:
+                self.sql_plan_cache.store(query, sql_query_string, schema_info, timer.stages.get("sql_generation", 0.0))
 
 
             formatted_results = format_sql_results(results)
@@ -384,83 +525,172 @@ class OptimizedRAGSystem:
                 purchase_history=purchase_history
             )
             print(response_prompt)
-            final_response = self.llm.invoke(response_prompt)
-            return final_response.content.strip() if hasattr(final_response, 'content') else str(final_response).strip()
+            with timer.stage("answer_generation"):
+                return self._generate_answer(response_prompt, on_token)
 
         except Exception as e:
             print(f"Error during SQL processing: {e}")
             return f"Lỗi khi xử lý câu hỏi liên quan đến SQL: {str(e)}"
 
 
-    def answer_query(self, user_key: str, query: str) -> str:
-        """Process query and return answer using LangChain tool calling"""
-        try:
-            print(f"Processing query: {query} for user: {user_key}")
+    def _select_tool_with_llm(self, user_key: str, query: str) -> Optional[str]:
+        """Hỏi LLM (tool calling) nên dùng tool nào cho câu hỏi"""
+        data_schema = self._get_database_schema(compact=True)
+        recent_history_str = self.chat_history.get_latest_chat(user_key)
+
+        # Create context prompt for tool selection
+        context_prompt = self.tool_manager.create_tool_selection_prompt(
+            recent_history_str=recent_history_str,
+            query=query,
+            data_schema=data_schema
+        )
 
-            user_info = self._get_user_info(user_key)
-            data_schema = self._get_database_schema()
-            recent_history_str = self.chat_history.get_latest_chat(user_key)
-            purchase_history = get_purchase_history(user_key)
+        llm_with_tools = self.llm.bind_tools(self.tool_manager.get_tools())
 
-            # Create context prompt for tool selection
-            context_prompt = self.tool_manager.create_tool_selection_prompt(
-                recent_history_str=recent_history_str,
-                query=query,
-                data_schema=data_schema
-            )
+        print("Invoking LLM with tool calling...")
+        response = llm_with_tools.invoke(context_prompt)
+        print(f"LLM Response: {response}")
 
-            llm_with_tools = self.llm.bind_tools(self.tool_manager.get_tools())
+        return self.tool_manager.process_tool_response(response)
 
-            print("Invoking LLM with tool calling...")
-            response = llm_with_tools.invoke(context_prompt)
-            print(f"LLM Response: {response}")
+    def answer_query(self, user_key: str, query: str, on_stage: Optional[Callable[[str, float], None]] = None,
+                     on_token: Optional[Callable[[str], None]] = None) -> str:
+        """Process query and return answer using LangChain tool calling.
+
+        Tool được chọn bởi router cục bộ; LLM chỉ được hỏi khi router không đủ tin cậy.
+        Tra cứu thông tin người dùng, lịch sử mua hàng và retrieval văn bản (suy đoán) được
+        chạy song song trong lúc LLM chọn tool. Kết quả retrieval được dùng lại nếu tool vector
+        được chọn và bị bỏ đi nếu tool SQL được chọn. ``on_stage(name, seconds)`` được gọi
+        ngay khi mỗi bước kết thúc; ``on_token(text)`` nhận từng đoạn câu trả lời khi LLM
+        sinh câu trả lời cuối (câu trả lời từ cache hoặc thông báo lỗi không đi qua ``on_token``).
+        """
+        timer = StageTimer(label=f"user={user_key}", on_stage=on_stage)
+        retrieval_future = None
+        try:
+            print(f"Processing query: {query} for user: {user_key}")
 
-            tool_name = self.tool_manager.process_tool_response(response)
+            user_info_future = self._executor.submit(timer.timed, "user_info", self._get_user_info, user_key)
+            purchase_history_future = self._executor.submit(timer.timed, "purchase_history", get_purchase_history, user_key)
+
+            # Response cache, tra trước khi chọn tool (mọi route của scope). Scope theo người dùng nếu
+            # câu trả lời được cá nhân hóa; lượt chat gần nhất chỉ được gắn vào scope khi câu hỏi
+            # phụ thuộc vào nó ("Giá bao nhiêu?" sau câu hỏi về một món), câu hỏi độc lập dùng chung
+            # câu trả lời bất kể lịch sử chat.
+            cache_context = self.chat_history.get_latest_chat(user_key) if is_context_dependent(query) else ""
+            cache_scope = ResponseCache.scope_for(user_key, personalized=user_key != "anonymous", context=cache_context)
+            query_vector = None
+            if self.response_cache.enabled:
+                with timer.stage("response_cache"):
+                    query_vector = self.embeddings.embed_query(query)
+                    cached_response = self.response_cache.get(None, cache_scope, query_vector)
+                if cached_response is not None:
+                    self.chat_history.add_chat(user_key, query, cached_response)
+                    print(f"[timing] user={user_key} summary: {timer.summary()}")
+                    return cached_response
+
+            # Router cục bộ (luật + kNN); chỉ gọi LLM chọn tool khi router không đủ tin cậy
+            decision = None
+            if self.query_router is not None:
+                with timer.stage("routing"):
+                    decision = self.query_router.route(query)
+                print(f"Query router decision: {decision}")
+
+            if decision is not None and not decision.needs_llm:
+                tool_name = decision.tool
+                if tool_name == VECTOR_TOOL and self.vector_store is not None:
+                    retrieval_future = self._executor.submit(timer.timed, "retrieval", self._retrieve_text_docs, query)
+            else:
+                if self.config.speculative_retrieval and self.vector_store is not None:
+                    retrieval_future = self._executor.submit(timer.timed, "retrieval", self._retrieve_text_docs, query)
+                with timer.stage("tool_selection"):
+                    tool_name = self._select_tool_with_llm(user_key, query)
             print(f"Selected tool: {tool_name}")
+            cache_route = SQL_TOOL if tool_name == SQL_TOOL else VECTOR_TOOL
+
+            user_info = self._future_result(user_info_future, "user_info")
+            purchase_history = self._future_result(purchase_history_future, "purchase_history", [])
 
             final_response = ""
 
-            if tool_name == "use_sql_tool":
-                final_response = self._answer_with_sql(user_key, query, user_info, purchase_history)
-            elif tool_name == "use_vector_tool":
-                is_image_upload = False
-                final_response = self._answer_with_vector(user_key, query, user_info, purchase_history, is_image_upload)
+            if tool_name == SQL_TOOL:
+                if retrieval_future is not None and not retrieval_future.cancel():
+                    print("Discarding speculative retrieval result (SQL tool selected)")
+                final_response = self._answer_with_sql(user_key, query, user_info, purchase_history, timer=timer,
+                                                       use_plan_cache=True, on_token=on_token)
             else:
-                # Fallback to vector tool if no tool is selected
-                print(f"No tool selected or unknown tool: '{tool_name}', falling back to vector tool")
-                is_image_upload = False
-                final_response = self._answer_with_vector(user_key, query, user_info, purchase_history, is_image_upload)
+                if tool_name != VECTOR_TOOL:
+                    # Fallback to vector tool if no tool is selected
+                    print(f"No tool selected or unknown tool: '{tool_name}', falling back to vector tool")
+                text_docs = self._future_result(retrieval_future, "retrieval")
+                final_response = self._answer_with_vector(
+                    user_key, query, user_info, purchase_history, is_image_upload=False,
+                    text_docs=text_docs, timer=timer, on_token=on_token
+                )
+
+            if query_vector is not None and not final_response.startswith(_ERROR_RESPONSE_PREFIXES):
+                self.response_cache.put(cache_route, cache_scope, query_vector, query, final_response)
 
             self.chat_history.add_chat(user_key, query, final_response)
+            print(f"[timing] user={user_key} summary: {timer.summary()}")
             return final_response
 
+        except InferenceBusy:
+            # Quá tải: không ghi vào lịch sử chat, để lớp gọi trả 503 cho client
+            if retrieval_future is not None:
+                retrieval_future.cancel()
+            raise
         except Exception as e:
+            if retrieval_future is not None:
+                retrieval_future.cancel()
             error_msg = f"Lỗi hệ thống khi xử lý yêu cầu: {str(e)}"
             print(f"Error in answer_query: {error_msg}")
             self.chat_history.add_chat(user_key, query, error_msg)
             return error_msg
 
 
+    def answer_query_stream(self, user_key: str, query: str,
+                            on_stage: Optional[Callable[[str, float], None]] = None) -> Iterator[Tuple[str, Any]]:
+        """Như ``answer_query`` nhưng trả về generator các sự kiện ``(loại, giá trị)``.
+
+        ``("token", text)`` cho từng đoạn câu trả lời khi LLM đang sinh, rồi ``("done", câu
+        trả lời đầy đủ)``; ``("error", exception)`` nếu ``answer_query`` ném lỗi (ví dụ
+        ``InferenceBusy``). Câu trả lời không được stream (từ cache, thông báo lỗi) được gửi
+        thành một token duy nhất trước ``done``.
+        """
+        events: "queue.Queue[Tuple[str, Any]]" = queue.Queue()
+        streamed = []
+
+        def on_token(text: str):
+            streamed.append(text)
+            events.put(("token", text))
+
+        def run():
+            try:
+                events.put(("done", self.answer_query(user_key, query, on_stage=on_stage, on_token=on_token)))
+            except Exception as e:
+                events.put(("error", e))
+
+        # Thread riêng thay vì self._executor: answer_query tự gửi các bước con vào executor,
+        # chiếm một worker của nó để chờ các bước đó có thể làm cạn executor khi nhiều stream
+        threading.Thread(target=run, name="rag-stream", daemon=True).start()
+        while True:
+            kind, value = events.get()
+            if kind == "token":
+                yield kind, value
+                continue
+            if kind == "done" and not streamed and value:
+                yield "token", value
+            yield kind, value
+            return
+
     def _get_user_info(self, user_key: str) -> dict:
         """Fetch user information based on user key"""
         if user_key == "anonymous":
             return None
 
         try:
-
-            db_path = os.path.join(os.path.dirname(__file__), '..', 'Database.db')
-            if not os.path.exists(db_path):
-                db_path = os.path.join(os.path.dirname(__file__), 'Database.db')
-                if not os.path.exists(db_path):
-                    print(f"Database file not found at expected locations.")
-                    return None
-
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
             query = "SELECT id, name, sex FROM Customers WHERE id = ?"
-            cursor.execute(query, (user_key,))
-            result = cursor.fetchone()
-            conn.close()
+            result = self.db_pool.fetchone(query, (user_key,))
 
             if result:
                 return {"id": result[0], "name": result[1], "sex": result[2]}
@@ -481,11 +711,7 @@ class OptimizedRAGSystem:
         """Initialize description vector store if exists, otherwise create it"""
         if os.path.exists(self.config.description_vector_store_path):
             try:
-                return FAISS.load_local(
-                    self.config.description_vector_store_path,
-                    self.embeddings,
-                    allow_dangerous_deserialization=True
-                )
+                return self._load_store(self.config.description_vector_store_path)
             except Exception as e:
                 print(f"Error loading description vector store: {e}")
 
@@ -0,0 +1,187 @@
+import time
+import hashlib
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+ANONYMOUS_SCOPE = "anonymous"
+
+
+@dataclass
+class _Entry:
+    query: str
+    response: str
+    created: float
+    last_used: float
+    hits: int = 0
+
+
+class _ScopeIndex:
+    """Các câu trả lời đã cache của một scope (route, user) cùng ma trận embedding câu hỏi."""
+
+    def __init__(self, dim: int):
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.entries: List[_Entry] = []
+
+    def add(self, vector: np.ndarray, entry: _Entry):
+        self.vectors = np.vstack([self.vectors, vector[None, :]])
+        self.entries.append(entry)
+
+    def remove(self, positions: List[int]):
+        keep = [i for i in range(len(self.entries)) if i not in set(positions)]
+        self.vectors = self.vectors[keep]
+        self.entries = [self.entries[i] for i in keep]
+
+
+class ResponseCache:
+    """Cache ngữ nghĩa cho câu trả lời của ``answer_query``.
+
+    Một câu hỏi trúng cache khi cosine giữa embedding của nó và một câu hỏi đã cache
+    trong cùng scope đạt ``similarity_threshold``. Scope gồm route (tool SQL/vector) và
+    người dùng: câu trả lời cho người dùng đã xác thực phụ thuộc ``user_info`` và lịch sử
+    mua hàng nên chỉ dùng lại cho chính người đó; người dùng ẩn danh dùng chung một scope.
+    Câu trả lời cho câu hỏi nối tiếp ("Giá bao nhiêu?") phụ thuộc lượt chat trước, nên nơi gọi
+    gắn hash của lượt chat gần nhất vào scope của riêng những câu hỏi đó
+    (``scope_for(..., context=...)``): chỉ lượt hỏi có cùng ngữ cảnh mới dùng lại được câu trả
+    lời; câu hỏi độc lập với ngữ cảnh dùng chung scope của người dùng. ``get`` với
+    ``route=None`` tra mọi route của scope, để nơi gọi tra cache trước khi chọn tool.
+    Toàn bộ cache bị xóa khi ``data_version()`` (phiên bản nội dung database) thay đổi.
+    """
+
+    def __init__(self, data_version: Callable[[], str], similarity_threshold: float = 0.97,
+                 max_entries: int = 2000, ttl_seconds: float = 3600, enabled: bool = True):
+        self.data_version = data_version
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self._scopes: Dict[Tuple[str, str], _ScopeIndex] = {}
+        self._version: Optional[str] = None
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.hits_by_route: Dict[str, int] = {}
+        self.stores = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def scope_for(user_key: str, personalized: bool, context: str = "") -> str:
+        """Scope của câu trả lời; ``context`` là lượt chat gần nhất mà câu trả lời có thể phụ thuộc."""
+        scope = str(user_key) if personalized else ANONYMOUS_SCOPE
+        if context:
+            scope += "#" + hashlib.sha1(context.encode("utf-8")).hexdigest()[:16]
+        return scope
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        return vector / (np.linalg.norm(vector) + 1e-8)
+
+    def _check_version(self):
+        """Xóa cache nếu nội dung database đã đổi. Gọi khi đang giữ ``_lock``."""
+        version = self.data_version()
+        if version != self._version:
+            if self._scopes:
+                self.invalidations += 1
+                print(f"Response cache invalidated (data version changed), dropped {self._size()} entries")
+            self._scopes.clear()
+            self._version = version
+
+    def _size(self) -> int:
+        return sum(len(index.entries) for index in self._scopes.values())
+
+    def get(self, route: Optional[str], scope: str, vector) -> Optional[str]:
+        """Trả về câu trả lời đã cache gần nhất với ``vector`` hoặc None; ``route=None`` = mọi route."""
+        if not self.enabled:
+            return None
+        query_vector = self._normalize(vector)
+        with self._lock:
+            self.lookups += 1
+            self._check_version()
+            now = time.time()
+            best_key, best_pos, best_similarity = None, None, -1.0
+            for key, index in self._scopes.items():
+                if key[1] != scope or (route is not None and key[0] != route):
+                    continue
+                expired = [i for i, entry in enumerate(index.entries) if now - entry.created > self.ttl_seconds]
+                if expired:
+                    index.remove(expired)
+                    self.evictions += len(expired)
+                if not index.entries:
+                    continue
+                similarities = index.vectors @ query_vector
+                pos = int(np.argmax(similarities))
+                if similarities[pos] > best_similarity:
+                    best_key, best_pos, best_similarity = key, pos, float(similarities[pos])
+
+            if best_key is None or best_similarity < self.similarity_threshold:
+                return None
+
+            entry = self._scopes[best_key].entries[best_pos]
+            entry.hits += 1
+            entry.last_used = now
+            self.hits += 1
+            self.hits_by_route[best_key[0]] = self.hits_by_route.get(best_key[0], 0) + 1
+            print(f"Response cache hit ({best_key[0]}/{scope}, similarity {best_similarity:.3f}): '{entry.query}'")
+            return entry.response
+
+    def put(self, route: str, scope: str, vector, query: str, response: str):
+        if not self.enabled:
+            return
+        query_vector = self._normalize(vector)
+        with self._lock:
+            self._check_version()
+            index = self._scopes.get((route, scope))
+            if index is None:
+                index = self._scopes[(route, scope)] = _ScopeIndex(query_vector.shape[0])
+            elif index.entries and float(np.max(index.vectors @ query_vector)) >= self.similarity_threshold:
+                return  # đã có câu hỏi tương đương trong cache
+            now = time.time()
+            index.add(query_vector, _Entry(query=query, response=response, created=now, last_used=now))
+            self.stores += 1
+            if self._size() > self.max_entries:
+                self._evict_lru()
+
+    def _evict_lru(self):
+        """Bỏ mục ít được dùng gần đây nhất trong toàn bộ cache. Gọi khi đang giữ ``_lock``."""
+        oldest_key, oldest_pos, oldest_time = None, None, float("inf")
+        for key, index in self._scopes.items():
+            for pos, entry in enumerate(index.entries):
+                if entry.last_used < oldest_time:
+                    oldest_key, oldest_pos, oldest_time = key, pos, entry.last_used
+        if oldest_key is not None:
+            self._scopes[oldest_key].remove([oldest_pos])
+            self.evictions += 1
+
+    def evict(self, route: Optional[str] = None, scope: Optional[str] = None) -> int:
+        """Xóa các mục khớp ``route`` và/hoặc ``scope`` (None = mọi giá trị, kể cả scope theo ngữ cảnh
+        của ``scope``); trả về số mục đã xóa."""
+        with self._lock:
+            removed = 0
+            for key in list(self._scopes):
+                if (route is None or key[0] == route) and (scope is None or key[1].split("#", 1)[0] == scope):
+                    removed += len(self._scopes.pop(key).entries)
+            self.evictions += removed
+            return removed
+
+    def clear(self) -> int:
+        return self.evict()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": self._size(),
+                "scopes": len(self._scopes),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                "hits_by_route": dict(self.hits_by_route),
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "similarity_threshold": self.similarity_threshold,
+            }
@@ -0,0 +1,155 @@
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from db_pool import get_pool
+
+# Mô tả cho từng bảng, dùng trong prompt chọn công cụ và sinh SQL
+TABLE_DESCRIPTIONS = {
+    "order": "Lưu thông tin đơn hàng của khách hàng",
+    "product": "Chứa thông tin về tên, mô tả về thành phần, màu sắc đồ uống,... và hình ảnh của các sản phẩm đang bán",
+    "variant": "Chứa thông tin chi tiết về từng biến thể của một sản phẩm đồ uống như kích cỡ, hàm lượng dinh dường, giá, hạng bán ra.",
+    "categories": "Lưu danh sách các danh mục phân loại sản phẩm đồ uống. Mỗi danh mục tương ứng với một nhóm sản phẩm cùng loại (ví dụ: cà phê, trà, nước ép). Các sản phẩm thuộc danh mục lưu ở bảng productproduct",
+}
+
+# Các bảng không đưa vào prompt (dữ liệu cá nhân, embedding khuôn mặt)
+EXCLUDED_TABLES = {"customers"}
+
+
+class SchemaCache:
+    """Giữ mô tả schema database trong bộ nhớ, chỉ dựng lại khi schema thay đổi.
+
+    Việc kiểm tra rất rẻ: chỉ ``os.stat`` file database (và file WAL). Khi mtime
+    thay đổi mới đọc ``PRAGMA schema_version``; schema chỉ được dựng lại nếu
+    schema_version khác lần trước (ghi dữ liệu thông thường không làm đổi nó).
+    """
+
+    def __init__(self, db_path: str, table_descriptions: Optional[Dict[str, str]] = None):
+        self.db_path = db_path
+        self.table_descriptions = table_descriptions or TABLE_DESCRIPTIONS
+        self._lock = threading.Lock()
+        self._file_version: Optional[Tuple[int, ...]] = None
+        self._schema_version: Optional[int] = None
+        self._tables: Dict[str, str] = {}
+        self._compact_tables: Dict[str, str] = {}
+        self._full_schema = ""
+        self._compact_schema = ""
+        self.refresh()
+
+    def _ensure_fresh(self):
+        file_version = get_pool(self.db_path).file_version()
+        if file_version == self._file_version:
+            return
+        with self._lock:
+            if file_version == self._file_version:
+                return
+            try:
+                with get_pool(self.db_path).connection() as conn:
+                    schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+                    if schema_version != self._schema_version:
+                        print(f"Database schema changed (version {self._schema_version} -> {schema_version}), rebuilding schema description")
+                        self._build(conn)
+                        self._schema_version = schema_version
+                self._file_version = file_version
+            except Exception as e:
+                print(f"Error checking database schema version: {e}")
+
+    def refresh(self):
+        """Buộc đọc lại schema ở lần truy cập kế tiếp."""
+        with self._lock:
+            self._file_version = None
+            self._schema_version = None
+        self._ensure_fresh()
+
+    def _build(self, conn: sqlite3.Connection):
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        tables = cursor.fetchall()
+
+        full_tables = {}
+        compact_tables = {}
+        for table in tables:
+            table_name = table[0]
+
+            if table_name.lower() in EXCLUDED_TABLES:
+                continue
+
+            cursor.execute(f"PRAGMA table_info({table_name})")
+            columns = cursor.fetchall()
+
+            cursor.execute(f"PRAGMA foreign_key_list({table_name})")
+            foreign_keys = cursor.fetchall()
+
+            cursor.execute(f"PRAGMA index_list({table_name})")
+            indexes = cursor.fetchall()
+
+            column_info = []
+            for col in columns:
+                col_name = col[1]
+                col_type = col[2]
+                is_pk = col[5] == 1
+                pk_info = " (PRIMARY KEY)" if is_pk else ""
+                column_info.append(f"{col_name} ({col_type}){pk_info}")
+
+            fk_info = []
+            for fk in foreign_keys:
+                ref_table = fk[2]
+                from_col = fk[3]
+                to_col = fk[4]
+                fk_info.append(f"FOREIGN KEY ({from_col}) REFERENCES {ref_table}({to_col})")
+
+            index_info = []
+            for idx in indexes:
+                idx_name = idx[1]
+                is_unique = idx[2] == 1
+                if not idx_name.startswith('sqlite_autoindex'):
+                    index_info.append(f"{'UNIQUE ' if is_unique else ''}INDEX {idx_name}")
+
+            description = self.table_descriptions.get(table_name.lower(), "Không có mô tả.")
+            table_info = [f"Bảng {table_name}: {description}"]
+            table_info.extend(column_info)
+            if fk_info:
+                table_info.append("\nKhóa ngoại:")
+                table_info.extend(fk_info)
+            if index_info:
+                table_info.append("\nChỉ mục:")
+                table_info.extend(index_info)
+            full_tables[table_name] = "\n".join(table_info)
+
+            # Dạng rút gọn: một dòng cho mỗi bảng (kèm mô tả một dòng nếu có), đủ để LLM chọn công cụ
+            compact_columns = ", ".join(f"{col[1]}{' PK' if col[5] == 1 else ''}" for col in columns)
+            compact_fks = "; ".join(f"{fk[3]}->{fk[2]}.{fk[4]}" for fk in foreign_keys)
+            compact_line = f"{table_name}({compact_columns})"
+            if compact_fks:
+                compact_line += f" FK: {compact_fks}"
+            if table_name.lower() in self.table_descriptions:
+                compact_line += f" -- {self.table_descriptions[table_name.lower()]}"
+            compact_tables[table_name] = compact_line
+
+        self._tables = full_tables
+        self._compact_tables = compact_tables
+        self._full_schema = "\n\n".join(full_tables.values())
+        self._compact_schema = "\n".join(compact_tables.values())
+
+    def get_schema(self) -> str:
+        """Mô tả đầy đủ (cột, khóa ngoại, chỉ mục) của tất cả các bảng."""
+        self._ensure_fresh()
+        return self._full_schema
+
+    def get_compact_schema(self) -> str:
+        """Mỗi bảng một dòng: tên bảng, danh sách cột, khóa ngoại và mô tả bảng."""
+        self._ensure_fresh()
+        return self._compact_schema
+
+    def get_table_schema(self, table_name: str, compact: bool = False) -> str:
+        """Mô tả của một bảng cụ thể (không phân biệt hoa thường)."""
+        self._ensure_fresh()
+        tables = self._compact_tables if compact else self._tables
+        for name, info in tables.items():
+            if name.lower() == table_name.lower():
+                return info
+        return ""
+
+    def table_names(self) -> List[str]:
+        self._ensure_fresh()
+        return list(self._tables.keys())
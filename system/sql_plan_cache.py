@@ -0,0 +1,312 @@
+import re
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlglot import exp, parse_one, errors
+
+from .query_router import strip_accents
+
+_DATE_PATTERN = r"\d{4}-\d{2}-\d{2}|\d{1,2}/\d{1,2}/\d{4}"
+_NUMBER_PATTERN = r"(?<![\w.])(\d+(?:[.,]\d{3})*(?:[.,]\d+)?)\s*(k|nghìn|ngàn|nghin|ngan)?(?!\w)"
+# Phép so sánh mà literal trong đó là giá trị lọc dữ liệu (giá, id, tên), không phải cấu trúc câu SQL
+_COMPARISONS = (exp.EQ, exp.NEQ, exp.GT, exp.GTE, exp.LT, exp.LTE, exp.Between, exp.In, exp.Like, exp.ILike)
+
+
+@dataclass
+class Slot:
+    """Một giá trị cụ thể trích từ câu hỏi (tên sản phẩm, danh mục, số, ngày)."""
+    kind: str
+    value: Any      # dạng chuẩn: tên trong database, số đã nhân hệ số "k"
+    surface: Any    # dạng người dùng gõ / số trước khi nhân hệ số
+
+    def matches(self, other: "Slot") -> bool:
+        return self.kind == other.kind and str(self.value).lower() == str(other.value).lower()
+
+
+@dataclass
+class SQLPlan:
+    """SQL đã kiểm tra, với các literal lấy từ câu hỏi được thay bằng tham số ``:pN``."""
+    template_sql: str
+    # tên tham số -> (vị trí slot, dạng giá trị "value"/"surface", tiền tố, hậu tố)
+    params: Dict[str, Tuple[int, str, str, str]]
+    # Slot không xuất hiện trong SQL: câu hỏi mới phải có đúng giá trị này mới dùng lại được plan
+    fixed_slots: Dict[int, Slot]
+    source_query: str
+    generation_seconds: float
+    # AST đã parse (và kiểm tra) của template, giữ lại để không phải parse lại
+    ast: Optional[exp.Expression] = field(default=None, repr=False, compare=False)
+    hits: int = 0
+
+    def bind(self, slots: List[Slot]) -> Dict[str, Any]:
+        values = {}
+        for name, (index, form, prefix, suffix) in self.params.items():
+            value = getattr(slots[index], form)
+            values[name] = f"{prefix}{value}{suffix}" if (prefix or suffix or isinstance(value, str)) else value
+        return values
+
+
+def _to_number(text: str) -> float:
+    """'50.000' / '50,000' / '12.5' -> số."""
+    if re.fullmatch(r"\d{1,3}(?:[.,]\d{3})+", text):
+        return float(re.sub(r"[.,]", "", text))
+    return float(text.replace(",", "."))
+
+
+def _as_int_if_whole(value: float):
+    return int(value) if float(value).is_integer() else value
+
+
+class SQLPlanCache:
+    """Cache SQL do LLM sinh, khóa theo "ý định" đã chuẩn hóa của câu hỏi.
+
+    Tên sản phẩm/danh mục (lấy từ database), số và ngày trong câu hỏi được tách thành
+    slot; phần còn lại (bỏ dấu, chữ thường) là khóa ý định. Khi lưu, các literal trong
+    AST sqlglot trùng với giá trị slot được thay bằng tham số bind, nên một plan phục vụ
+    mọi câu hỏi cùng dạng ("giá Cappuccino", "giá Caffè Latte"). Plan chỉ được lưu sau
+    khi đã qua ``validate_sql_query``; khi trúng cache, SQL được chạy ngay với tham số mới
+    mà không cần gọi LLM hay kiểm tra lại. Literal cấu trúc không lấy từ câu hỏi (``LIMIT 5``,
+    ``ORDER BY 1``, cờ ``= 1``, ``'%'``) được giữ nguyên trong template. SQL có literal mang
+    giá trị cụ thể (tên món, ngày, giá, id) không lấy từ slot của câu hỏi, ví dụ tên món LLM
+    suy ra từ lịch sử chat, không được lưu, vì literal đó sẽ bị dùng lại nguyên văn cho mọi
+    câu hỏi cùng dạng.
+    """
+
+    def __init__(self, entity_source: Callable[[], Dict[str, List[str]]],
+                 data_version: Callable[[], str], max_entries: int = 500, enabled: bool = True):
+        self.entity_source = entity_source
+        self.data_version = data_version
+        self.max_entries = max(1, max_entries)
+        self.enabled = enabled
+        self._plans: "OrderedDict[str, List[SQLPlan]]" = OrderedDict()
+        self._schema_key: Optional[str] = None
+        self._entity_version: Optional[str] = None
+        self._pattern: Optional[re.Pattern] = None
+        self._entities: Dict[str, Tuple[str, str]] = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.stores = 0
+        self.uncacheable = 0
+        self.generation_seconds_saved = 0.0
+
+    # --- Trích slot từ câu hỏi ---
+
+    def _ensure_entities(self):
+        version = self.data_version()
+        if version == self._entity_version and self._pattern is not None:
+            return
+        entities: Dict[str, Tuple[str, str]] = {}
+        for kind, names in self.entity_source().items():
+            for name in names:
+                if name and name.strip():
+                    entities.setdefault(unicodedata.normalize("NFC", name.strip()).lower(), (kind, name.strip()))
+        alternatives = [re.escape(name) for name in sorted(entities, key=len, reverse=True)]
+        groups = [f"(?P<date>{_DATE_PATTERN})"]
+        if alternatives:
+            groups.append(f"(?<!\\w)(?P<entity>{'|'.join(alternatives)})(?!\\w)")
+        groups.append(_NUMBER_PATTERN.replace("(\\d+", "(?P<number>\\d+", 1).replace("(k|", "(?P<unit>k|", 1))
+        self._pattern = re.compile("|".join(groups), re.IGNORECASE)
+        self._entities = entities
+        self._entity_version = version
+
+    def normalize(self, question: str) -> Tuple[str, List[Slot]]:
+        """Trả về (khóa ý định, danh sách slot theo thứ tự xuất hiện)."""
+        with self._lock:
+            self._ensure_entities()
+            pattern, entities = self._pattern, self._entities
+        text = unicodedata.normalize("NFC", question or "")
+        slots: List[Slot] = []
+        parts: List[str] = []
+        last = 0
+        for match in pattern.finditer(text):
+            parts.append(text[last:match.start()])
+            last = match.end()
+            if match.group("date"):
+                slot = Slot("date", match.group("date"), match.group("date"))
+            elif "entity" in pattern.groupindex and match.group("entity"):
+                kind, name = entities[match.group("entity").lower()]
+                slot = Slot(kind, name, match.group("entity"))
+            else:
+                raw = _to_number(match.group("number"))
+                value = raw * 1000 if match.group("unit") and match.group("unit").lower() == "k" else raw
+                slot = Slot("number", _as_int_if_whole(value), _as_int_if_whole(raw))
+            slots.append(slot)
+            parts.append(f" <{slot.kind}> ")
+        parts.append(text[last:])
+        key = strip_accents("".join(parts))
+        key = " ".join(re.sub(r"[^\w<> ]", " ", key).split())
+        return key, slots
+
+    # --- Tạo template từ SQL ---
+
+    @staticmethod
+    def _bind_literal(literal: exp.Literal, slots: List[Slot]) -> Optional[Tuple[int, str, str, str]]:
+        if literal.is_number:
+            try:
+                number = float(literal.this)
+            except ValueError:
+                return None
+            for index, slot in enumerate(slots):
+                if slot.kind != "number":
+                    continue
+                for form in ("value", "surface"):
+                    if float(getattr(slot, form)) == number:
+                        return index, form, "", ""
+            return None
+
+        text = literal.this
+        lowered = text.lower()
+        for index, slot in enumerate(slots):
+            if slot.kind == "number":
+                continue
+            for form in ("value", "surface"):
+                value = str(getattr(slot, form))
+                position = lowered.find(value.lower())
+                if value and position >= 0:
+                    return index, form, text[:position], text[position + len(value):]
+        return None
+
+    @staticmethod
+    def _literal_context(literal: exp.Literal) -> Optional[exp.Expression]:
+        """Node cha có nghĩa của literal, bỏ qua dấu âm và ngoặc."""
+        parent = literal.parent
+        while isinstance(parent, (exp.Neg, exp.Paren)):
+            parent = parent.parent
+        return parent
+
+    @classmethod
+    def _is_filter_number(cls, literal: exp.Literal) -> bool:
+        """Số dùng để lọc dữ liệu (``price < 50000``, ``id = 7``), khác cờ 0/1 và hằng số tính toán."""
+        try:
+            return isinstance(cls._literal_context(literal), _COMPARISONS) and abs(float(literal.this)) > 1
+        except ValueError:
+            return False
+
+    def _is_bindable(self, literal: exp.Literal) -> bool:
+        """Literal có thể là giá trị lấy từ câu hỏi. Số thứ tự cột trong ``ORDER BY``, cờ 0/1 và hằng
+        số trong biểu thức tính toán là cấu trúc câu SQL, không gắn với slot dù câu hỏi có số trùng
+        ("top 1" không được biến ``is_active = 1`` thành tham số)."""
+        if literal.find_ancestor(exp.Limit, exp.Offset):
+            return True
+        if literal.find_ancestor(exp.Order):
+            return False
+        return self._is_filter_number(literal) if literal.is_number else True
+
+    def _is_entity_like(self, literal: exp.Literal, entities: Dict[str, Tuple[str, str]]) -> bool:
+        """Literal mang giá trị cụ thể của dữ liệu (tên món, danh mục, ngày, giá, id)."""
+        if literal.find_ancestor(exp.Limit, exp.Offset, exp.Order):
+            return False
+        if literal.is_number:
+            return self._is_filter_number(literal)
+        if not re.sub(r"[%_\s]", "", literal.this):
+            return False
+        if re.search(_DATE_PATTERN, literal.this) or isinstance(self._literal_context(literal), (exp.Like, exp.ILike)):
+            return True
+        name = unicodedata.normalize("NFC", literal.this.strip("%_ ")).lower()
+        return name in entities
+
+    def _build_plan(self, question: str, sql: str, slots: List[Slot], generation_seconds: float) -> Optional[SQLPlan]:
+        try:
+            ast = parse_one(sql.strip().rstrip(";"), read="sqlite")
+        except errors.ParseError as e:
+            print(f"SQL plan cache: cannot parse generated SQL, not caching ({e})")
+            return None
+        if ast is None or not isinstance(ast, (exp.Select, exp.Union)):
+            return None
+
+        with self._lock:
+            entities = self._entities
+        params: Dict[str, Tuple[int, str, str, str]] = {}
+        bound = set()
+        for literal in list(ast.find_all(exp.Literal)):
+            binding = self._bind_literal(literal, slots) if self._is_bindable(literal) else None
+            if binding is None:
+                if self._is_entity_like(literal, entities):
+                    print(f"SQL plan cache: literal {literal.sql()} does not come from the question, not caching")
+                    return None
+                continue  # literal cấu trúc, giữ nguyên trong template
+            name = f"p{len(params)}"
+            params[name] = binding
+            bound.add(binding[0])
+            literal.replace(exp.Placeholder(this=name))
+
+        fixed = {index: slot for index, slot in enumerate(slots) if index not in bound}
+        return SQLPlan(
+            template_sql=ast.sql(dialect="sqlite"),
+            ast=ast,
+            params=params,
+            fixed_slots=fixed,
+            source_query=question,
+            generation_seconds=generation_seconds
+        )
+
+    # --- API ---
+
+    def _check_schema(self, schema_info: str):
+        """Xóa toàn bộ plan khi schema đổi. Gọi khi đang giữ ``_lock``."""
+        schema_key = hashlib.sha1(schema_info.encode("utf-8")).hexdigest()
+        if schema_key != self._schema_key:
+            self._plans.clear()
+            self._schema_key = schema_key
+
+    def lookup(self, question: str, schema_info: str) -> Optional[Tuple[SQLPlan, Dict[str, Any]]]:
+        """Trả về (plan, tham số bind) nếu đã có plan cho cùng dạng câu hỏi."""
+        if not self.enabled:
+            return None
+        key, slots = self.normalize(question)
+        with self._lock:
+            self.lookups += 1
+            self._check_schema(schema_info)
+            for plan in self._plans.get(key, []):
+                if all(index < len(slots) and slot.matches(slots[index]) for index, slot in plan.fixed_slots.items()):
+                    self._plans.move_to_end(key)
+                    plan.hits += 1
+                    self.hits += 1
+                    self.generation_seconds_saved += plan.generation_seconds
+                    return plan, plan.bind(slots)
+        return None
+
+    def store(self, question: str, sql: str, schema_info: str, generation_seconds: float = 0.0) -> Optional[SQLPlan]:
+        """Lưu SQL đã qua kiểm tra cho câu hỏi; trả về plan hoặc None nếu không tạo được template."""
+        if not self.enabled:
+            return None
+        key, slots = self.normalize(question)
+        plan = self._build_plan(question, sql, slots, generation_seconds)
+        with self._lock:
+            if plan is None:
+                self.uncacheable += 1
+                return None
+            self._check_schema(schema_info)
+            plans = self._plans.setdefault(key, [])
+            plans.append(plan)
+            self._plans.move_to_end(key)
+            self.stores += 1
+            while len(self._plans) > self.max_entries:
+                self._plans.popitem(last=False)
+        print(f"SQL plan cached for intent '{key}' with params {list(plan.params)}: {plan.template_sql}")
+        return plan
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            plans = [plan for plans in self._plans.values() for plan in plans]
+            avg_generation = sum(p.generation_seconds for p in plans) / len(plans) if plans else 0.0
+            return {
+                "enabled": self.enabled,
+                "intents": len(self._plans),
+                "plans": len(plans),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                "stores": self.stores,
+                "uncacheable": self.uncacheable,
+                "avg_generation_ms": round(avg_generation * 1000, 1),
+                "generation_time_saved_s": round(self.generation_seconds_saved, 3),
+            }
@@ -0,0 +1,51 @@
+import time
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+
+class StageTimer:
+    """Đo thời gian từng bước của một request và báo ngay khi mỗi bước kết thúc.
+
+    ``on_stage(name, seconds)`` (nếu có) được gọi mỗi khi một bước hoàn tất, kể cả
+    các bước chạy song song ở luồng khác, để nơi gọi có thể stream thời gian đo được.
+    """
+
+    def __init__(self, label: str = "", on_stage: Optional[Callable[[str, float], None]] = None):
+        self.label = label
+        self.on_stage = on_stage
+        self.stages: Dict[str, float] = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.stages[name] = seconds
+        print(f"[timing]{f' {self.label}' if self.label else ''} {name}: {seconds * 1000:.1f} ms")
+        if self.on_stage is not None:
+            try:
+                self.on_stage(name, seconds)
+            except Exception as e:
+                print(f"Error reporting stage timing for {name}: {e}")
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed(self, name: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Gọi ``fn`` và ghi lại thời gian chạy của nó dưới tên ``name``."""
+        with self.stage(name):
+            return fn(*args, **kwargs)
+
+    def total(self) -> float:
+        return time.perf_counter() - self._start
+
+    def summary(self) -> Dict[str, float]:
+        with self._lock:
+            result = {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()}
+        result["total"] = round(self.total() * 1000, 1)
+        return result
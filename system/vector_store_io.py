@@ -0,0 +1,128 @@
+import os
+import pickle
+from typing import Any, Dict, Iterator, Mapping, Union
+
+import faiss
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from search_engine.faiss_indexer import read_index
+from search_engine.record_store import RecordFile, atomic_write, write_records
+
+# Tên file của LangChain FAISS.save_local và file docstore dạng bản ghi đặt cạnh chúng
+INDEX_FILE = "index.faiss"
+PICKLE_FILE = "index.pkl"
+DOCSTORE_FILE = "docstore.records"
+
+
+class _PositionIds(Mapping):
+    """``index_to_docstore_id`` của store tải từ file bản ghi: vị trí i có docstore ID ``str(i)``."""
+
+    def __init__(self, count: int):
+        self._count = count
+
+    def __getitem__(self, position: int) -> str:
+        if not 0 <= position < self._count:
+            raise KeyError(position)
+        return str(position)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(self._count))
+
+
+class RecordDocstore(Docstore):
+    """Docstore chỉ đọc trên ``RecordFile``: Document được giải mã khi được truy cập."""
+
+    def __init__(self, records: RecordFile):
+        self.records = records
+
+    def search(self, search: str) -> Union[str, Document]:
+        try:
+            record = self.records[int(search)]
+        except (ValueError, IndexError):
+            return f"ID {search} not found."
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
+
+
+def save_vector_store(vector_store: FAISS, path: str):
+    """Lưu store theo định dạng ``FAISS.save_local`` kèm docstore dạng bản ghi để lần tải sau dùng được mmap.
+
+    Mỗi file được ghi ra file tạm rồi ``os.replace`` nên worker khác đang mmap bản cũ không bị ảnh hưởng.
+    """
+    vector_store = _in_memory_docstore(vector_store)
+    atomic_write(os.path.join(path, INDEX_FILE), lambda tmp_path: faiss.write_index(vector_store.index, tmp_path))
+
+    def write_pickle(tmp_path: str):
+        with open(tmp_path, "wb") as f:
+            pickle.dump((vector_store.docstore, dict(vector_store.index_to_docstore_id)), f)
+
+    atomic_write(os.path.join(path, PICKLE_FILE), write_pickle)
+
+    _write_docstore_records(vector_store, path)
+
+
+def _write_docstore_records(vector_store: FAISS, path: str):
+    """Ghi docstore theo thứ tự vị trí trong index ra ``docstore.records``."""
+    records = []
+    for position in range(vector_store.index.ntotal):
+        doc = vector_store.docstore.search(vector_store.index_to_docstore_id[position])
+        records.append({"page_content": doc.page_content, "metadata": doc.metadata})
+    try:
+        write_records(os.path.join(path, DOCSTORE_FILE), records)
+    except (TypeError, ValueError) as e:
+        # Metadata không serialize được bằng JSON: lần tải sau dùng index.pkl như trước
+        print(f"Keeping pickle docstore for {path}: {e}")
+        if os.path.exists(os.path.join(path, DOCSTORE_FILE)):
+            os.remove(os.path.join(path, DOCSTORE_FILE))
+
+
+def load_vector_store(path: str, embeddings, mmap: bool = True) -> FAISS:
+    """Tải FAISS store; với ``mmap`` thì map index.faiss và docstore vào bộ nhớ thay vì đọc toàn bộ.
+
+    Dùng ``FAISS.load_local`` khi không bật mmap, khi chưa có file docstore bản ghi hoặc khi
+    file đó không khớp số vector của index.faiss; khi bật mmap, file bản ghi được ghi lại từ
+    pickle để lần khởi động sau map được.
+    """
+    records_path = os.path.join(path, DOCSTORE_FILE)
+    if mmap and os.path.exists(records_path):
+        index, mmapped = read_index(os.path.join(path, INDEX_FILE), mmap=True)
+        records = RecordFile(records_path)
+        if len(records) == index.ntotal:
+            print(f"Loaded vector store {path} ({index.ntotal} vectors{', mmap' if mmapped else ''})")
+            return FAISS(embeddings, index, RecordDocstore(records), _PositionIds(len(records)))
+        print(f"Docstore records in {path} do not match the index ({len(records)} != {index.ntotal}), loading pickle")
+    vector_store = FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+    if mmap:
+        _write_docstore_records(vector_store, path)
+    return vector_store
+
+
+def _in_memory_docstore(vector_store: FAISS) -> FAISS:
+    """Store có docstore pickle được: giải mã RecordDocstore thành InMemoryDocstore (index giữ nguyên)."""
+    if not isinstance(vector_store.docstore, RecordDocstore):
+        return vector_store
+    docs: Dict[str, Any] = {}
+    ids: Dict[int, str] = {}
+    for position, record in enumerate(vector_store.docstore.records):
+        docs[str(position)] = Document(page_content=record["page_content"], metadata=record["metadata"])
+        ids[position] = str(position)
+    return FAISS(vector_store.embedding_function, vector_store.index, InMemoryDocstore(docs), ids)
+
+
+def materialize_vector_store(vector_store: FAISS) -> FAISS:
+    """Bản sao độc lập, sửa được (index trong bộ nhớ, InMemoryDocstore) của ``vector_store``.
+
+    Store đang phục vụ truy vấn (kể cả bản mmap) không bị động tới khi sửa trên bản sao.
+    """
+    if isinstance(vector_store.docstore, RecordDocstore):
+        store = _in_memory_docstore(vector_store)
+    else:
+        store = FAISS(vector_store.embedding_function, vector_store.index,
+                      InMemoryDocstore(dict(vector_store.docstore._dict)), dict(vector_store.index_to_docstore_id))
+    store.index = faiss.deserialize_index(faiss.serialize_index(vector_store.index))
+    return store
@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from langchain_community.vectorstores import FAISS
+
+from search_engine.record_store import atomic_write
+from .vector_store_io import materialize_vector_store, save_vector_store
+
+# Khóa và hash của hàng nguồn được lưu ngay trong metadata của Document
+ROW_KEY = "row_key"
+ROW_HASH = "row_hash"
+# Dấu phiên bản ghi cạnh vector store sau mỗi lần đồng bộ
+VERSION_FILE = "sync_version.json"
+# Trường metadata phụ thuộc vị trí hàng, không tính vào hash (xóa một hàng không làm các hàng sau "đổi")
+_UNHASHED_FIELDS = ("original_row_index",)
+# Trường metadata nhận diện hàng trong store dựng trước khi có đồng bộ (không có ``row_key``)
+TABLE_LEGACY_FIELDS = ("table", "original_row_index")
+DESCRIPTION_LEGACY_FIELDS = ("ID",)
+# Các hàng (ID, Name_Product, Descriptions) của vector store mô tả
+DESCRIPTION_SQL = "SELECT Product.ID, Name_Product, Descriptions FROM Product;"
+
+
+def row_hash(content: str, metadata: Dict[str, Any]) -> str:
+    """Hash nội dung và metadata của một hàng (bỏ qua khóa/hash đồng bộ và trường vị trí)."""
+    fields = {k: v for k, v in metadata.items() if k not in (ROW_KEY, ROW_HASH) + _UNHASHED_FIELDS}
+    payload = json.dumps([content, fields], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def keyed_documents(documents: Iterable[Tuple[str, str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """(khóa, nội dung, metadata) -> document có ``row_key``/``row_hash`` trong metadata; khóa trùng: hàng sau thắng."""
+    by_key: Dict[str, Dict[str, Any]] = {}
+    for key, content, metadata in documents:
+        metadata = dict(metadata, **{ROW_KEY: key, ROW_HASH: row_hash(content, metadata)})
+        by_key[key] = {"content": content, "metadata": metadata}
+    return list(by_key.values())
+
+
+def table_documents(documents: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Document của ``load_table_data`` với khóa ``<bảng>:<rowid>``."""
+    return keyed_documents(
+        (f"{doc['metadata']['table']}:{doc['metadata']['rowid']}", doc["content"], doc["metadata"])
+        for doc in documents
+    )
+
+
+def description_documents(products: Iterable[Tuple[Any, str, str]]) -> List[Dict[str, Any]]:
+    """Document mô tả sản phẩm từ các hàng (ID, Name_Product, Descriptions), khóa là product ID."""
+    return keyed_documents(
+        (str(product_id), f"{description}", {"ID": product_id, "name": name, "description": description})
+        for product_id, name, description in products
+    )
+
+
+def data_version(documents: List[Dict[str, Any]]) -> str:
+    """Phiên bản dữ liệu nguồn: hash của các cặp (khóa, hash hàng), không phụ thuộc thứ tự."""
+    digest = hashlib.sha1()
+    for key, value in sorted((doc["metadata"][ROW_KEY], doc["metadata"][ROW_HASH]) for doc in documents):
+        digest.update(f"{key}\0{value}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def read_version(path: str) -> Optional[Dict[str, Any]]:
+    version_path = os.path.join(path, VERSION_FILE)
+    if not os.path.exists(version_path):
+        return None
+    try:
+        with open(version_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading {version_path}: {e}")
+        return None
+
+
+def write_version(path: str, version: str, stats: Dict[str, Any]):
+    stamp = dict(stats, version=version, synced_at=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+    def writer(tmp_path: str):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(stamp, f, ensure_ascii=False, indent=2)
+
+    atomic_write(os.path.join(path, VERSION_FILE), writer)
+
+
+def _legacy_key(metadata: Dict[str, Any], fields: Sequence[str]) -> Optional[Tuple]:
+    if not fields or any(field not in metadata for field in fields):
+        return None
+    return tuple(json.dumps(metadata[field], default=str) for field in fields)
+
+
+def sync_vector_store(vector_store: Optional[FAISS], documents: List[Dict[str, Any]], embeddings,
+                      batch_size: int = 256,
+                      legacy_fields: Sequence[str] = ()) -> Tuple[Optional[FAISS], Dict[str, int]]:
+    """Đưa ``vector_store`` về đúng ``documents`` (kết quả của ``keyed_documents``).
+
+    Hàng mới hoặc có ``row_hash`` khác được embed theo batch ``batch_size``; vector của hàng đã bị
+    xóa hoặc đã đổi bị xóa. Document không có ``row_key`` (store dựng trước khi có đồng bộ) được
+    nhận lại theo các trường ``legacy_fields`` của metadata (ví dụ bảng và vị trí hàng): nếu nội
+    dung vẫn giống hàng hiện tại thì vector cũ được giữ và chỉ metadata được thay, không embed lại.
+    Mọi thay đổi làm trên bản sao (``materialize_vector_store``) nên store đang phục vụ không bị
+    động tới. Trả về ``(store, thống kê)``; store là chính ``vector_store`` nếu không có gì thay
+    đổi, None nếu chưa có store và cũng không có document nào.
+    """
+    wanted = {doc["metadata"][ROW_KEY]: doc for doc in documents}
+    by_legacy_key = {}
+    if legacy_fields:
+        for key, doc in wanted.items():
+            legacy_key = _legacy_key(doc["metadata"], legacy_fields)
+            if legacy_key is not None:
+                by_legacy_key[legacy_key] = key
+
+    existing: Dict[str, Tuple[str, str]] = {}  # row_key -> (docstore ID, row_hash)
+    adopted: Dict[str, str] = {}  # row_key -> docstore ID của document cũ giữ lại vector
+    stale: List[str] = []
+    if vector_store is not None:
+        for docstore_id in vector_store.index_to_docstore_id.values():
+            doc = vector_store.docstore.search(docstore_id)
+            metadata = getattr(doc, "metadata", None) or {}
+            key = metadata.get(ROW_KEY)
+            if key is None:
+                key = by_legacy_key.get(_legacy_key(metadata, legacy_fields))
+                if (key is not None and key not in existing and key not in adopted
+                        and getattr(doc, "page_content", None) == wanted[key]["content"]):
+                    adopted[key] = docstore_id
+                else:
+                    stale.append(docstore_id)
+            elif key in existing or key in adopted or key not in wanted:
+                stale.append(docstore_id)
+            else:
+                existing[key] = (docstore_id, metadata.get(ROW_HASH))
+    # Document đã có row_key thắng bản cũ cùng hàng
+    for key in [key for key in adopted if key in existing]:
+        stale.append(adopted.pop(key))
+
+    changed = [key for key, (_, stored_hash) in existing.items() if stored_hash != wanted[key]["metadata"][ROW_HASH]]
+    to_embed = ([doc for key, doc in wanted.items() if key not in existing and key not in adopted]
+                + [wanted[key] for key in changed])
+    stats = {
+        "added": len(to_embed) - len(changed),
+        "updated": len(changed),
+        "deleted": len(stale),
+        "unchanged": len(existing) - len(changed),
+        "adopted": len(adopted),
+    }
+    if not to_embed and not stale and not adopted:
+        stats["total"] = vector_store.index.ntotal if vector_store is not None else 0
+        return vector_store, stats
+
+    store = materialize_vector_store(vector_store) if vector_store is not None else None
+    reused: List[Tuple[str, Any]] = []  # (row_key, vector) của document cũ được nhận lại
+    if store is not None and adopted:
+        positions = {docstore_id: position for position, docstore_id in store.index_to_docstore_id.items()}
+        reused = [(key, store.index.reconstruct(positions[docstore_id])) for key, docstore_id in adopted.items()]
+    removed = stale + [existing[key][0] for key in changed] + list(adopted.values())
+    if store is not None and removed:
+        store.delete(removed)
+    if reused:
+        store.add_embeddings([(wanted[key]["content"], vector) for key, vector in reused],
+                             metadatas=[wanted[key]["metadata"] for key, _ in reused])
+
+    batch_size = max(1, batch_size)
+    for start in range(0, len(to_embed), batch_size):
+        batch = to_embed[start:start + batch_size]
+        texts = [doc["content"] for doc in batch]
+        metadatas = [doc["metadata"] for doc in batch]
+        vectors = embeddings.embed_documents(texts)
+        if store is None:
+            store = FAISS.from_embeddings(list(zip(texts, vectors)), embeddings, metadatas=metadatas)
+        else:
+            store.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas)
+        print(f"Embedded {min(start + batch_size, len(to_embed))}/{len(to_embed)} documents")
+
+    stats["total"] = store.index.ntotal if store is not None else 0
+    return store, stats
+
+
+def sync_and_save(vector_store: Optional[FAISS], documents: List[Dict[str, Any]], embeddings, path: str,
+                  batch_size: int = 256,
+                  legacy_fields: Sequence[str] = ()) -> Tuple[Optional[FAISS], Dict[str, int]]:
+    """``sync_vector_store`` rồi lưu store vào ``path`` nếu có thay đổi và ghi dấu phiên bản dữ liệu."""
+    store, stats = sync_vector_store(vector_store, documents, embeddings, batch_size, legacy_fields)
+    if store is None:
+        return store, stats
+    version = data_version(documents)
+    if store is not vector_store:
+        os.makedirs(path, exist_ok=True)
+        save_vector_store(store, path)
+    if store is not vector_store or (read_version(path) or {}).get("version") != version:
+        write_version(path, version, stats)
+    return store, stats
+
+
+def main(config):
+    """Đồng bộ một lần cả hai vector store trên đĩa (không cần chạy app)."""
+    from db_pool import get_pool
+    from utils import load_table_data
+    from search_engine.description_embeddings import DescriptionEmbeddings, FILE_NAME as DESCRIPTION_EMBEDDINGS_FILE
+    from .model_registry import model_registry, register_default_models, PHOBERT
+    from .vector_store_io import load_vector_store
+
+    register_default_models(config)
+    embeddings = model_registry.get(PHOBERT)
+
+    def load(path: str) -> Optional[FAISS]:
+        if not os.path.exists(path):
+            return None
+        try:
+            return load_vector_store(path, embeddings)
+        except Exception as e:
+            print(f"Error loading vector store {path}: {e}")
+            return None
+
+    documents = table_documents(load_table_data(config.db_path))
+    if documents:
+        _, stats = sync_and_save(load(config.vector_store_path), documents, embeddings, config.vector_store_path,
+                                 config.vector_sync_batch_size, TABLE_LEGACY_FIELDS)
+        print(f"Vector store: {stats}")
+    else:
+        print("No documents loaded from database, keeping current vector store")
+
+    documents = description_documents(get_pool(config.db_path).fetchall(DESCRIPTION_SQL))
+    if documents:
+        current = load(config.description_vector_store_path)
+        store, stats = sync_and_save(current, documents, embeddings, config.description_vector_store_path,
+                                     config.vector_sync_batch_size, DESCRIPTION_LEGACY_FIELDS)
+        if store is not None and store is not current:
+            DescriptionEmbeddings.from_vector_store(store).save(
+                os.path.join(config.description_vector_store_path, DESCRIPTION_EMBEDDINGS_FILE)
+            )
+        print(f"Description vector store: {stats}")
+    else:
+        print("No product descriptions found, keeping current description vector store")
+
+
+if __name__ == "__main__":
+    from config import Config
+
+    parser = argparse.ArgumentParser(
+        description="Đồng bộ vector store dữ liệu bảng và mô tả sản phẩm với database (chạy một lần)"
+    )
+    parser.parse_args()
+    main(Config())
@@ -0,0 +1,137 @@
+import time
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+PENDING = "pending"
+LOADING = "loading"
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+
+
+@dataclass
+class WarmupComponent:
+    """Một thành phần tải lúc khởi động: ``load`` trả về đối tượng, ``warmup`` chạy thử một lần trên nó."""
+    name: str
+    load: Callable[[], Any]
+    warmup: Optional[Callable[[Any], Any]] = None
+    required: bool = True
+    status: str = PENDING
+    load_s: Optional[float] = None
+    warmup_s: Optional[float] = None
+    error: Optional[str] = None
+    attempts: int = 0
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "status": self.status,
+            "required": self.required,
+            "load_s": round(self.load_s, 3) if self.load_s is not None else None,
+            "warmup_s": round(self.warmup_s, 3) if self.warmup_s is not None else None,
+            "error": self.error,
+            "attempts": self.attempts,
+        }
+
+
+class StartupWarmup:
+    """Tải model và chỉ mục theo thứ tự ưu tiên sau khi server đã mở cổng.
+
+    ``start`` chạy các thành phần lần lượt trong một tác vụ nền (``spawn``, ví dụ
+    ``socketio.start_background_task``); mỗi thành phần được tải rồi chạy một lượt suy luận
+    thử nếu ``run_warmup``. Server sẵn sàng nhận traffic khi mọi thành phần ``required`` đã
+    ``ready``. Các hàm ``load``/``warmup`` tự đưa phần nặng CPU lên pool suy luận.
+
+    Thành phần lỗi (ví dụ database hoặc file model chưa sẵn sàng) được chạy lại tối đa
+    ``retry_attempts`` lần, cách nhau ``retry_backoff`` giây, nhân đôi sau mỗi lần (tối đa
+    ``MAX_RETRY_BACKOFF``), để server tự hồi phục thay vì báo chưa sẵn sàng mãi.
+    """
+
+    MAX_RETRY_BACKOFF = 300.0
+
+    def __init__(self, components: Iterable[WarmupComponent], order: Optional[List[str]] = None,
+                 run_warmup: bool = True, retry_attempts: int = 5, retry_backoff: float = 5.0):
+        components = list(components)
+        by_name = {component.name: component for component in components}
+        for name in order or []:
+            if name not in by_name:
+                print(f"Warm-up: unknown component '{name}' in WARMUP_ORDER, ignoring")
+        ordered = [by_name[name] for name in dict.fromkeys(order or []) if name in by_name]
+        self.components = ordered + [c for c in components if c not in ordered]
+        self.run_warmup = run_warmup
+        self.retry_attempts = max(0, retry_attempts)
+        self.retry_backoff = max(0.0, retry_backoff)
+        self._lock = threading.Lock()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.created_at = time.monotonic()
+
+    def start(self, spawn: Callable[[Callable[[], None]], Any]):
+        """Chạy ``run`` trong tác vụ nền; gọi nhiều lần chỉ chạy một lần."""
+        with self._lock:
+            if self.started_at is not None:
+                return
+            self.started_at = time.monotonic()
+        spawn(self._run)
+
+    def run(self):
+        """Chạy mọi thành phần ngay trên luồng hiện tại (chế độ khởi động chặn)."""
+        with self._lock:
+            if self.started_at is not None:
+                return
+            self.started_at = time.monotonic()
+        self._run()
+
+    def _run(self):
+        for component in self.components:
+            self._run_component(component)
+        delay = self.retry_backoff
+        for attempt in range(1, self.retry_attempts + 1):
+            failed = [c for c in self.components if c.status == FAILED]
+            if not failed:
+                break
+            print(f"Warm-up: retrying {', '.join(c.name for c in failed)} in {delay:.0f}s "
+                  f"(attempt {attempt}/{self.retry_attempts})")
+            # time.sleep được eventlet monkey-patch nên chỉ nhường greenlet, không chặn server
+            time.sleep(delay)
+            for component in failed:
+                self._run_component(component)
+            delay = min(delay * 2, self.MAX_RETRY_BACKOFF)
+        self.finished_at = time.monotonic()
+        print(f"Warm-up finished in {self.finished_at - self.started_at:.2f}s, ready={self.is_ready()}")
+
+    def _run_component(self, component: WarmupComponent):
+        component.attempts += 1
+        try:
+            component.status = LOADING
+            start = time.perf_counter()
+            loaded = component.load()
+            component.load_s = time.perf_counter() - start
+
+            if self.run_warmup and component.warmup is not None:
+                component.status = WARMING
+                start = time.perf_counter()
+                component.warmup(loaded)
+                component.warmup_s = time.perf_counter() - start
+
+            component.status = READY
+            component.error = None
+            print(f"Warm-up: '{component.name}' ready (load {component.load_s:.2f}s"
+                  f"{f', warm-up {component.warmup_s:.2f}s' if component.warmup_s is not None else ''})")
+        except Exception as e:
+            component.status = FAILED
+            component.error = str(e)
+            print(f"Warm-up: '{component.name}' failed: {e}")
+
+    def is_ready(self) -> bool:
+        return all(c.status == READY for c in self.components if c.required)
+
+    def status(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "ready": self.is_ready(),
+            "uptime_s": round(now - self.created_at, 1),
+            "warmup_s": round((self.finished_at or now) - self.started_at, 2) if self.started_at is not None else None,
+            "finished": self.finished_at is not None,
+            "components": {c.name: c.describe() for c in self.components},
+        }
@@ -0,0 +1,69 @@
+import numpy as np
+
+from system.query_router import is_context_dependent
+from system.response_cache import ResponseCache
+
+
+def _cache():
+    return ResponseCache(lambda: "v1", similarity_threshold=0.97)
+
+
+def test_same_follow_up_with_different_history_gets_different_answers():
+    cache = _cache()
+    question_vector = np.array([1.0, 0.0, 0.0], dtype=np.float32)
+    history_a = "Q: Cappuccino có gì đặc biệt?\nA: Cappuccino có lớp bọt sữa dày."
+    history_b = "Q: Trà đào có ngọt không?\nA: Trà đào vị ngọt thanh."
+
+    scope_a = ResponseCache.scope_for("anonymous", personalized=False, context=history_a)
+    scope_b = ResponseCache.scope_for("anonymous", personalized=False, context=history_b)
+    cache.put("sql", scope_a, question_vector, "Giá bao nhiêu?", "Cappuccino giá 45.000đ")
+
+    assert cache.get("sql", scope_b, question_vector) is None
+    cache.put("sql", scope_b, question_vector, "Giá bao nhiêu?", "Trà đào giá 39.000đ")
+
+    assert cache.get("sql", scope_a, question_vector) == "Cappuccino giá 45.000đ"
+    assert cache.get("sql", scope_b, question_vector) == "Trà đào giá 39.000đ"
+
+
+def test_answer_given_with_history_is_not_served_without_history():
+    cache = _cache()
+    question_vector = np.array([0.0, 1.0, 0.0], dtype=np.float32)
+    with_history = ResponseCache.scope_for("42", personalized=True, context="Q: Latte?\nA: Latte giá 50.000đ")
+    cache.put("sql", with_history, question_vector, "Giá bao nhiêu?", "Latte giá 50.000đ")
+
+    assert cache.get("sql", ResponseCache.scope_for("42", personalized=True), question_vector) is None
+
+
+def test_evict_by_user_scope_includes_context_scopes():
+    cache = _cache()
+    vector = np.array([0.0, 0.0, 1.0], dtype=np.float32)
+    cache.put("vector", ResponseCache.scope_for("42", personalized=True), vector, "q", "a")
+    cache.put("vector", ResponseCache.scope_for("42", personalized=True, context="Q: x\nA: y"), vector, "q", "b")
+    cache.put("vector", ResponseCache.scope_for("7", personalized=True), vector, "q", "c")
+
+    assert cache.evict(scope="42") == 2
+    assert cache.stats()["entries"] == 1
+
+
+def _scope(user_key, query, history):
+    context = history if is_context_dependent(query) else ""
+    return ResponseCache.scope_for(user_key, personalized=user_key != "anonymous", context=context)
+
+
+def test_context_free_repeat_is_served_across_histories():
+    cache = _cache()
+    vector = np.array([1.0, 1.0, 0.0], dtype=np.float32)
+    query = "Món nào đắt nhất trong menu?"
+    cache.put("sql", _scope("anonymous", query, "Q: Chào bạn\nA: Xin chào!"), vector, query, "Caffè Mocha 65.000đ")
+
+    # Lượt hỏi khác, lịch sử khác; tra trước khi chọn tool nên không cần biết route
+    assert cache.get(None, _scope("anonymous", query, "Q: Trà đào?\nA: Vị ngọt thanh."), vector) == "Caffè Mocha 65.000đ"
+    assert cache.stats()["hits_by_route"] == {"sql": 1}
+
+
+def test_follow_up_is_scoped_to_its_history():
+    history_a = "Q: Cappuccino có gì đặc biệt?\nA: Cappuccino có lớp bọt sữa dày."
+    history_b = "Q: Trà đào có ngọt không?\nA: Trà đào vị ngọt thanh."
+
+    for query in ("Giá bao nhiêu?", "Còn size lớn thì sao?", "Món đó có bao nhiêu calo?"):
+        assert _scope("anonymous", query, history_a) != _scope("anonymous", query, history_b)
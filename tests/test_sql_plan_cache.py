@@ -0,0 +1,48 @@
+import sqlite3
+
+from system.sql_plan_cache import SQLPlanCache
+
+SCHEMA = "products(id, name, price, category_id, is_active)"
+
+
+def _cache():
+    entities = {"product": ["Caffè Latte", "Cappuccino", "Trà đào"], "category": ["Cà phê", "Trà"]}
+    return SQLPlanCache(lambda: entities, lambda: "v1")
+
+
+def test_limit_query_is_cached_and_replayed_with_new_bindings():
+    cache = _cache()
+    sql = ("SELECT name, price FROM products WHERE is_active = 1 AND name LIKE '%Cappuccino%' "
+           "ORDER BY price DESC LIMIT 3")
+    plan = cache.store("Top 3 món giống Cappuccino?", sql, SCHEMA)
+
+    assert plan is not None
+    assert "LIMIT :p" in plan.template_sql
+    assert "is_active = 1" in plan.template_sql
+
+    cached = cache.lookup("Top 5 món giống Trà đào?", SCHEMA)
+    assert cached is not None
+    plan, params = cached
+    assert set(params.values()) == {5, "%Trà đào%"}
+
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE products (id INTEGER, name TEXT, price REAL, category_id INTEGER, is_active INTEGER)")
+    conn.executemany("INSERT INTO products (name, price, is_active) VALUES (?, ?, 1)",
+                     [(f"Trà đào {i}", 30000 + i) for i in range(8)])
+    assert len(conn.execute(plan.template_sql, params).fetchall()) == 5
+
+
+def test_structural_limit_without_question_number_stays_fixed():
+    cache = _cache()
+    plan = cache.store("Món bán chạy nhất?", "SELECT name FROM products ORDER BY 1 LIMIT 5", SCHEMA)
+
+    assert plan is not None and not plan.params
+    assert cache.lookup("Món bán chạy nhất?", SCHEMA)[1] == {}
+
+
+def test_entity_literal_from_history_is_not_cached():
+    cache = _cache()
+    sql = "SELECT price FROM products WHERE name LIKE '%Caffè Latte%' LIMIT 1"
+
+    assert cache.store("Giá bao nhiêu?", sql, SCHEMA) is None
+    assert cache.lookup("Giá bao nhiêu?", SCHEMA) is None